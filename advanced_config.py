@@ -5,7 +5,16 @@ from datetime import timedelta
 CACHE_SETTINGS = {
     "enabled": True,
     "expire_time": 300,  # 5 minutes
-    "max_size": 1000,  # Maximum number of items in cache
+    "max_size": 1000,  # Maximum number of items per memory cache namespace
+    "namespace_max_size": {  # overrides of max_size for busier namespaces
+        "users": 10000,
+        "services": 200,
+        "reports": 100,
+    },
+    "user_expire_time": 60,  # User snapshots served without touching the database
+    "user_max_size": 10000,
+    "service_expire_time": 300,  # @cached service lookups, dropped on any service edit
+    "report_expire_time": 60,  # @cached reports, dropped when a purchase completes
 }
 
 # Security Settings
@@ -52,7 +61,9 @@ CLEANUP_SETTINGS = {
     "expired_users_days": 30,  # Delete expired users after 30 days
     "old_logs_days": 90,  # Delete logs older than 90 days
     "old_backups_days": 30,  # Delete backups older than 30 days
-    "backup_retention_count": 10  # Keep last 10 backups minimum
+    "backup_retention_count": 10,  # Keep last 10 backups minimum
+    "expired_users_chunk_size": 200,  # services deleted per commit
+    "marzban_delete_concurrency": 10  # panel deletes in flight per chunk
 }
 
 # Performance Settings
@@ -63,6 +74,66 @@ PERFORMANCE_SETTINGS = {
     "max_connections": 1000
 }
 
+# Marzban Client Settings
+MARZBAN_CLIENT_SETTINGS = {
+    "dns_cache_ttl": 300,  # seconds a resolved panel address is reused
+    "keepalive_timeout": 60,  # seconds an idle panel connection stays open
+    "token_refresh_margin": 60,  # renew the JWT this many seconds before it expires
+    "default_token_ttl": 86400,  # if the token carries no exp claim
+    "failure_threshold": 5,  # consecutive failures that open the circuit
+    "reset_timeout": 30,  # seconds the circuit stays open before a trial call
+    "inbound_cache_ttl": 3600,  # seconds cached inbound definitions are trusted
+    "inbound_refresh_interval": 600,  # background refresh of the inbound registry
+}
+
+# Marzban Usage Sync Settings
+MARZBAN_SYNC_SETTINGS = {
+    "interval": 300,  # seconds between usage syncs
+    "page_size": 500,  # panel users per API call
+    "concurrency": 4,  # pages fetched at once
+}
+
+PROVISIONING_SETTINGS = {
+    "concurrency": 4,  # Marzban accounts created at once
+    "max_attempts": 8,  # then the job is marked failed and the admin is told
+    "backoff_base": 5,  # seconds before the first retry, doubled after each failure
+    "backoff_max": 600,  # cap on the wait between retries
+    "poll_interval": 30,  # seconds between checks for due retries when idle
+}
+
+# Broadcast Settings
+BROADCAST_SETTINGS = {
+    "global_rate": 25,  # messages/s, under Telegram's ~30/s bot-wide limit
+    "per_chat_interval": 1.0,  # seconds between messages to the same chat
+    "concurrency": 20,  # sends in flight at once
+    "retry_attempts": 3,  # per recipient, on network errors
+    "max_flood_waits": 10,  # RetryAfter pauses per recipient before giving up; they use no attempt
+    "progress_interval": 3,  # seconds between progress message edits
+    "stream_batch_size": 500,  # recipient ids fetched per query, each in a fresh session
+}
+
+# Database Settings
+DATABASE_SETTINGS = {
+    "journal_mode": "WAL",  # Readers never wait on the writer
+    "synchronous": "NORMAL",  # fsync on checkpoint only, safe with WAL
+    "mmap_size": 268435456,  # 256 MB
+    "cache_size": -65536,  # 64 MB (negative values are KiB)
+    "busy_timeout": 5000,  # ms
+    "write_batch_size": 200,  # Max writes grouped into one commit
+}
+
+# Pagination Settings
+PAGINATION_SETTINGS = {
+    "page_size": 10,  # Rows per page in admin listings
+}
+
+# Log Settings
+LOG_SETTINGS = {
+    "flush_interval": 500,  # ms between flushes of buffered log rows
+    "flush_size": 100,  # Flush early once this many rows are waiting
+    "max_backlog": 10000,  # Oldest rows are dropped beyond this
+}
+
 # Path Settings
 PATH_SETTINGS = {
     "backup_dir": "backups",
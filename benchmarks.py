@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from cache_manager import MemoryTier
+from database import Database, AsyncDatabase, Transaction, backfill_sales_rollup, sales_summary_query
+from init_db import migrate_database
+from menus import MENU_LAYOUTS, MenuRegistry, build_markup
+
+
+def _temp_db_url(directory: str) -> str:
+    return f"sqlite:///{os.path.join(directory, 'bench.db')}"
+
+
+async def _heartbeat(stop: asyncio.Event, interval: float = 0.001):
+    """Measure how long the event loop was stalled between ticks"""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def _run_updates(handle_update, updates: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    heartbeat = asyncio.create_task(_heartbeat(stop))
+
+    async def one(i):
+        async with semaphore:
+            await handle_update(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(updates)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return elapsed, await heartbeat
+
+
+def bench_concurrent_updates(updates: int = 2000, concurrency: int = 50):
+    """Simulate a burst of /start + purchase updates against both database layers.
+
+    Expect the sync layer to show the most updates/s: it runs each query
+    inline, while aiosqlite hands every statement to its worker thread and
+    back. What the async layers buy is the loop stall. A sync query blocks
+    every other update until it returns; async queries leave the loop free,
+    so one slow write no longer delays unrelated users. Compare the stall
+    column, not the throughput one.
+    """
+    print(f"Concurrent updates: {updates} updates, concurrency {concurrency}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(_temp_db_url(directory))
+        for i in range(updates):
+            db.create_user(telegram_id=i)
+
+        async def sync_update(i):
+            # What the handlers used to do: call the sync layer inline
+            user = db.get_user(i)
+            db.create_transaction(user.id, 1000, 'deposit')
+            await asyncio.sleep(0)
+
+        elapsed, stall = asyncio.run(_run_updates(sync_update, updates, concurrency))
+        print(f"  sync Database:  {updates / elapsed:8.0f} updates/s, worst loop stall {stall * 1000:7.1f} ms")
+        db.engine.dispose()
+
+    for label, batched in (("AsyncDatabase:", False), ("+ BatchWriter:", True)):
+        with tempfile.TemporaryDirectory() as directory:
+            migrate_database(_temp_db_url(directory))
+            async_db = AsyncDatabase(_temp_db_url(directory))
+
+            async def run():
+                for i in range(updates):
+                    await async_db.create_user(telegram_id=i)
+                if batched:
+                    await async_db.start()
+
+                async def async_update(i):
+                    user = await async_db.get_user(i)
+                    await async_db.create_transaction(user.id, 1000, 'deposit')
+
+                result = await _run_updates(async_update, updates, concurrency)
+                await async_db.close()
+                return result
+
+            elapsed, stall = asyncio.run(run())
+            print(f"  {label:15} {updates / elapsed:8.0f} updates/s, worst loop stall {stall * 1000:7.1f} ms")
+    print("  (async trades some throughput for a free event loop; the stall is the latency other updates see)")
+
+
+def _seed_transactions(db: Database, count: int, days: int = 60):
+    """Insert `count` transactions spread over the last `days` days"""
+    now = datetime.utcnow()
+    rng = random.Random(42)
+    db.create_user(telegram_id=1)
+    with db.engine.begin() as conn:
+        for offset in range(0, count, 50000):
+            conn.execute(insert(Transaction), [
+                {
+                    'user_id': 1,
+                    'amount': rng.choice((50000, 100000, 250000)),
+                    'type': rng.choice(('purchase', 'purchase', 'deposit')),
+                    'status': rng.choice(('completed', 'completed', 'pending')),
+                    'created_at': now - timedelta(seconds=rng.randrange(days * 86400))
+                }
+                for _ in range(min(50000, count - offset))
+            ])
+
+
+def _orm_sales_summary(db: Database, today):
+    """The previous report: three ORM queries, summed in Python"""
+    with Session(db.engine) as session:
+        summary = []
+        for days in (0, 7, 30):
+            sales = session.scalars(select(Transaction).filter(
+                Transaction.type == 'purchase',
+                Transaction.status == 'completed',
+                Transaction.created_at >= today - timedelta(days=days)
+            )).all()
+            summary.append((len(sales), sum(t.amount for t in sales)))
+        return tuple(summary)
+
+
+def _rollup_sales_summary(db: Database, today):
+    with db.engine.connect() as conn:
+        row = conn.execute(sales_summary_query(today)).one()
+        return tuple(zip(row[0::2], row[1::2]))
+
+
+def _best_of(func, *args, repeat: int = 3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_sales_report(sizes=(100_000, 1_000_000)):
+    """Sales report latency: ORM objects summed in Python vs the daily rollup"""
+    print("Sales report:")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            db = Database(_temp_db_url(directory))
+            _seed_transactions(db, size)
+            with db.engine.begin() as conn:
+                backfill_sales_rollup(conn)
+            today = datetime.utcnow().date()
+
+            orm_time, orm_result = _best_of(_orm_sales_summary, db, today)
+            rollup_time, rollup_result = _best_of(_rollup_sales_summary, db, today)
+            assert [count for count, _ in orm_result] == [count for count, _ in rollup_result]
+
+            print(f"  {size:>9,} rows: ORM {orm_time * 1000:9.1f} ms, daily rollup {rollup_time * 1000:8.1f} ms")
+            db.engine.dispose()
+
+
+def _scan_evicting_set(cache: dict, key, value, expire_seconds: int, max_size: int):
+    """The previous memory cache insert: a min() scan over every entry once full"""
+    cache[key] = {'value': value, 'expire_time': datetime.utcnow() + timedelta(seconds=expire_seconds)}
+    if len(cache) > max_size:
+        del cache[min(cache.items(), key=lambda item: item[1]['expire_time'])[0]]
+
+
+def bench_memory_cache(keys: int = 100_000, scan_writes: int = 200):
+    """Memory tier set/get/evict cost with `keys` entries resident"""
+    print(f"Memory cache: {keys:,} keys")
+    rng = random.Random(42)
+
+    cache = {}
+    for i in range(keys):
+        _scan_evicting_set(cache, f"k{i}", i, 300, keys)
+    started = time.perf_counter()
+    for i in range(scan_writes):
+        _scan_evicting_set(cache, f"new{i}", i, 300, keys)
+    scan_set = (time.perf_counter() - started) / scan_writes
+
+    tier = MemoryTier(max_size=keys, namespace_sizes={})
+    started = time.perf_counter()
+    for i in range(keys):
+        tier.set(f"k{i}", i, rng.randrange(60, 600))
+    fill = (time.perf_counter() - started) / keys
+
+    started = time.perf_counter()
+    for i in range(keys):
+        tier.set(f"new{i}", i, rng.randrange(60, 600))  # every set evicts
+    evicting_set = (time.perf_counter() - started) / keys
+
+    lookups = [f"new{rng.randrange(keys)}" for _ in range(keys)]
+    started = time.perf_counter()
+    for key in lookups:
+        tier.get(key)
+    get = (time.perf_counter() - started) / keys
+
+    stats = tier.stats()['default']
+    print(f"  dict + min() scan: {scan_set * 1e6:9.1f} us/set when full")
+    print(f"  LRU + TTL heap:    {evicting_set * 1e6:9.1f} us/set when full, "
+          f"{fill * 1e6:.1f} us/set filling, {get * 1e6:.1f} us/get")
+    print(f"  {stats['evictions']:,} evictions, {stats['hits']:,} hits, {stats['misses']:,} misses")
+
+
+def _traced(func, calls):
+    """Blocks and bytes allocated per call; results are kept alive so nothing is freed in between"""
+    kept = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    started = time.perf_counter()
+    for args in calls:
+        kept.append(func(*args))
+    elapsed = time.perf_counter() - started
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in diff)
+    size = sum(stat.size_diff for stat in diff)
+    return blocks / len(calls), size / len(calls), elapsed / len(calls)
+
+
+def bench_menus(updates: int = 20_000):
+    """Static menu markups: built per update (old handlers) vs prebuilt registry"""
+    print(f"Menus: {updates:,} updates")
+    rng = random.Random(42)
+    layouts = MENU_LAYOUTS['fa']
+    calls = []
+    for _ in range(updates):
+        name = rng.choice(list(layouts))
+        roles = layouts[name][0]
+        calls.append((name, rng.choice(roles)))
+
+    registry = MenuRegistry()
+    rebuilt = _traced(lambda name, role: build_markup(layouts[name][1], role), calls)
+    prebuilt = _traced(lambda name, role: registry.get(name, role), calls)
+    for label, (blocks, size, elapsed) in (('built per update', rebuilt), ('prebuilt registry', prebuilt)):
+        print(f"  {label:17} {blocks:7.1f} allocations, {size:8.0f} bytes, {elapsed * 1e6:6.2f} us per update (traced)")
+
+
+BENCHMARKS = {
+    'updates': bench_concurrent_updates,
+    'sales_report': bench_sales_report,
+    'memory_cache': bench_memory_cache,
+    'menus': bench_menus,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VPN bot benchmarks")
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,33 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, filters, CallbackContext
 )
 
-from marzpy import Marzban
 from database import *
+from advanced_config import CACHE_SETTINGS
+from cache_manager import cached
+from broadcast import Broadcaster
+from catalog import ServiceCatalog
+from init_db import migrate_database
+from menus import DEFAULT_LOCALE, MenuRegistry
+from notifications import ExpiryScheduler, send_low_data_warnings
+from provisioning import Provisioner
+from marzban_client import InboundRegistry, MarzbanClient, PanelUnavailable
+from usage_sync import UsageSync
+from optimizations import SendRateLimiter
 from config import *
 import json
 import os
-import traceback
 import psutil
-from aiohttp import ClientError, ClientSession
-import pytz
-from typing import Dict, Any, Optional, List, Union
+from aiohttp import ClientError, ClientResponseError
+from typing import Optional, List
 
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select
+from sqlalchemy.orm import selectinload
 
 # Configure logging
 logging.basicConfig(
@@ -33,7 +42,7 @@ class LogManager:
 
     async def log(self, level: str, module: str, message: str, details: dict = None):
         try:
-            self.db.log_system(level, module, message, details)
+            await self.db.log_system(level, module, message, details)
         except Exception as e:
             logger.error(f"Failed to create log entry: {e}")
 
@@ -60,26 +69,74 @@ class ErrorHandler:
 
 class VPNBot:
     def __init__(self):
-        self.db = Database(DATABASE_URL)
-        self.marzban = Marzban(
+        self.db = AsyncDatabase(DATABASE_URL)
+        self.marzban = MarzbanClient(
+            MARZBAN_CONFIG["url"],
             MARZBAN_CONFIG["username"],
-            MARZBAN_CONFIG["password"],
-            MARZBAN_CONFIG["url"]
+            MARZBAN_CONFIG["password"]
         )
+        self.inbounds = InboundRegistry(self.marzban)
+        self.usage_sync = UsageSync(self.db, self.marzban)
+        self.cache_manager = self.db.cache_manager
+        self.catalog = ServiceCatalog(self.db)
+        self.menus = MenuRegistry()
         self.log_manager = LogManager(self.db)
+        self.rate_limiter = SendRateLimiter()
+        self.broadcasts = {}  # job id -> running task
+        self.expiry_scheduler = ExpiryScheduler(self.db, self.rate_limiter)
+        self.provisioner = Provisioner(self.db, self.marzban, self.inbounds, self.rate_limiter, ADMIN_ID)
         self.error_handler = ErrorHandler(self)
         self.system_monitor = SystemMonitor(self)
         self.cleanup_manager = CleanupManager(self)
+        self.background_tasks = set()
 
-    async def initialize(self):
+    async def initialize(self, application: Application = None):
         """Initialize bot with optimizations"""
-        await self.marzban.get_token()
-        self._create_default_services()
+        if application is not None:
+            self.bot = application.bot
+
+        # DDL is a one-off at startup and runs on its own sync engine
+        for version in await asyncio.to_thread(migrate_database, DATABASE_URL):
+            logger.info(f"Migration {version:03d} applied")
+        await self.db.start()
+
+        try:
+            await self.marzban.get_token()
+        except Exception as e:
+            logger.error(f"Marzban login failed: {e}")
+
+        await self.catalog.reload()
+        await self._create_default_services()
+
+        # Pick up broadcasts interrupted by the last shutdown where they stopped
+        for job in await self.db.get_running_broadcast_jobs():
+            self._start_broadcast(self.bot, job)
 
         # Start background tasks
-        asyncio.create_task(self.system_monitor.start_monitoring())
-        asyncio.create_task(self.cleanup_manager.start_cleanup())
-        asyncio.create_task(self.setup_notifications())
+        self._start_task(self.system_monitor.start_monitoring())
+        self._start_task(self.cleanup_manager.start_cleanup())
+        self._start_task(self.setup_notifications())
+        self._start_task(self.expiry_scheduler.run(self.bot))
+        self._start_task(self.usage_sync.run_forever())
+        self._start_task(self.inbounds.run_forever())
+        self._start_task(self.provisioner.run_forever(self.bot))
+        self._start_task(self._cleanup_cache())
+
+    async def shutdown(self, application: Application = None):
+        """Stop background tasks and flush queued database writes"""
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        await self.marzban.close()
+        await self.db.close()
+        self.cache_manager.close()
+
+    def _start_task(self, coro):
+        # Keep a strong reference, the event loop only holds weak ones
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
 
     async def _cleanup_cache(self):
         """Periodic cache cleanup"""
@@ -91,16 +148,35 @@ class VPNBot:
                 logger.error(f"Cache cleanup error: {e}")
                 await asyncio.sleep(300)
 
-    def _create_default_services(self):
+    async def _services_changed(self):
+        """After an admin edit: drop cached service lookups and rebuild the catalog"""
+        self.cache_manager.invalidate('services')
+        await self.catalog.reload()
+
+    def _menu(self, name: str, user):
+        """The prebuilt markup of a static menu for this user's role and language"""
+        role = 'admin' if user.id == ADMIN_ID else 'user'
+        return self.menus.get(name, role, user.language_code or DEFAULT_LOCALE)
+
+    async def _create_default_services(self):
         """Create default services in database"""
+        if self.catalog.snapshot.services:
+            return
+
         for template in SERVICE_TEMPLATES.values():
-            self.db.create_service(
+            try:
+                if not await self.inbounds.exists(template["inbound_id"]):
+                    logger.warning(f"Service template {template['name']} uses unknown inbound {template['inbound_id']}")
+            except Exception as e:
+                logger.error(f"Could not validate inbound of {template['name']}: {e}")
+            await self.db.create_service(
                 name=template["name"],
                 price=template["price"],
                 duration=template["duration"],
                 data_limit=template["data_limit"],
                 inbound_id=template["inbound_id"]
             )
+        await self.catalog.reload()
 
     async def start(self, update: Update, context: CallbackContext):
         """Start command handler"""
@@ -108,25 +184,15 @@ class VPNBot:
             user_id = update.effective_user.id
 
             # Create or get user
-            user = self.db.get_user(user_id)
+            user = await self.db.get_user(user_id)
             if not user:
-                self.db.create_user(
+                await self.db.create_user(
                     telegram_id=user_id,
                     username=update.effective_user.username,
                     is_admin=(user_id == ADMIN_ID)
                 )
 
-            # Create keyboard
-            keyboard = [
-                [InlineKeyboardButton("🛒 خرید سرویس", callback_data='buy_service')],
-                [InlineKeyboardButton("👤 حساب کاربری", callback_data='user_account')],
-                [InlineKeyboardButton("📊 اطلاعات سرویس", callback_data='service_info')]
-            ]
-
-            if user_id == ADMIN_ID:
-                keyboard.append([InlineKeyboardButton("⚙️ پنل مدیریت", callback_data='admin_panel')])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = self._menu('main', update.effective_user)
 
             # Send welcome message
             await update.message.reply_text(
@@ -165,6 +231,7 @@ class VPNBot:
                 'report_monthly': self.show_report,
                 'report_custom': self.show_report,
                 'active_users': self.show_active_users,
+                'pending_transactions': self.show_pending_transactions,
                 'add_discount': self.add_discount_code,
                 'list_discount_codes': self.list_discount_codes,
                 'discount_type_percent' : self.handle_discount_type,
@@ -184,6 +251,26 @@ class VPNBot:
                 return
 
             # Then handle pattern-based callbacks
+            if query.data.startswith('page_'):
+                listings = {
+                    'users': self.show_active_users,
+                    'discounts': self.list_discount_codes,
+                    'services': self.edit_services,
+                    'pending': self.show_pending_transactions
+                }
+                handler = listings.get(query.data.split('_')[1])
+                if handler:
+                    await handler(update, context)
+                    return
+
+            if query.data.startswith('cancel_broadcast_'):
+                await self.cancel_broadcast(update, context)
+                return
+
+            if query.data.startswith(('approve_transaction_', 'reject_transaction_')):
+                await self.handle_transaction_action(update, context)
+                return
+
             if query.data.startswith('service_'):
                 await self.handle_service_purchase(update, context)
                 return
@@ -233,23 +320,10 @@ class VPNBot:
     async def show_services(self, update: Update, context: CallbackContext):
         """Show available services"""
         try:
-            services = self.db.get_active_services()
-
-            keyboard = []
-            for service in services:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"{service.name} - {service.price,} تومان",  # name - price
-                        callback_data=f"service_{service.id}"     # service id
-                    )
-                ])
-
-            keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='back_to_main')])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
+            # Prebuilt with the catalog snapshot, no database work
             await update.callback_query.edit_message_text(
                 "📦 لطفاً سرویس مورد نظر خود را انتخاب کنید:",
-                reply_markup=reply_markup
+                reply_markup=self.catalog.snapshot.buy_markup
             )
 
         except Exception as e:
@@ -258,28 +332,49 @@ class VPNBot:
                 "❌ خطا در نمایش سرویس‌ها. لطفاً مجدداً تلاش کنید."
             )
 
-    async def create_marzban_user(self, username: str, service: Dict[str, Any]):
-        """Create user in Marzban panel"""
-
-        #TODO: handle this later
-
-        # expire_date = datetime.utcnow() + timedelta(days=service['duration'])
-        # user_data = {
-        #     "username": username,
-        #     "expire": int(expire_date.timestamp()),
-        #     "data_limit": service['data_limit'] * 1024 * 1024 * 1024,  # Convert GB to bytes
-        #     "inbound_id": service['inbound_id']
-        # }
-        # return await self.marzban.create_user(user_data)
-
-        return {'success':True}
+    async def _purchase(self, query, service):
+        """Charge for the service and queue its Marzban account; the panel is not waited on"""
+        # Pressing the same confirm button twice must not buy twice
+        idempotency_key = f"purchase_{query.from_user.id}_{query.message.message_id}_{service.id}"
+        try:
+            user_service_id, charged = await self.db.purchase_service(
+                query.from_user.id,
+                service,
+                idempotency_key=idempotency_key
+            )
+        except Exception as e:
+            logger.error(f"Error in purchase of service {service.id}: {e}")
+            await query.edit_message_text(MESSAGES["purchase_failed"])
+            return
+        if user_service_id is None:
+            await query.edit_message_text(
+                MESSAGES["insufficient_balance"],
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("💰 شارژ کیف پول", callback_data='charge_wallet')
+                ]])
+            )
+            return
+        if not charged:
+            await query.edit_message_text(MESSAGES["purchase_already_processed"])
+            return
+        self.provisioner.notify()
+        self.expiry_scheduler.push(user_service_id, datetime.utcnow() + timedelta(days=service.duration))
+
+        await query.edit_message_text(
+            f"✅ خرید موفقیت‌آمیز بود!\n\n"
+            f"نام سرویس: {service.name}\n"
+            f"مدت: {service.duration} روز\n"
+            f"حجم: {service.data_limit} GB\n"
+            f"💰 مبلغ: {service.price:,} تومان\n\n"
+            f"⏳ حساب شما در حال ساخت است و به محض آماده شدن اطلاع داده می‌شود."
+        )
 
     async def show_user_account(self, update: Update, context: CallbackContext):
         """Show user account information"""
         try:
             user_id = update.effective_user.id
-            user = self.db.get_user(user_id)
-            active_services = self.db.get_user_active_services(user.id)
+            user = await self.db.get_user(user_id)
+            active_services = await self.db.get_user_active_services(user.id)
 
             text = f"""
 👤 اطلاعات حساب کاربری:
@@ -298,14 +393,9 @@ class VPNBot:
 📊 {remaining_gb:.1f} GB حجم باقیمانده
 """
 
-            keyboard = [
-                [InlineKeyboardButton("💰 شارژ کیف پول", callback_data='charge_wallet')],
-                [InlineKeyboardButton("🔄 تمدید سرویس", callback_data='extend_service')],
-                [InlineKeyboardButton("🔙 بازگشت", callback_data='back_to_main')]
-            ]
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
+            await update.callback_query.edit_message_text(
+                text, reply_markup=self._menu('account', update.effective_user)
+            )
 
         except Exception as e:
             logger.error(f"Error in show_user_account: {e}")
@@ -320,8 +410,8 @@ class VPNBot:
             service_id = int(query.data.split('_')[1])
 
             # Get user and service
-            user = self.db.get_user(update.effective_user.id)
-            service = self.db.get_service(service_id)
+            user = await self.db.get_user(update.effective_user.id)
+            service = self.catalog.get(service_id)
 
             if not service:
                 await query.edit_message_text("❌ سرویس مورد نظر یافت نشد.")
@@ -368,51 +458,16 @@ class VPNBot:
         try:
             query = update.callback_query
 
-            user = self.db.get_user(update.effective_user.id)
-            active_service = self.db.get_user_active_services(user.id)
-            service = self.db.get_service(active_service[0][2])
+            user = await self.db.get_user(update.effective_user.id)
+            active_service = await self.db.get_user_active_services(user.id)
+            service = self.catalog.get(active_service[0][2])
 
             if not service:
                 await query.edit_message_text("❌ سرویس مورد نظر یافت نشد.")
                 return
 
-            # Create user in Marzban
-            result = await self.create_marzban_user(user.username, {
-                'duration': service.duration,
-                'data_limit': service.data_limit,
-                'inbound_id': service.inbound_id
-            })
-
-            if result['success']:
-                # Deduct the price from user's wallet balance)
-                self.db.update_user_balance(update.effective_user.id, -service.price)
-
-                # Log the transaction
-                self.db.create_transaction(
-                    user_id=user.id,
-                    amount=service.price,
-                    type_='purchase',
-                    status='completed'
-                )
-
-
-                #create service for user
-                self.db.create_user_service(
-                    user_id=user.id,
-                    service_id=service.id,
-                    marzban_username=str(service.inbound_id),
-                    expire_date=datetime.utcnow() + timedelta(days=service.duration),
-                    data_limit=service.data_limit)
-
-                await query.edit_message_text(
-                    f"✅ خرید موفقیت‌آمیز بود!\n\n"
-                    f"نام سرویس: {service.name}\n"
-                    f"مدت: {service.duration} روز\n"
-                    f"حجم: {service.data_limit} GB\n"
-                    f"💰 مبلغ: {service.price:,} تومان"
-                )
-            else:
-                await query.edit_message_text("❌ خطا در ایجاد حساب کاربری در پنل Marzban.")
+            # Charge and queue the Marzban account in one commit
+            await self._purchase(query, service)
 
         except ValueError:
             logger.error("Invalid service ID.")
@@ -425,50 +480,14 @@ class VPNBot:
         """Handle purchase confirmation"""
         try:
             query = update.callback_query
-
-            user = self.db.get_user(update.effective_user.id)
-            service = self.db.get_service(query.data.split('_')[2])
+            service = self.catalog.get(query.data.split('_')[2])
 
             if not service:
                 await query.edit_message_text("❌ سرویس مورد نظر یافت نشد.")
                 return
 
-            # Create user in Marzban
-            result = await self.create_marzban_user(user.username, {
-                'duration': service.duration,
-                'data_limit': service.data_limit,
-                'inbound_id': service.inbound_id
-            })
-
-            if result['success']:
-                # Deduct the price from user's wallet balance)
-                self.db.update_user_balance(update.effective_user.id, -service.price)
-
-                # Log the transaction
-                self.db.create_transaction(
-                    user_id=user.id,
-                    amount=service.price,
-                    type_='purchase',
-                    status='completed'
-                )
-
-                #create service for user
-                self.db.create_user_service(
-                    user_id=user.id,
-                    service_id=service.id,
-                    marzban_username=str(service.inbound_id),
-                    expire_date=datetime.utcnow() + timedelta(days=service.duration),
-                    data_limit=service.data_limit)
-
-                await query.edit_message_text(
-                    f"✅ خرید موفقیت‌آمیز بود!\n\n"
-                    f"نام سرویس: {service.name}\n"
-                    f"مدت: {service.duration} روز\n"
-                    f"حجم: {service.data_limit} GB\n"
-                    f"💰 مبلغ: {service.price:,} تومان"
-                )
-            else:
-                await query.edit_message_text("❌ خطا در ایجاد حساب کاربری در پنل Marzban.")
+            # Charge and queue the Marzban account in one commit
+            await self._purchase(query, service)
 
         except ValueError:
             logger.error("Invalid service ID.")
@@ -482,23 +501,9 @@ class VPNBot:
         try:
             query = update.callback_query
 
-            amounts = [50000, 100000, 200000, 500000]
-            keyboard = []
-
-            for amount in amounts:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"💰 {amount:,} تومان",
-                        callback_data=f'charge_{amount}'
-                    )
-                ])
-
-            keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='back_to_main')])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
             await query.edit_message_text(
                 "💳 لطفا مبلغ شارژ کیف پول را انتخاب کنید:",
-                reply_markup=reply_markup
+                reply_markup=self._menu('wallet_charge', update.effective_user)
             )
 
         except Exception as e:
@@ -518,8 +523,8 @@ class VPNBot:
             card_holder = PAYMENT_METHODS["card"]["name"]
 
             # Create pending transaction
-            user = self.db.get_user(update.effective_user.id)
-            transaction_id = self.db.create_transaction(
+            user = await self.db.get_user(update.effective_user.id)
+            transaction_id = await self.db.create_transaction(
                 user_id=user.id,
                 amount=amount,
                 type_='deposit',
@@ -558,10 +563,10 @@ class VPNBot:
             transaction_id, amount = map(int, query.data.split('_')[2:])
 
             # Update transaction status
-            self.db.update_transaction_status(transaction_id, 'completed')
+            await self.db.update_transaction_status(transaction_id, 'completed')
 
             # Get user and update balance
-            self.db.update_user_balance(update.effective_user.id, amount)
+            await self.db.update_user_balance(update.effective_user.id, amount)
 
             await query.edit_message_text(
                 "✅ پرداخت شما با موفقیت انجام شد و کیف پول شما شارژ شد.",
@@ -582,19 +587,9 @@ class VPNBot:
             if update.effective_user.id != ADMIN_ID:
                 return
 
-            keyboard = [
-                [InlineKeyboardButton("📊 گزارش فروش", callback_data='admin_sales_report')],
-                [InlineKeyboardButton("👥 مدیریت کاربران", callback_data='admin_users')],
-                [InlineKeyboardButton("🎁 کد تخفیف", callback_data='admin_discount_codes')],
-                [InlineKeyboardButton("📨 ارسال پیام همگانی", callback_data='admin_broadcast')],
-                [InlineKeyboardButton("⚙️ تنظیمات سرویس‌ها", callback_data='admin_services')],
-                [InlineKeyboardButton("🔙 بازگشت", callback_data='back_to_main')]
-            ]
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
             await update.callback_query.edit_message_text(
                 "⚙️ پنل مدیریت\nلطفا یک گزینه را انتخاب کنید:",
-                reply_markup=reply_markup
+                reply_markup=self._menu('admin_panel', update.effective_user)
             )
 
         except Exception as e:
@@ -608,66 +603,45 @@ class VPNBot:
         if update.effective_user.id != ADMIN_ID:
             return
 
-        with Session(self.db.engine) as session:
-            # Daily sales
-            today = datetime.utcnow().date()
-            daily_sales = session.query(Transaction).filter(
-                Transaction.type == 'purchase',
-                Transaction.status == 'completed',
-                Transaction.created_at >= today
-            ).all()
-
-            # Weekly sales
-            week_ago = today - timedelta(days=7)
-            weekly_sales = session.query(Transaction).filter(
-                Transaction.type == 'purchase',
-                Transaction.status == 'completed',
-                Transaction.created_at >= week_ago
-            ).all()
-
-            # Monthly sales
-            month_ago = today - timedelta(days=30)
-            monthly_sales = session.query(Transaction).filter(
-                Transaction.type == 'purchase',
-                Transaction.status == 'completed',
-                Transaction.created_at >= month_ago
-            ).all()
-
-            report = f"""
+        daily, weekly, monthly = await self.db.get_sales_summary(datetime.utcnow().date())
+
+        report = f"""
 📊 گزارش فروش:
 
 امروز:
-تعداد: {len(daily_sales)}
-مبلغ: {sum(t.amount for t in daily_sales):,} تومان
+تعداد: {daily[0]}
+مبلغ: {daily[1]:,} تومان
 
 هفته اخیر:
-تعداد: {len(weekly_sales)}
-مبلغ: {sum(t.amount for t in weekly_sales):,} تومان
+تعداد: {weekly[0]}
+مبلغ: {weekly[1]:,} تومان
 
 ماه اخیر:
-تعداد: {len(monthly_sales)}
-مبلغ: {sum(t.amount for t in monthly_sales):,} تومان
+تعداد: {monthly[0]}
+مبلغ: {monthly[1]:,} تومان
 """
 
-            keyboard = [
-                [InlineKeyboardButton("📈 گزارش تفصیلی", callback_data='detailed_report')],
-                [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("📈 گزارش تفصیلی", callback_data='detailed_report')],
+            [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
+        ]
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.callback_query.edit_message_text(report, reply_markup=reply_markup)
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.callback_query.edit_message_text(report, reply_markup=reply_markup)
 
     async def manage_users(self, update: Update, context: CallbackContext):
         """Manage users"""
         if update.effective_user.id != ADMIN_ID:
             return
 
-        with Session(self.db.engine) as session:
+        async with self.db.Session() as session:
             # Get users statistics
-            total_users = session.query(User).count()
-            active_users = session.query(User).join(UserService).filter(
-                UserService.is_active == True
-            ).distinct().count()
+            total_users = await session.scalar(select(func.count(User.id)))
+            active_users = await session.scalar(
+                select(func.count(func.distinct(UserService.user_id))).filter(
+                    UserService.is_active == True
+                )
+            )
 
             text = f"""
 👥 مدیریت کاربران
@@ -686,27 +660,48 @@ class VPNBot:
             reply_markup = InlineKeyboardMarkup(keyboard)
             await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
 
+    @staticmethod
+    def _page_token(data: str) -> Optional[str]:
+        """Paging token of a 'page_<listing>_<token>' callback, None for the first page"""
+        return data.split('_', 2)[2] if data.startswith('page_') else None
+
+    @staticmethod
+    def _paging_rows(listing: str, page: Page) -> List[List[InlineKeyboardButton]]:
+        """Previous/next buttons for a page, as zero or one keyboard row"""
+        row = []
+        if page.prev_token:
+            row.append(InlineKeyboardButton("◀️ قبلی", callback_data=f'page_{listing}_{page.prev_token}'))
+        if page.next_token:
+            row.append(InlineKeyboardButton("بعدی ▶️", callback_data=f'page_{listing}_{page.next_token}'))
+        return [row] if row else []
+
     async def show_active_users(self, update: Update, context: CallbackContext):
         """Show active users"""
-        with Session(self.db.engine) as session:
-            active_users = session.query(User).join(UserService).filter(
+        paginator = KeysetPaginator(
+            select(User).where(select(UserService.id).where(
+                UserService.user_id == User.id,
                 UserService.is_active == True
-            ).distinct().all()
+            ).exists()),
+            User.id
+        )
+        async with self.db.Session() as session:
+            page = await paginator.page(session, self._page_token(update.callback_query.data))
 
-            if not active_users:
-                await update.callback_query.edit_message_text("❌ هیچ کاربر فعالی یافت نشد.")
-                return
+        if not page.items:
+            await update.callback_query.edit_message_text("❌ هیچ کاربر فعالی یافت نشد.")
+            return
 
-            text = "📋 کاربران فعال:\n"
-            for user in active_users:
-                text += f"👤 {user.username} - ID: {user.telegram_id}\n"
+        text = "📋 کاربران فعال:\n"
+        for user in page.items:
+            text += f"👤 {user.username} - ID: {user.telegram_id}\n"
 
-            keyboard = [
-                [InlineKeyboardButton("🔙 بازگشت به مدیریت کاربران", callback_data='admin_users')]
-             ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        keyboard = [
+            *self._paging_rows('users', page),
+            [InlineKeyboardButton("🔙 بازگشت به مدیریت کاربران", callback_data='admin_users')]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
-            await update.callback_query.edit_message_text(text)
+        await update.callback_query.edit_message_text(text, reply_markup=reply_markup)
 
     async def broadcast_message(self, update: Update, context: CallbackContext):
         """Send broadcast message to users"""
@@ -717,8 +712,13 @@ class VPNBot:
             # [InlineKeyboardButton("👥 همه کاربران", callback_data='broadcast_all')],
             # [InlineKeyboardButton("✅ کاربران فعال", callback_data='broadcast_active')],
             # [InlineKeyboardButton("❌ کاربران غیرفعال", callback_data='broadcast_inactive')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
         ]
+        for job in await self.db.get_running_broadcast_jobs():
+            keyboard.append([InlineKeyboardButton(
+                f"⛔ توقف ارسال #{job.id} ({job.sent} ارسال شده)",
+                callback_data=f'cancel_broadcast_{job.id}'
+            )])
+        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')])
 
         reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -756,39 +756,54 @@ class VPNBot:
         message = update.message.text
         target = context.user_data.get('broadcast_target', 'all')
 
+        # Runs as a background job; the engine keeps one progress message up to date
+        job = await self.db.create_broadcast_job(message, target, update.effective_user.id)
+        if job is None:
+            await update.message.reply_text("❌ خطا در ایجاد پیام همگانی. لطفا دوباره امتحان کنید.")
+            return
+        self._start_broadcast(context.bot, job)
 
-        with Session(self.db.engine) as session:
-            if target == 'all':
-                users = session.query(User).all()
-            elif target == 'active':
-                users = session.query(User).join(UserService).filter(
-                    UserService.is_active == True
-                ).distinct().all()
-            else:  # 'inactive'
-                users = session.query(User).outerjoin(UserService).filter(
-                    UserService.id == None
-                ).all()
+        # Clear the state after sending
+        context.user_data.pop('admin_state', None)
+        context.user_data.pop('broadcast_target', None)
 
-            success, failed = 0, 0
 
-            for user in users:
-                try:
-                    await context.bot.send_message(user.telegram_id, message)
-                    success += 1
-                except Exception as e:
-                    logger.error(f"Failed to send broadcast to {user.telegram_id}: {e}")
-                    failed += 1
+    def _start_broadcast(self, bot, job: BroadcastJob):
+        broadcaster = Broadcaster(bot, self.db, self.rate_limiter)
+        task = self._start_task(self._run_broadcast(broadcaster, job))
+        self.broadcasts[job.id] = task
+        task.add_done_callback(lambda _: self.broadcasts.pop(job.id, None))
 
-            await update.message.reply_text(
-                f"📨 پیام همگانی ارسال شد:\n"
-                f"✅ موفق: {success}\n"
-                f"❌ ناموفق: {failed}"
-            )
+    async def _run_broadcast(self, broadcaster: Broadcaster, job: BroadcastJob):
+        try:
+            sent, failed = await broadcaster.run(job)
+            await self.db.finish_broadcast_job(job.id, 'completed')
+            logger.info(f"Broadcast #{job.id} to {job.target} users finished: {sent} sent, {failed} failed")
+        except asyncio.CancelledError:
+            # Cancelled from the admin panel, or shutdown: the checkpoint is saved
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{job.id} to {job.target} users failed: {e}")
 
-        # Clear the state after sending
-        context.user_data.pop('admin_state', None)
-        context.user_data.pop('broadcast_target', None)
+    async def cancel_broadcast(self, update: Update, context: CallbackContext):
+        """Stop a running broadcast job"""
+        if update.effective_user.id != ADMIN_ID:
+            return
 
+        query = update.callback_query
+        job_id = int(query.data.split('_')[-1])
+
+        task = self.broadcasts.get(job_id)
+        if task:
+            # Stop the workers before the job's delivery rows are deleted;
+            # the engine edits its progress message on the way out
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await self.db.finish_broadcast_job(job_id, 'cancelled')
+        elif await self.db.finish_broadcast_job(job_id, 'cancelled'):
+            await query.edit_message_text(f"⛔ پیام همگانی #{job_id} متوقف شد.")
+        else:
+            await query.edit_message_text(f"❌ پیام همگانی #{job_id} در حال ارسال نیست.")
 
     async def manage_services(self, update: Update, context: CallbackContext):
         """Manage services settings"""
@@ -796,18 +811,9 @@ class VPNBot:
             return
 
         #TODO handle each key sepratedly
-        keyboard = [
-            [InlineKeyboardButton("➕ افزودن سرویس", callback_data='add_service')],
-            [InlineKeyboardButton("📝 ویرایش سرویس‌ها", callback_data='edit_services')],
-            [InlineKeyboardButton("🔄 تنظیمات تمدید", callback_data='renewal_settings')],
-            [InlineKeyboardButton("⚙️ تنظیمات اینباند", callback_data='inbound_settings')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
-        ]
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.callback_query.edit_message_text(
             "⚙️ مدیریت سرویس‌ها و تنظیمات\nلطفا یک گزینه را انتخاب کنید:",
-            reply_markup=reply_markup
+            reply_markup=self._menu('manage_services', update.effective_user)
         )
 
     async def add_service(self, update: Update, context: CallbackContext):
@@ -865,10 +871,27 @@ class VPNBot:
                 new_service['is_active'] = True
                 new_service['inbound_id'] = 1  # Default inbound ID
 
-                with Session(self.db.engine) as session:
-                    service = Service(**new_service)
-                    session.add(service)
-                    session.commit()
+                try:
+                    if not await self.inbounds.exists(new_service['inbound_id']):
+                        await update.message.reply_text(
+                            f"❌ اینباند {new_service['inbound_id']} در پنل وجود ندارد."
+                        )
+                        return
+                except Exception as e:
+                    # Panel unreachable: add the service anyway, like _create_default_services
+                    logger.error(f"Could not validate inbound of {new_service['name']}: {e}")
+                    await update.message.reply_text(
+                        f"⚠️ پنل در دسترس نیست، اینباند {new_service['inbound_id']} بررسی نشد."
+                    )
+
+                await self.db.create_service(
+                    name=new_service['name'],
+                    price=new_service['price'],
+                    duration=new_service['duration'],
+                    data_limit=new_service['data_limit'],
+                    inbound_id=new_service['inbound_id']
+                )
+                await self._services_changed()
 
                 await update.message.reply_text(
                     f"✅ سرویس جدید با موفقیت اضافه شد:\n\n"
@@ -889,26 +912,28 @@ class VPNBot:
         if update.effective_user.id != ADMIN_ID:
             return
 
-        with Session(self.db.engine) as session:
-            services = session.query(Service).all()
-            keyboard = []
-
-            for service in services:
-                status = "✅" if service.is_active else "❌"
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"{status} {service.name} - {service.price:,} تومان",
-                        callback_data=f'edit_service_details_{service.id}'
-                    )
-                ])
+        paginator = KeysetPaginator(select(Service), Service.id)
+        async with self.db.Session() as session:
+            page = await paginator.page(session, self._page_token(update.callback_query.data))
+
+        keyboard = []
+        for service in page.items:
+            status = "✅" if service.is_active else "❌"
+            keyboard.append([
+                InlineKeyboardButton(
+                    f"{status} {service.name} - {service.price:,} تومان",
+                    callback_data=f'edit_service_details_{service.id}'
+                )
+            ])
 
-            keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='manage_services')])
-            reply_markup = InlineKeyboardMarkup(keyboard)
+        keyboard.extend(self._paging_rows('services', page))
+        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='manage_services')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
-            await update.callback_query.edit_message_text(
-                "📝 لیست سرویس‌ها:\nبرای ویرایش روی سرویس مورد نظر کلیک کنید:",
-                reply_markup=reply_markup
-            )
+        await update.callback_query.edit_message_text(
+            "📝 لیست سرویس‌ها:\nبرای ویرایش روی سرویس مورد نظر کلیک کنید:",
+            reply_markup=reply_markup
+        )
 
     async def edit_service_details(self, update: Update, context: CallbackContext):
         """Show service editing options"""
@@ -924,8 +949,8 @@ class VPNBot:
 
         context.user_data['edit_service_id'] = service_id  # Store service_id for further use
 
-        with Session(self.db.engine) as session:
-            service = session.query(Service).filter_by(id=service_id).first()
+        async with self.db.Session() as session:
+            service = await session.get(Service, service_id)
             if not service:
                 await query.answer("❌ سرویس یافت نشد.", show_alert=True)
                 return
@@ -981,30 +1006,21 @@ class VPNBot:
             await update.message.reply_text("❌ خطا در دریافت اطلاعات سرویس.")
             return
 
-        with Session(self.db.engine) as session:
-            service = session.query(Service).filter_by(id=service_id).first()
-            if not service:
-                await update.message.reply_text("❌ سرویس یافت نشد.")
-                return
-
-            try:
-                if edit_field == 'price':
-                    service.price = int(new_value)
-                elif edit_field == 'duration':
-                    service.duration = int(new_value)
-                elif edit_field == 'data_limit':
-                    service.data_limit = float(new_value)
-                elif edit_field == 'name':
-                    service.name = new_value
-                else:
-                    await update.message.reply_text("❌ فیلد ویرایش نامعتبر است.")
-                    return
-
-                session.commit()
-                await update.message.reply_text(f"✅ {edit_field} سرویس با موفقیت تغییر یافت.")
+        parsers = {'price': int, 'duration': int, 'data_limit': float, 'name': str}
+        if edit_field not in parsers:
+            await update.message.reply_text("❌ فیلد ویرایش نامعتبر است.")
+            return
+        try:
+            value = parsers[edit_field](new_value)
+        except ValueError:
+            await update.message.reply_text("❌ مقدار وارد شده معتبر نیست. لطفا دوباره تلاش کنید.")
+            return
 
-            except ValueError:
-                await update.message.reply_text("❌ مقدار وارد شده معتبر نیست. لطفا دوباره تلاش کنید.")
+        if not await self.db.update_service(service_id, **{edit_field: value}):
+            await update.message.reply_text("❌ سرویس یافت نشد.")
+            return
+        await self._services_changed()
+        await update.message.reply_text(f"✅ {edit_field} سرویس با موفقیت تغییر یافت.")
 
 
     async def edit_service_name(self, update: Update, context: CallbackContext):
@@ -1024,15 +1040,10 @@ class VPNBot:
             await update.message.reply_text("❌ خطا در دریافت اطلاعات سرویس.")
             return
 
-        with Session(self.db.engine) as session:
-            service = session.query(Service).filter_by(id=service_id).first()
-            if not service:
-                await update.message.reply_text("❌ سرویس مورد نظر یافت نشد.")
-                return
-
-            # Update the service name
-            service.name = new_name
-            session.commit()
+        if not await self.db.update_service(service_id, name=new_name):
+            await update.message.reply_text("❌ سرویس مورد نظر یافت نشد.")
+            return
+        await self._services_changed()
 
         await update.message.reply_text(f"✅ نام سرویس به '{new_name}' تغییر یافت.")
         context.user_data.pop('edit_service_id', None)
@@ -1076,35 +1087,26 @@ class VPNBot:
         query = update.callback_query
         service_id = int(query.data.split('_')[-1])
 
-        with Session(self.db.engine) as session:
-            service = session.query(Service).filter_by(id=service_id).first()
-            if not service:
-                await query.edit_message_text("❌ سرویس مورد نظر یافت نشد.")
-                return
-
-            # Toggle the service status
-            service.is_active = not service.is_active
-            session.commit()
+        is_active = await self.db.toggle_service(service_id)
+        if is_active is None:
+            await query.edit_message_text("❌ سرویس مورد نظر یافت نشد.")
+            return
+        await self._services_changed()
 
-            status = "فعال ✅" if service.is_active else "غیرفعال ❌"
-            await query.edit_message_text(f"وضعیت سرویس به {status} تغییر یافت.")
+        status = "فعال ✅" if is_active else "غیرفعال ❌"
+        await query.edit_message_text(f"وضعیت سرویس به {status} تغییر یافت.")
 
     async def delete_service(self, update: Update, context: CallbackContext):
         """Handle deleting a service"""
         query = update.callback_query
         service_id = int(query.data.split('_')[-1])
 
-        with Session(self.db.engine) as session:
-            service = session.query(Service).filter_by(id=service_id).first()
-            if not service:
-                await query.edit_message_text("❌ سرویس مورد نظر یافت نشد.")
-                return
-
-            # Delete the service
-            session.delete(service)
-            session.commit()
+        if not await self.db.delete_service(service_id):
+            await query.edit_message_text("❌ سرویس مورد نظر یافت نشد.")
+            return
+        await self._services_changed()
 
-            await query.edit_message_text("✅ سرویس با موفقیت حذف شد.")
+        await query.edit_message_text("✅ سرویس با موفقیت حذف شد.")
 
 
 
@@ -1114,24 +1116,14 @@ class VPNBot:
             return
 
         try:
-            # Retrieve active services from the database
-            services = self.db.get_active_services()
-            if not services:
+            snapshot = self.catalog.snapshot
+            if not snapshot.active:
                 await update.callback_query.edit_message_text("❌ هیچ سرویسی برای تمدید یافت نشد.")
                 return
 
-            # Create a keyboard to list services
-            keyboard = [
-                [InlineKeyboardButton(f"{service.name} - {service.price:,} تومان", callback_data=f'renew_{service.id}')]
-                for service in services
-            ]
-            keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
             await update.callback_query.edit_message_text(
                 "⚙️ لطفا سرویس مورد نظر برای تمدید را انتخاب کنید:",
-                reply_markup=reply_markup
+                reply_markup=snapshot.renewal_markup
             )
 
         except Exception as e:
@@ -1160,19 +1152,24 @@ class VPNBot:
         if update.effective_user.id != ADMIN_ID:
             return
 
-        with Session(self.db.engine) as session:
-            discount_codes = session.query(DiscountCode).all()
+        paginator = KeysetPaginator(select(DiscountCode), DiscountCode.id)
+        async with self.db.Session() as session:
+            page = await paginator.page(session, self._page_token(update.callback_query.data))
 
-            if not discount_codes:
-                await update.callback_query.edit_message_text("❌ هیچ کد تخفیفی یافت نشد.")
-                return
+        if not page.items:
+            await update.callback_query.edit_message_text("❌ هیچ کد تخفیفی یافت نشد.")
+            return
 
-            text = "📋 لیست کدهای تخفیف:\n"
-            for code in discount_codes:
-                status = "✅ فعال" if code.is_active else "❌ غیرفعال"
-                text += f"💳 کد: {code.code} - نوع: {code.type} - مقدار: {code.amount} - وضعیت: {status}\n"
+        text = "📋 لیست کدهای تخفیف:\n"
+        for code in page.items:
+            status = "✅ فعال" if code.is_active else "❌ غیرفعال"
+            text += f"💳 کد: {code.code} - نوع: {code.type} - مقدار: {code.amount} - وضعیت: {status}\n"
 
-            await update.callback_query.edit_message_text(text)
+        paging = self._paging_rows('discounts', page)
+        await update.callback_query.edit_message_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(paging) if paging else None
+        )
 
 
     async def add_discount_code(self, update: Update, context: CallbackContext):
@@ -1232,15 +1229,9 @@ class VPNBot:
                         await update.message.reply_text("لطفا یک مقدار مثبت وارد کنید.")
                         return
 
-                with Session(self.db.engine) as session:
-                    discount = DiscountCode(
-                        code=new_discount['code'],
-                        type=new_discount['type'],
-                        amount=amount,
-                        is_active=True
-                    )
-                    session.add(discount)
-                    session.commit()
+                if await self.db.create_discount_code(new_discount['code'], new_discount['type'], amount) is None:
+                    await update.message.reply_text("❌ خطا در ذخیره کد تخفیف. لطفا دوباره تلاش کنید.")
+                    return
 
                 amount_text = f"{amount}%" if new_discount['type'] == 'percent' else f"{amount:,} تومان"
                 await update.message.reply_text(
@@ -1297,39 +1288,53 @@ class VPNBot:
         if update.effective_user.id != ADMIN_ID:
             return
 
-        with Session(self.db.engine) as session:
-            transactions = session.query(Transaction).filter_by(
-                status='pending'
-            ).order_by(Transaction.created_at.desc()).all()
+        # Newest first; (created_at, id) is served by ix_transactions_status_created
+        paginator = KeysetPaginator(
+            select(Transaction).options(selectinload(Transaction.user)).filter_by(status='pending'),
+            Transaction.created_at,
+            Transaction.id,
+            descending=True
+        )
+        async with self.db.Session() as session:
+            page = await paginator.page(session, self._page_token(update.callback_query.data))
 
-            if not transactions:
-                await update.callback_query.edit_message_text(
-                    "هیچ تراکنش در انتظاری وجود ندارد.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 بازگشت", callback_data='manage_transactions')
-                    ]])
-                )
-                return
+        if not page.items:
+            await update.callback_query.edit_message_text(
+                "هیچ تراکنش در انتظاری وجود ندارد.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("🔙 بازگشت", callback_data='manage_transactions')
+                ]])
+            )
+            return
 
-            for transaction in transactions:
-                user = session.query(User).filter_by(id=transaction.user_id).first()
-                keyboard = [
-                    [
-                        InlineKeyboardButton("✅ تایید", callback_data=f'approve_transaction_{transaction.id}'),
-                        InlineKeyboardButton("❌ رد", callback_data=f'reject_transaction_{transaction.id}')
-                    ]
+        for transaction in page.items:
+            user = transaction.user
+            keyboard = [
+                [
+                    InlineKeyboardButton("✅ تایید", callback_data=f'approve_transaction_{transaction.id}'),
+                    InlineKeyboardButton("❌ رد", callback_data=f'reject_transaction_{transaction.id}')
                 ]
+            ]
 
-                await context.bot.send_message(
-                    update.effective_user.id,
-                    f"""
+            await context.bot.send_message(
+                update.effective_user.id,
+                f"""
 💳 تراکنش جدید:
 👤 کاربر: {user.username or user.telegram_id}
 💰 مبلغ: {transaction.amount:,} تومان
 ⏰ زمان: {transaction.created_at.strftime('%Y-%m-%d %H:%M:%S')}
-                    """,
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
+                """,
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        await context.bot.send_message(
+            update.effective_user.id,
+            "💰 تراکنش‌های در انتظار",
+            reply_markup=InlineKeyboardMarkup([
+                *self._paging_rows('pending', page),
+                [InlineKeyboardButton("🔙 بازگشت", callback_data='manage_transactions')]
+            ])
+        )
 
     async def handle_transaction_action(self, update: Update, context: CallbackContext):
         """Handle transaction approval/rejection"""
@@ -1337,92 +1342,45 @@ class VPNBot:
             return
 
         query = update.callback_query
-        action, transaction_id = query.data.split('_')[1:]
+        # approve_transaction_<id> / reject_transaction_<id>
+        action, _, transaction_id = query.data.split('_')
         transaction_id = int(transaction_id)
 
-        with Session(self.db.engine) as session:
-            transaction = session.query(Transaction).filter_by(id=transaction_id).first()
-            if not transaction or transaction.status != 'pending':
-                await query.edit_message_text("❌ تراکنش مورد نظر یافت نشد یا قبلا بررسی شده است.")
-                return
-
-            user = session.query(User).filter_by(id=transaction.user_id).first()
-
-            if action == 'approve':
-                transaction.status = 'completed'
-                user.wallet_balance += transaction.amount
-                message = f"✅ تراکنش شما به مبلغ {transaction.amount:,} تومان تایید و کیف پول شما شارژ شد."
-            else:
-                transaction.status = 'rejected'
-                message = f"❌ تراکنش شما به مبلغ {transaction.amount:,} تومان رد شد."
+        # Status change and credit are one atomic write on the writer task
+        settled = await self.db.settle_deposit(transaction_id, action == 'approve')
+        if settled is None:
+            await query.edit_message_text("❌ تراکنش مورد نظر یافت نشد یا قبلا بررسی شده است.")
+            return
 
-            session.commit()
+        telegram_id, amount = settled
+        if action == 'approve':
+            message = f"✅ تراکنش شما به مبلغ {amount:,} تومان تایید و کیف پول شما شارژ شد."
+        else:
+            message = f"❌ تراکنش شما به مبلغ {amount:,} تومان رد شد."
 
-            # Notify user
-            try:
-                await context.bot.send_message(user.telegram_id, message)
-            except Exception as e:
-                logger.error(f"Failed to notify user {user.telegram_id}: {e}")
+        # Notify user
+        try:
+            await context.bot.send_message(telegram_id, message)
+        except Exception as e:
+            logger.error(f"Failed to notify user {telegram_id}: {e}")
 
-            await query.edit_message_text("✅ عملیات با موفقیت انجام شد.")
+        await query.edit_message_text("✅ عملیات با موفقیت انجام شد.")
 
     async def setup_notifications(self):
-        """Setup automatic notifications"""
+        """Setup automatic notifications (expiry warnings run on expiry_scheduler)"""
         while True:
             try:
-                await self.check_expiring_services()
                 await self.check_low_data_services()
                 await asyncio.sleep(3600)  # Check every hour
             except Exception as e:
                 logger.error(f"Error in notifications: {e}")
                 await asyncio.sleep(300)  # Wait 5 minutes on error
 
-    async def check_expiring_services(self):
-        """Check and notify users about expiring services"""
-        with Session(self.db.engine) as session:
-            # Get services expiring in SUBSCRIPTION_REMINDER_DAYS
-            expiring_date = datetime.utcnow() + timedelta(days=SUBSCRIPTION_REMINDER_DAYS)
-            services = session.query(UserService).filter(
-                UserService.is_active == True,
-                UserService.expire_date <= expiring_date,
-                UserService.expire_date > datetime.utcnow()
-            ).all()
-
-            for service in services:
-                days_left = (service.expire_date - datetime.utcnow()).days
-                try:
-                    await self.bot.send_message(
-                        service.user.telegram_id,
-                        f"""
-⚠️ اخطار انقضای سرویس:
-سرویس {service.service.name} شما تا {days_left} روز دیگر منقضی می‌شود.
-برای تمدید سرویس از منوی اصلی اقدام کنید.
-                        """
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send expiry notification: {e}")
-
     async def check_low_data_services(self):
         """Check and notify users about low data services"""
-        with Session(self.db.engine) as session:
-            active_services = session.query(UserService).filter(
-                UserService.is_active == True
-            ).all()
-
-            for service in active_services:
-                remaining_gb = (service.data_limit - service.data_used) / 1024
-                if remaining_gb <= SUBSCRIPTION_REMINDER_DATA:
-                    try:
-                        await self.bot.send_message(
-                            service.user.telegram_id,
-                            f"""
-⚠️ اخطار اتمام حجم:
-حجم باقیمانده سرویس {service.service.name} شما {remaining_gb:.1f} GB است.
-برای خرید حجم اضافه از منوی اصلی اقدام کنید.
-                        """
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to send data limit notification: {e}")
+        sent = await send_low_data_warnings(self.db, self.bot, self.rate_limiter)
+        if sent:
+            logger.info(f"Sent {sent} low data notifications")
 
     async def manage_inbounds(self, update: Update, context: CallbackContext):
         """Manage inbound settings"""
@@ -1430,7 +1388,7 @@ class VPNBot:
             return
 
         try:
-            inbounds = await self.marzban.get_inbounds()
+            inbounds = await self.inbounds.all()
             keyboard = []
 
             for inbound in inbounds:
@@ -1450,6 +1408,8 @@ class VPNBot:
                 reply_markup=reply_markup
             )
 
+        except PanelUnavailable:
+            await update.callback_query.edit_message_text(MESSAGES["panel_unavailable"])
         except Exception as e:
             logger.error(f"Error getting inbounds: {e}")
             await update.callback_query.edit_message_text(
@@ -1465,7 +1425,10 @@ class VPNBot:
         inbound_id = int(query.data.split('_')[1])
 
         try:
-            inbound = await self.marzban.get_inbound(inbound_id)
+            inbound = await self.inbounds.get(inbound_id)
+            if inbound is None:
+                await query.edit_message_text("❌ اینباند مورد نظر یافت نشد")
+                return
             status = "فعال ✅" if inbound["enable"] else "غیرفعال ❌"
 
             text = f"""
@@ -1485,6 +1448,8 @@ class VPNBot:
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text(text, reply_markup=reply_markup)
 
+        except PanelUnavailable:
+            await query.edit_message_text(MESSAGES["panel_unavailable"])
         except Exception as e:
             logger.error(f"Error getting inbound details: {e}")
             await query.edit_message_text("❌ خطا در دریافت اطلاعات اینباند")
@@ -1498,16 +1463,21 @@ class VPNBot:
         inbound_id = int(query.data.split('_')[2])
 
         try:
-            inbound = await self.marzban.get_inbound(inbound_id)
+            inbound = await self.inbounds.get(inbound_id)
+            if inbound is None:
+                await query.edit_message_text("❌ اینباند مورد نظر یافت نشد")
+                return
             new_status = not inbound["enable"]
 
-            await self.marzban.update_inbound(inbound_id, {"enable": new_status})
+            await self.inbounds.update(inbound_id, {"enable": new_status})
 
             status_text = "فعال ✅" if new_status else "غیرفعال ❌"
             await query.edit_message_text(
                 f"✅ وضعیت اینباند {inbound['tag']} به {status_text} تغییر کرد."
             )
 
+        except PanelUnavailable:
+            await query.edit_message_text(MESSAGES["panel_unavailable"])
         except Exception as e:
             logger.error(f"Error toggling inbound: {e}")
             await query.edit_message_text("❌ خطا در تغییر وضعیت اینباند")
@@ -1517,83 +1487,65 @@ class VPNBot:
         if update.effective_user.id != ADMIN_ID:
             return
 
-        keyboard = [
-            [InlineKeyboardButton("📊 گزارش روزانه", callback_data='report_daily')],
-            [InlineKeyboardButton("📈 گزارش هفتگی", callback_data='report_weekly')],
-            [InlineKeyboardButton("📉 گزارش ماهانه", callback_data='report_monthly')],
-            [InlineKeyboardButton("🗓 گزارش سفارشی", callback_data='report_custom')],
-            [InlineKeyboardButton("💾 ذخیره گزارش", callback_data='save_report')],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]
-        ]
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
         await update.callback_query.edit_message_text(
             "📊 گزارش‌گیری تفصیلی\nلطفا نوع گزارش را انتخاب کنید:",
-            reply_markup=reply_markup
+            reply_markup=self._menu('detailed_report', update.effective_user)
         )
 
-    async def generate_report(self, start_date: datetime, end_date: datetime):
-        """Generate detailed report for given period"""
-        with Session(self.db.engine) as session:
-            # Sales data
-            sales = session.query(Transaction).filter(
-                Transaction.type == 'purchase',
-                Transaction.status == 'completed',
-                Transaction.created_at.between(start_date, end_date)
-            ).all()
+    @cached('reports', ttl=CACHE_SETTINGS['report_expire_time'], key='{start_date}_{end_date}', disk=True)
+    async def generate_report(self, start_date: date, end_date: date):
+        """Generate detailed report for given period, both days inclusive"""
+        sales_count, sales_total = await self.db.get_sales_totals(start_date, end_date)
+
+        period_start = datetime.combine(start_date, datetime.min.time())
+        period_end = datetime.combine(end_date + timedelta(days=1), datetime.min.time())
 
+        async with self.db.Session() as session:
             # User statistics
-            new_users = session.query(User).filter(
-                User.created_at.between(start_date, end_date)
-            ).count()
+            new_users = await session.scalar(select(func.count(User.id)).filter(
+                User.created_at >= period_start,
+                User.created_at < period_end
+            ))
 
-            active_services = session.query(UserService).filter(
+            active_services = await session.scalar(select(func.count(UserService.id)).filter(
                 UserService.is_active == True,
-                UserService.created_at <= end_date,
-                UserService.expire_date > end_date
-            ).count()
-
-            # Most popular services
-            service_stats = {}
-            for sale in sales:
-                service = session.query(UserService).filter_by(
-                    user_id=sale.user_id,
-                    created_at=sale.created_at
-                ).first()
-                if service:
-                    service_name = service.service.name
-                    service_stats[service_name] = service_stats.get(service_name, 0) + 1
-
-            report = {
-                'period': {
-                    'start': start_date.strftime('%Y-%m-%d'),
-                    'end': end_date.strftime('%Y-%m-%d')
-                },
-                'sales': {
-                    'total': sum(s.amount for s in sales),
-                    'count': len(sales)
-                },
-                'users': {
-                    'new': new_users,
-                    'active_services': active_services
-                },
-                'popular_services': service_stats
-            }
+                UserService.created_at < period_end,
+                UserService.expire_date >= period_end
+            ))
+
+        # Most popular services
+        popular_services = await self.db.get_popular_services(period_start, period_end, limit=5)
+
+        report = {
+            'period': {
+                'start': start_date.strftime('%Y-%m-%d'),
+                'end': end_date.strftime('%Y-%m-%d')
+            },
+            'sales': {
+                'total': sales_total,
+                'count': sales_count
+            },
+            'users': {
+                'new': new_users,
+                'active_services': active_services
+            },
+            'popular_services': popular_services
+        }
 
-            return report
+        return report
 
     async def show_report(self, update: Update, context: CallbackContext):
         """Show generated report"""
         query = update.callback_query
         report_type = query.data.split('_')[1]
 
-        end_date = datetime.utcnow()
+        end_date = datetime.utcnow().date()
         if report_type == 'daily':
-            start_date = end_date - timedelta(days=1)
+            start_date = end_date
         elif report_type == 'weekly':
-            start_date = end_date - timedelta(days=7)
+            start_date = end_date - timedelta(days=6)
         elif report_type == 'monthly':
-            start_date = end_date - timedelta(days=30)
+            start_date = end_date - timedelta(days=29)
         else:
             # Handle custom date range
             context.user_data['report_state'] = 'waiting_start_date'
@@ -1618,11 +1570,7 @@ class VPNBot:
 
 🔝 محبوب‌ترین سرویس‌ها:
 """
-        for service, count in sorted(
-            report['popular_services'].items(),
-            key=lambda x: x[1],
-            reverse=True
-        )[:5]:
+        for service, count in report['popular_services']:
             text += f"• {service}: {count} فروش\n"
 
         keyboard = [
@@ -1659,11 +1607,11 @@ class VPNBot:
             timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
             filename = f"backup_{backup_type}_{timestamp}.json"
 
-            with Session(self.db.engine) as session:
+            async with self.db.Session() as session:
                 data = {}
 
                 if backup_type in ['full', 'users']:
-                    users = session.query(User).all()
+                    users = (await session.scalars(select(User))).all()
                     data['users'] = [
                         {
                             'telegram_id': user.telegram_id,
@@ -1676,7 +1624,7 @@ class VPNBot:
                     ]
 
                 if backup_type in ['full', 'services']:
-                    services = session.query(Service).all()
+                    services = (await session.scalars(select(Service))).all()
                     data['services'] = [
                         {
                             'name': service.name,
@@ -1690,45 +1638,34 @@ class VPNBot:
                     ]
 
                 if backup_type in ['full', 'transactions']:
-                    transactions = session.query(Transaction).all()
+                    transactions = (await session.scalars(select(Transaction))).all()
                     data['transactions'] = [
                         {
                             'user_id': tx.user_id,
                             'amount': tx.amount,
                             'type': tx.type,
                             'status': tx.status,
+                            'service_id': tx.service_id,
                             'created_at': tx.created_at.isoformat()
                         }
                         for tx in transactions
                     ]
 
-                # Save backup file
-                with open(f'backups/{filename}', 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
+            # Save backup file
+            with open(f'backups/{filename}', 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
 
-                # Create backup record
-                backup = Backup(
-                    filename=filename,
-                    size=os.path.getsize(f'backups/{filename}'),
-                    type=backup_type,
-                    status='completed'
-                )
-                session.add(backup)
-                session.commit()
-
-                return backup
+            # Create backup record
+            backup = await self.db.add_backup(
+                filename, backup_type, 'completed', size=os.path.getsize(f'backups/{filename}')
+            )
+            if backup is None:
+                raise RuntimeError("backup record could not be saved")
+            return backup
 
         except Exception as e:
             logger.error(f"Backup creation failed: {e}")
-            with Session(self.db.engine) as session:
-                backup = Backup(
-                    filename=filename,
-                    type=backup_type,
-                    status='failed',
-                    note=str(e)
-                )
-                session.add(backup)
-                session.commit()
+            await self.db.add_backup(filename, backup_type, 'failed', note=str(e))
             raise
 
     async def handle_backup(self, update: Update, context: CallbackContext):
@@ -1765,8 +1702,10 @@ class VPNBot:
         if update.effective_user.id != ADMIN_ID:
             return
 
-        with Session(self.db.engine) as session:
-            backups = session.query(Backup).order_by(Backup.created_at.desc()).limit(10).all()
+        async with self.db.Session() as session:
+            backups = (await session.scalars(
+                select(Backup).order_by(Backup.created_at.desc()).limit(10)
+            )).all()
 
             if not backups:
                 await update.callback_query.edit_message_text(
@@ -1808,8 +1747,8 @@ class VPNBot:
         query = update.callback_query
         backup_id = int(query.data.split('_')[2])
 
-        with Session(self.db.engine) as session:
-            backup = session.query(Backup).filter_by(id=backup_id).first()
+        async with self.db.Session() as session:
+            backup = await session.get(Backup, backup_id)
 
             if not backup or backup.status != 'completed':
                 await query.edit_message_text("❌ فایل پشتیبان یافت نشد.")
@@ -1856,21 +1795,9 @@ class VPNBot:
     async def back_to_main(self, update: Update, context: CallbackContext):
         """Return to main menu"""
         try:
-            user_id = update.effective_user.id
-
-            keyboard = [
-                [InlineKeyboardButton("🛒 خرید سرویس", callback_data='buy_service')],
-                [InlineKeyboardButton("👤 حساب کاربری", callback_data='user_account')],
-                [InlineKeyboardButton("📊 اطلاعات سرویس", callback_data='service_info')]
-            ]
-
-            if user_id == ADMIN_ID:
-                keyboard.append([InlineKeyboardButton("⚙️ پنل مدیریت", callback_data='admin_panel')])
-
-            reply_markup = InlineKeyboardMarkup(keyboard)
             await update.callback_query.edit_message_text(
                 MESSAGES["welcome"],
-                reply_markup=reply_markup
+                reply_markup=self._menu('main', update.effective_user)
             )
 
         except Exception as e:
@@ -1885,7 +1812,7 @@ class VPNBot:
             user_id = update.effective_user.id
             logger.info(f"Showing service info for user {user_id}")
 
-            user = self.db.get_user(user_id)
+            user = await self.db.get_user(user_id)
             if not user:
                 logger.error(f"User {user_id} not found")
                 await update.callback_query.edit_message_text(
@@ -1894,7 +1821,7 @@ class VPNBot:
                 return
 
             logger.info(f"Found user: {user}")
-            active_services = self.db.get_user_active_services(user.id)
+            active_services = await self.db.get_user_active_services(user.id)
             logger.info(f"Active services: {active_services}")
 
             if not active_services:
@@ -1950,63 +1877,82 @@ class CleanupManager:
                 await asyncio.sleep(3600)
 
     async def cleanup_expired_users(self):
-        """Clean up expired users"""
-        cleanup_date = datetime.utcnow() - timedelta(days=CLEANUP_SETTINGS["expired_users_days"])
-
-        with Session(self.bot.db.engine) as session:
-            expired_services = session.query(UserService).filter(
-                UserService.is_active == False,
-                UserService.expire_date < cleanup_date
-            ).all()
+        """Clean up expired users, a chunk at a time. Returns (deleted, failed).
 
-            for service in expired_services:
+        A chunk's Marzban accounts are deleted concurrently, then the rows
+        whose account is gone are removed with one DELETE ... IN and one
+        commit, so the write lock is never held for the whole run. Rows whose
+        panel delete failed are kept and picked up by the next run.
+        """
+        cleanup_date = datetime.utcnow() - timedelta(days=CLEANUP_SETTINGS["expired_users_days"])
+        semaphore = asyncio.Semaphore(CLEANUP_SETTINGS["marzban_delete_concurrency"])
+        total = await self.bot.db.count_expired_user_services(cleanup_date)
+        deleted = failed = 0
+        after_id = 0
+        panel_down = False
+
+        async def delete_account(user_service_id, username):
+            nonlocal panel_down
+            async with semaphore:
                 try:
-                    # Delete from Marzban
-                    await self.bot.marzban.delete_user(service.marzban_username)
+                    await self.bot.marzban.delete_user(username)
+                    return user_service_id
+                except ClientResponseError as e:
+                    if e.status == 404:
+                        # Already gone from the panel
+                        return user_service_id
+                    logger.error(f"Error deleting Marzban user {username}: {e}")
+                except PanelUnavailable:
+                    panel_down = True
                 except Exception as e:
-                    logger.error(f"Error deleting Marzban user: {e}")
+                    logger.error(f"Error deleting Marzban user {username}: {e}")
+                return None
+
+        while not panel_down:
+            chunk = await self.bot.db.get_expired_user_services(
+                cleanup_date, after_id, CLEANUP_SETTINGS["expired_users_chunk_size"]
+            )
+            if not chunk:
+                break
+            after_id = chunk[-1].id
 
-                # Delete from database
-                session.delete(service)
+            results = await asyncio.gather(*(delete_account(row.id, row.marzban_username) for row in chunk))
+            ids = [user_service_id for user_service_id in results if user_service_id is not None]
+            failed += len(chunk) - len(ids)
+            if ids:
+                deleted += await self.bot.db.delete_user_services(ids)
+            logger.info(f"Expired user cleanup: {deleted + failed}/{total} processed, {deleted} deleted, {failed} failed")
 
-            session.commit()
+        if panel_down:
+            logger.warning("Expired user cleanup stopped, Marzban is unavailable; the rest is left for the next run")
+        return deleted, failed
 
     async def cleanup_old_logs(self):
         """Clean up old logs"""
         cleanup_date = datetime.utcnow() - timedelta(days=CLEANUP_SETTINGS["old_logs_days"])
 
-        with Session(self.bot.db.engine) as session:
-            # Clean system logs
-            session.query(SystemLog).filter(
-                SystemLog.created_at < cleanup_date
-            ).delete()
-
-            # Clean error logs
-            session.query(ErrorLog).filter(
-                ErrorLog.created_at < cleanup_date
-            ).delete()
-
-            session.commit()
+        await self.bot.db.delete_logs_before(cleanup_date)
 
     async def cleanup_old_backups(self):
         """Clean up old backups"""
         cleanup_date = datetime.utcnow() - timedelta(days=CLEANUP_SETTINGS["old_backups_days"])
 
-        with Session(self.bot.db.engine) as session:
-            old_backups = session.query(Backup).filter(
+        async with self.bot.db.Session() as session:
+            old_backups = (await session.scalars(select(Backup).filter(
                 Backup.created_at < cleanup_date
-            ).order_by(Backup.created_at.desc())[CLEANUP_SETTINGS["backup_retention_count"]:]
+            ).order_by(Backup.created_at.desc()).offset(CLEANUP_SETTINGS["backup_retention_count"]))).all()
 
-            for backup in old_backups:
-                try:
-                    # Delete backup file
-                    os.remove(f'backups/{backup.filename}')
-                    # Delete from database
-                    session.delete(backup)
-                except Exception as e:
-                    logger.error(f"Error deleting backup: {e}")
+        removed = []
+        for backup in old_backups:
+            try:
+                # Delete backup file
+                os.remove(f'backups/{backup.filename}')
+                removed.append(backup.id)
+            except Exception as e:
+                logger.error(f"Error deleting backup: {e}")
 
-            session.commit()
+        if removed:
+            await self.bot.db.delete_backups(removed)
 
 class SystemMonitor:
     def __init__(self, bot: VPNBot):
@@ -2026,11 +1972,11 @@ class SystemMonitor:
         """Check various system metrics"""
         try:
             # Check database connection
-            with Session(self.bot.db.engine) as session:
-                session.query(User).first()
+            async with self.bot.db.Session() as session:
+                await session.execute(select(User.id).limit(1))
 
-            # Check Marzban connection
-            await self.bot.marzban.get_token()
+            # Check Marzban connection (reuses the cached token and connection)
+            await self.bot.marzban.get_system()
 
             # Check disk space
             disk_usage = psutil.disk_usage('/')
@@ -2086,7 +2032,13 @@ def main():
     try:
         vpn_bot = VPNBot()
 
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .post_init(vpn_bot.initialize)
+            .post_shutdown(vpn_bot.shutdown)
+            .build()
+        )
 
         application.add_handler(CommandHandler("start", vpn_bot.start))
         application.add_handler(CallbackQueryHandler(vpn_bot.handle_callback))
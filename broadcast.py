@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Tuple
+
+from sqlalchemy import select
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from advanced_config import BROADCAST_SETTINGS
+from database import BroadcastDelivery, BroadcastJob, User, UserService
+from optimizations import SendRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def broadcast_recipients(job: BroadcastJob, after_id: int = None):
+    """(user id, telegram id) of the users job still has to send to, in user id order.
+
+    Users up to the job's checkpoint (or after_id, for the next page) and
+    those already recorded as delivered are skipped, so a resumed job never
+    messages anyone twice.
+    """
+    has_active_service = select(UserService.id).where(
+        UserService.user_id == User.id,
+        UserService.is_active == True
+    ).exists()
+    has_service = select(UserService.id).where(UserService.user_id == User.id).exists()
+    delivered = select(BroadcastDelivery.user_id).where(
+        BroadcastDelivery.job_id == job.id,
+        BroadcastDelivery.user_id == User.id
+    ).exists()
+
+    after_id = job.last_user_id if after_id is None else after_id
+    stmt = select(User.id, User.telegram_id).where(User.id > after_id, ~delivered).order_by(User.id)
+    if job.target == 'active':
+        return stmt.where(has_active_service)
+    if job.target == 'inactive':
+        return stmt.where(~has_service)
+    return stmt
+
+
+class Broadcaster:
+    """Runs a BroadcastJob without tripping Telegram's flood limits.
+
+    Recipient ids are read in keyset pages of stream_batch_size, each in its
+    own short session so no read transaction holds back WAL checkpoints,
+    into a bounded queue drained by `concurrency` workers. Every send
+    goes through the shared SendRateLimiter; a RetryAfter pauses all workers
+    for the requested time and the message is retried. Each delivery is
+    recorded, and every progress_interval the job is checkpointed at the
+    highest user id below which all sends finished, alongside an edit of
+    one progress message with the running counts.
+    """
+
+    def __init__(self, bot, db, limiter: SendRateLimiter,
+                 concurrency: int = BROADCAST_SETTINGS['concurrency'],
+                 retry_attempts: int = BROADCAST_SETTINGS['retry_attempts'],
+                 max_flood_waits: int = BROADCAST_SETTINGS['max_flood_waits'],
+                 progress_interval: float = BROADCAST_SETTINGS['progress_interval'],
+                 stream_batch_size: int = BROADCAST_SETTINGS['stream_batch_size']):
+        self.bot = bot
+        self.db = db
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.retry_attempts = retry_attempts
+        self.max_flood_waits = max_flood_waits
+        self.progress_interval = progress_interval
+        self.stream_batch_size = stream_batch_size
+
+    async def run(self, job: BroadcastJob) -> Tuple[int, int]:
+        """Send the job's message to its remaining recipients. Returns (sent, failed).
+
+        Cancelling the task stops sending after a final checkpoint; the job
+        row itself is left for the caller to mark.
+        """
+        self.job = job
+        self.sent = job.sent
+        self.failed = job.failed
+        self.checkpoint = job.last_user_id
+        self.dispatched = deque()
+        self.done = set()
+        self.started = time.monotonic()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        progress = await self.bot.send_message(
+            job.admin_id,
+            self._progress_text("📨 در حال ارسال پیام همگانی..."),
+            reply_markup=self._cancel_markup()
+        )
+        reporter = asyncio.create_task(self._report(progress))
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        try:
+            after_id = job.last_user_id
+            while True:
+                async with self.db.Session() as session:
+                    rows = (await session.execute(
+                        broadcast_recipients(job, after_id).limit(self.stream_batch_size)
+                    )).all()
+                if not rows:
+                    break
+                for user_id, chat_id in rows:
+                    self.dispatched.append(user_id)
+                    await queue.put((user_id, chat_id))
+                after_id = rows[-1].id
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            await self._checkpoint()
+            await self._edit(progress, self._progress_text("⛔ پیام همگانی متوقف شد:"))
+            raise
+        finally:
+            for task in workers:
+                task.cancel()
+            reporter.cancel()
+            # Once run() returns no worker can record another delivery
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+
+        await self._checkpoint()
+        await self._edit(progress, self._progress_text("📨 پیام همگانی ارسال شد:"))
+        return self.sent, self.failed
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            user_id, chat_id = item
+            if await self._send(chat_id, self.job.message):
+                await self.db.record_broadcast_delivery(self.job.id, user_id)
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._mark_done(user_id)
+
+    def _mark_done(self, user_id: int):
+        """Advance the checkpoint over the finished prefix of dispatched users"""
+        self.done.add(user_id)
+        while self.dispatched and self.dispatched[0] in self.done:
+            self.checkpoint = self.dispatched.popleft()
+            self.done.discard(self.checkpoint)
+
+    async def _checkpoint(self):
+        await self.db.checkpoint_broadcast_job(self.job.id, self.checkpoint, self.sent, self.failed)
+
+    async def _send(self, chat_id: int, text: str) -> bool:
+        attempts = flood_waits = 0
+        while attempts < self.retry_attempts:
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.send_message(chat_id, text)
+                return True
+            except RetryAfter as e:
+                # Telegram said when to resume; waiting it out is not a failed attempt
+                flood_waits += 1
+                if flood_waits > self.max_flood_waits:
+                    logger.error(f"Broadcast to {chat_id} still flood limited after {flood_waits - 1} pauses")
+                    return False
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                logger.warning(f"Broadcast flood limited, pausing {delay}s")
+                self.limiter.pause(delay)
+            except Forbidden:
+                # Blocked the bot or deactivated, retrying will not help
+                return False
+            except NetworkError as e:
+                attempts += 1
+                logger.warning(f"Broadcast to {chat_id} failed (attempt {attempts}): {e}")
+            except Exception as e:
+                logger.error(f"Failed to send broadcast to {chat_id}: {e}")
+                return False
+        return False
+
+    def _progress_text(self, title: str) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (
+            f"{title}\n"
+            f"✅ موفق: {self.sent}\n"
+            f"❌ ناموفق: {self.failed}\n"
+            f"⚡ سرعت: {self.sent / elapsed:.1f} پیام در ثانیه"
+        )
+
+    def _cancel_markup(self):
+        return InlineKeyboardMarkup([[
+            InlineKeyboardButton("⛔ توقف ارسال", callback_data=f'cancel_broadcast_{self.job.id}')
+        ]])
+
+    async def _report(self, progress):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._checkpoint()
+            await self._edit(progress, self._progress_text("📨 در حال ارسال پیام همگانی..."), self._cancel_markup())
+
+    async def _edit(self, progress, text: str, reply_markup=None):
+        try:
+            await self.limiter.acquire(progress.chat_id)
+            await self.bot.edit_message_text(
+                text,
+                chat_id=progress.chat_id,
+                message_id=progress.message_id,
+                reply_markup=reply_markup
+            )
+        except BadRequest:
+            # "Message is not modified" when nothing moved since the last edit
+            pass
+        except TelegramError as e:
+            logger.error(f"Failed to update broadcast progress: {e}")
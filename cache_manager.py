@@ -1,93 +1,464 @@
-from typing import Any, Dict, Optional
-from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import hashlib
+import heapq
+import inspect
 import json
 import os
+import sqlite3
+import threading
+import time
 from advanced_config import CACHE_SETTINGS, PATH_SETTINGS
 
-class CacheManager:
+MISSING = object()
+
+
+class CacheStats:
     def __init__(self):
-        self.memory_cache: Dict[str, Any] = {}
-        self.disk_cache_dir = PATH_SETTINGS['cache_dir']
-        os.makedirs(self.disk_cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hit_rate
+        }
+
+
+class MemoryNamespace:
+    """One namespace of the memory tier: an LRU of at most max_size entries with per-entry TTL.
+
+    The OrderedDict keeps recency (get/set/evict are O(1)); a heap of
+    (expires_at, key) finds expired entries without scanning. Heap entries
+    left behind by an overwrite are skipped when popped, and the heap is
+    rebuilt once they outnumber the live ones.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()  # key -> (value, expires_at)
+        self.expiry = []
+        self.stats = CacheStats()
+
+    def get(self, key: str, now: float) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats.misses += 1
+            return MISSING
+        if entry[1] <= now:
+            del self.entries[key]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return MISSING
+        self.entries.move_to_end(key)
+        self.stats.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: Any, expires_at: float, now: float):
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        heapq.heappush(self.expiry, (expires_at, key))
+        self.purge_expired(now)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats.evictions += 1
+        if len(self.expiry) > 2 * len(self.entries) + 64:
+            self.expiry = [(expires_at, key) for key, (_, expires_at) in self.entries.items()]
+            heapq.heapify(self.expiry)
+
+    def delete(self, key: str) -> bool:
+        return self.entries.pop(key, None) is not None
+
+    def purge_expired(self, now: float) -> int:
+        purged = 0
+        while self.expiry and self.expiry[0][0] <= now:
+            expires_at, key = heapq.heappop(self.expiry)
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == expires_at:
+                del self.entries[key]
+                purged += 1
+        self.stats.expirations += purged
+        return purged
+
+
+class MemoryTier:
+    """Namespaced in-process cache; each namespace has its own size limit and counters"""
+
+    def __init__(self, max_size: int = CACHE_SETTINGS['max_size'],
+                 namespace_sizes: Dict[str, int] = CACHE_SETTINGS['namespace_max_size'],
+                 expire_time: float = CACHE_SETTINGS['expire_time']):
+        self.max_size = max_size
+        self.namespace_sizes = namespace_sizes
+        self.expire_time = expire_time
+        self.namespaces: Dict[str, MemoryNamespace] = {}
+
+    def namespace(self, name: str) -> MemoryNamespace:
+        namespace = self.namespaces.get(name)
+        if namespace is None:
+            namespace = MemoryNamespace(self.namespace_sizes.get(name, self.max_size))
+            self.namespaces[name] = namespace
+        return namespace
+
+    def get(self, key: str, namespace: str = 'default', default: Any = None) -> Any:
+        value = self.namespace(namespace).get(key, time.monotonic())
+        return default if value is MISSING else value
+
+    def set(self, key: str, value: Any, expire_seconds: Optional[float] = None, namespace: str = 'default'):
+        now = time.monotonic()
+        self.namespace(namespace).set(key, value, now + (expire_seconds or self.expire_time), now)
+
+    def delete(self, key: str, namespace: str = 'default') -> bool:
+        return self.namespace(namespace).delete(key)
+
+    def clear(self, namespace: Optional[str] = None):
+        if namespace is None:
+            self.namespaces.clear()
+        else:
+            self.namespaces.pop(namespace, None)
+
+    def purge_expired(self) -> int:
+        now = time.monotonic()
+        return sum(namespace.purge_expired(now) for namespace in self.namespaces.values())
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {**namespace.stats.as_dict(), 'size': len(namespace.entries), 'max_size': namespace.max_size}
+            for name, namespace in self.namespaces.items()
+        }
+
+
+class DiskTier:
+    """Disk cache in one SQLite file: cache(key_hash, key, expires_at, is_binary, value).
+
+    Keys are stored under their SHA-256 digest, so any string is a valid
+    key. Every set is a single INSERT OR REPLACE, atomic under WAL. Expiry
+    is indexed, so a sweep deletes a range instead of reading every entry.
+    bytes are stored as they are; anything else as JSON text. The
+    generations table keeps CacheManager's invalidation counters of the
+    names disk entries depend on.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key_hash BLOB PRIMARY KEY, key TEXT NOT NULL, expires_at REAL NOT NULL,"
+            " is_binary INTEGER NOT NULL, value BLOB NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_cache_expires_at ON cache (expires_at)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID"
+        )
+
+    @staticmethod
+    def key_hash(key: str) -> bytes:
+        return hashlib.sha256(key.encode()).digest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT is_binary, value FROM cache WHERE key_hash = ? AND expires_at > ?",
+                (self.key_hash(key), time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        is_binary, value = row
+        return bytes(value) if is_binary else json.loads(value)
+
+    def set(self, key: str, value: Any, expire_seconds: float):
+        is_binary = isinstance(value, (bytes, bytearray, memoryview))
+        data = bytes(value) if is_binary else json.dumps(value)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key_hash, key, expires_at, is_binary, value) VALUES (?, ?, ?, ?, ?)",
+                (self.key_hash(key), key, time.time() + expire_seconds, int(is_binary), data)
+            )
+
+    def delete(self, key: str) -> bool:
+        with self.lock:
+            return self.conn.execute("DELETE FROM cache WHERE key_hash = ?", (self.key_hash(key),)).rowcount > 0
+
+    def purge_expired(self) -> int:
+        with self.lock:
+            return self.conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def get_generation(self, name: str) -> int:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def set_generation(self, name: str, value: int):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO generations (name, value) VALUES (?, ?)", (name, value))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class CacheManager:
+    def __init__(self, cache_dir: str = PATH_SETTINGS['cache_dir']):
+        self.memory = MemoryTier()
+        self.disk_cache_dir = cache_dir
+        self._disk: Optional[DiskTier] = None
+        self.disk_lock = threading.RLock()
+        # Bumped to invalidate a namespace or tag; keys embed the generations
+        # they were built with. Names that disk entries depend on are
+        # persisted in the disk tier, so a restart keeps those entries valid
+        # and an invalidation in any run reaches them.
+        self.generations: Dict[str, int] = {}
+        self.persisted: Set[str] = set()
+        self.generation_writer: Optional[ThreadPoolExecutor] = None
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.locks: Dict[str, threading.Lock] = {}
+
+    @property
+    def disk(self) -> DiskTier:
+        """Opened on first use, so memory-only callers never touch the filesystem"""
+        if self._disk is None:
+            with self.disk_lock:
+                if self._disk is None:
+                    os.makedirs(self.disk_cache_dir, exist_ok=True)
+                    self._remove_legacy_files()
+                    self._disk = DiskTier(os.path.join(self.disk_cache_dir, 'cache.db'))
+        return self._disk
+
+    def _bump(self, name: str):
+        with self.disk_lock:
+            value = self.generations[name] = self.generations.get(name, 0) + 1
+            persisted = name in self.persisted
+        if persisted:
+            # Written through on one background thread, in bump order; lookups use memory
+            if self.generation_writer is None:
+                self.generation_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-generations')
+            self.generation_writer.submit(self.disk.set_generation, name, value)
+
+    def _generation(self, name: str, persistent: bool) -> int:
+        if persistent and name not in self.persisted:
+            with self.disk_lock:
+                if name not in self.persisted:
+                    stored = self.disk.get_generation(name)
+                    # Any bump in this process so far may have made entries stored under `stored` stale
+                    value = stored + self.generations.get(name, 0)
+                    if value != stored:
+                        self.disk.set_generation(name, value)
+                    self.generations[name] = value
+                    self.persisted.add(name)
+        return self.generations.get(name, 0)
+
+    def load_generations(self, names: Iterable[str]):
+        """Read the stored generations of names from the disk tier; blocking, run it in a thread"""
+        for name in names:
+            self._generation(name, persistent=True)
+
+    def invalidate(self, namespace: str):
+        """Drop everything cached under a namespace"""
+        self._bump(namespace)
+        self.memory.clear(namespace)
+
+    def invalidate_tag(self, tag: str):
+        """Drop every entry cached with this tag, e.g. 'user:42', in any namespace"""
+        self._bump(tag)
+
+    def versioned_key(self, namespace: str, key: str, tags: Iterable[str] = (), persistent: bool = False) -> str:
+        """The key with the current generation of its namespace and tags; persistent for disk entries"""
+        names = (namespace, *tags)
+        versions = ','.join(f"{name}@{self._generation(name, persistent)}" for name in names)
+        return f"{versions}|{key}"
+
+    def _remove_legacy_files(self):
+        """Drop the one-JSON-file-per-key entries of the old disk cache"""
+        for filename in os.listdir(self.disk_cache_dir):
+            if filename.endswith('.cache'):
+                try:
+                    os.remove(os.path.join(self.disk_cache_dir, filename))
+                except OSError:
+                    pass
         
-    async def get_from_memory(self, key: str) -> Optional[Any]:
+    async def get_from_memory(self, key: str, namespace: str = 'default') -> Optional[Any]:
         """Get value from memory cache"""
-        if key in self.memory_cache:
-            data = self.memory_cache[key]
-            if datetime.utcnow() < data['expire_time']:
-                return data['value']
-            else:
-                del self.memory_cache[key]
-        return None
+        return self.memory.get(key, namespace)
         
-    async def set_in_memory(self, key: str, value: Any, expire_seconds: int = None):
+    async def set_in_memory(self, key: str, value: Any, expire_seconds: int = None, namespace: str = 'default'):
         """Set value in memory cache"""
         if not expire_seconds:
             expire_seconds = CACHE_SETTINGS['expire_time']
-            
-        self.memory_cache[key] = {
-            'value': value,
-            'expire_time': datetime.utcnow() + timedelta(seconds=expire_seconds)
-        }
-        
-        # Cleanup if cache is too large
-        if len(self.memory_cache) > CACHE_SETTINGS['max_size']:
-            oldest_key = min(
-                self.memory_cache.items(),
-                key=lambda x: x[1]['expire_time']
-            )[0]
-            del self.memory_cache[oldest_key]
+        self.memory.set(key, value, expire_seconds, namespace)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Hit, miss, eviction and expiration counters per memory namespace"""
+        return self.memory.stats()
             
     async def get_from_disk(self, key: str) -> Optional[Any]:
         """Get value from disk cache"""
-        cache_file = os.path.join(self.disk_cache_dir, f"{key}.cache")
-        if os.path.exists(cache_file):
-            try:
-                with open(cache_file, 'r') as f:
-                    data = json.load(f)
-                    if datetime.fromisoformat(data['expire_time']) > datetime.utcnow():
-                        return data['value']
-                    else:
-                        os.remove(cache_file)
-            except Exception:
-                if os.path.exists(cache_file):
-                    os.remove(cache_file)
-        return None
+        return await asyncio.to_thread(self.disk.get, key)
         
     async def set_in_disk(self, key: str, value: Any, expire_seconds: int = None):
-        """Set value in disk cache"""
+        """Set value in disk cache; bytes are stored as is, anything else as JSON"""
         if not expire_seconds:
             expire_seconds = CACHE_SETTINGS['expire_time']
-            
-        cache_file = os.path.join(self.disk_cache_dir, f"{key}.cache")
-        data = {
-            'value': value,
-            'expire_time': (datetime.utcnow() + timedelta(seconds=expire_seconds)).isoformat()
-        }
-        
-        with open(cache_file, 'w') as f:
-            json.dump(data, f)
+        await asyncio.to_thread(self.disk.set, key, value, expire_seconds)
+
+    async def delete_from_disk(self, key: str) -> bool:
+        return await asyncio.to_thread(self.disk.delete, key)
             
     async def clear_expired(self):
         """Clear expired cache entries"""
-        # Clear memory cache
-        now = datetime.utcnow()
-        expired_keys = [
-            key for key, data in self.memory_cache.items()
-            if data['expire_time'] < now
-        ]
-        for key in expired_keys:
-            del self.memory_cache[key]
-            
-        # Clear disk cache
-        for filename in os.listdir(self.disk_cache_dir):
-            if filename.endswith('.cache'):
-                filepath = os.path.join(self.disk_cache_dir, filename)
+        self.memory.purge_expired()
+        await asyncio.to_thread(self.disk.purge_expired)
+
+    def close(self):
+        if self.generation_writer is not None:
+            self.generation_writer.shutdown(wait=True)
+            self.generation_writer = None
+        if self._disk is not None:
+            self._disk.close()
+
+
+_default_manager: Optional[CacheManager] = None
+
+
+def default_cache_manager() -> CacheManager:
+    global _default_manager
+    if _default_manager is None:
+        _default_manager = CacheManager()
+    return _default_manager
+
+
+def _manager_for(args) -> CacheManager:
+    """The `cache_manager` of the instance a method is called on, else the process-wide one"""
+    if args:
+        manager = getattr(args[0], 'cache_manager', None)
+        if isinstance(manager, CacheManager):
+            return manager
+    return default_cache_manager()
+
+
+def cached(namespace: str, ttl: Optional[float] = None, key: Union[str, Callable, None] = None,
+           tags: Iterable[str] = (), disk: bool = False):
+    """Cache a function's result in the memory tier (and the disk tier with disk=True).
+
+    `key` is a format string over the arguments ("{service_id}"), a callable
+    taking them as keywords, or by default their repr. `tags` are format
+    strings too ("user:{user_id}"); CacheManager.invalidate(namespace) and
+    invalidate_tag(tag) drop matching entries. None results are not cached.
+    Concurrent misses on one key run the function once. Works on plain and
+    async functions; disk values must be bytes or JSON-serialisable.
+    """
+    ttl = ttl or CACHE_SETTINGS['expire_time']
+    tags = tuple(tags)
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        def key_parts(args, kwargs):
+            """(unversioned key, tag names) of one call"""
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {name: value for name, value in bound.arguments.items() if name not in ('self', 'cls')}
+            if key is None:
+                text = repr(tuple(arguments.values()))
+            elif callable(key):
+                text = str(key(**arguments))
+            else:
+                text = key.format(**arguments)
+            return f"{func.__module__}.{func.__qualname__}:{text}", [tag.format(**arguments) for tag in tags]
+
+        def cache_key(manager, args, kwargs):
+            base, tag_names = key_parts(args, kwargs)
+            return manager.versioned_key(namespace, base, tag_names, persistent=disk)
+
+        def store(manager, full_key, value):
+            if value is not None:
+                manager.memory.set(full_key, value, ttl, namespace)
+
+        if inspect.iscoroutinefunction(func):
+            async def load(manager, full_key, args, kwargs):
+                if disk:
+                    value = await asyncio.to_thread(manager.disk.get, full_key)
+                    if value is not None:
+                        store(manager, full_key, value)
+                        return value
+                value = await func(*args, **kwargs)
+                store(manager, full_key, value)
+                if disk and value is not None:
+                    await asyncio.to_thread(manager.disk.set, full_key, value, ttl)
+                return value
+
+            def forget(manager, full_key, future):
+                manager.inflight.pop(full_key, None)
+                if not future.cancelled():
+                    future.exception()  # retrieved, even if every waiter was cancelled
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                manager = _manager_for(args)
+                base, tag_names = key_parts(args, kwargs)
+                if disk and not manager.persisted.issuperset((namespace, *tag_names)):
+                    # First use of these names in this process: their generations are on disk
+                    await asyncio.to_thread(manager.load_generations, (namespace, *tag_names))
+                full_key = manager.versioned_key(namespace, base, tag_names, persistent=disk)
+                value = manager.memory.get(full_key, namespace, MISSING)
+                if value is not MISSING:
+                    return value
+
+                future = manager.inflight.get(full_key)
+                if future is None:
+                    future = asyncio.ensure_future(load(manager, full_key, args, kwargs))
+                    manager.inflight[full_key] = future
+                    future.add_done_callback(lambda done: forget(manager, full_key, done))
+                return await asyncio.shield(future)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                manager = _manager_for(args)
+                full_key = cache_key(manager, args, kwargs)
+                value = manager.memory.get(full_key, namespace, MISSING)
+                if value is not MISSING:
+                    return value
+
+                own_lock = threading.Lock()
+                lock = manager.locks.setdefault(full_key, own_lock)
                 try:
-                    with open(filepath, 'r') as f:
-                        data = json.load(f)
-                        if datetime.fromisoformat(data['expire_time']) < now:
-                            os.remove(filepath)
-                except Exception:
-                    if os.path.exists(filepath):
-                        os.remove(filepath) 
\ No newline at end of file
+                    with lock:
+                        # Filled by the thread we were waiting on
+                        value = manager.memory.get(full_key, namespace, MISSING)
+                        if value is not MISSING:
+                            return value
+                        if disk:
+                            value = manager.disk.get(full_key)
+                            if value is not None:
+                                store(manager, full_key, value)
+                                return value
+                        value = func(*args, **kwargs)
+                        store(manager, full_key, value)
+                        if disk and value is not None:
+                            manager.disk.set(full_key, value, ttl)
+                        return value
+                finally:
+                    # Only the caller that created the lock retires it; a waiter
+                    # popping it would let a newcomer start a second load
+                    if lock is own_lock:
+                        manager.locks.pop(full_key, None)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,58 @@
+import asyncio
+from collections import namedtuple
+from types import MappingProxyType
+
+from sqlalchemy import select
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from database import Service, service_entry
+
+CatalogSnapshot = namedtuple('CatalogSnapshot', ['version', 'services', 'by_id', 'active', 'buy_markup', 'renewal_markup'])
+
+
+def build_snapshot(version: int, services) -> CatalogSnapshot:
+    """An immutable catalog: entries by id, the active ones in id order and their menus"""
+    entries = tuple(service_entry(s) for s in sorted(services, key=lambda s: s.id))
+    active = tuple(entry for entry in entries if entry.is_active)
+
+    buy_markup = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(f"{entry.name} - {entry.price:,} تومان", callback_data=f"service_{entry.id}")]
+         for entry in active]
+        + [[InlineKeyboardButton("🔙 بازگشت", callback_data='back_to_main')]]
+    )
+    renewal_markup = InlineKeyboardMarkup(
+        [[InlineKeyboardButton(f"{entry.name} - {entry.price:,} تومان", callback_data=f'renew_{entry.id}')]
+         for entry in active]
+        + [[InlineKeyboardButton("🔙 بازگشت", callback_data='admin_panel')]]
+    )
+    return CatalogSnapshot(
+        version, entries, MappingProxyType({entry.id: entry for entry in entries}), active, buy_markup, renewal_markup
+    )
+
+
+class ServiceCatalog:
+    """The service catalog as a versioned, immutable snapshot.
+
+    Services only change through the admin flows, which call reload()
+    after committing; the new snapshot replaces the old one in a single
+    assignment, so a handler always sees one consistent version. Menus
+    are served from the snapshot without touching the database.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.snapshot = build_snapshot(0, ())
+        self.lock = asyncio.Lock()
+
+    async def reload(self) -> CatalogSnapshot:
+        async with self.lock:
+            async with self.db.Session() as session:
+                services = (await session.scalars(select(Service))).all()
+            self.snapshot = build_snapshot(self.snapshot.version + 1, services)
+            return self.snapshot
+
+    def get(self, service_id):
+        try:
+            return self.snapshot.by_id.get(int(service_id))
+        except (TypeError, ValueError):
+            return None
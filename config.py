@@ -71,7 +71,10 @@ MESSAGES = {
 📊 حجم باقیمانده: {data_limit} GB
     """,
     "insufficient_balance": "موجودی کیف پول شما کافی نیست. لطفا ابتدا کیف پول خود را شارژ کنید.",
-    "payment_received": "پرداخت شما با موفقیت انجام شد و کیف پول شما شارژ شد."
+    "payment_received": "پرداخت شما با موفقیت انجام شد و کیف پول شما شارژ شد.",
+    "panel_unavailable": "⚠️ پنل در حال حاضر در دسترس نیست. لطفا چند دقیقه دیگر دوباره تلاش کنید.",
+    "purchase_already_processed": "ℹ️ این خرید قبلا انجام شده است و مبلغی دوباره کسر نشد.",
+    "purchase_failed": "❌ خطا در ثبت خرید. مبلغی از کیف پول شما کسر نشد، لطفا دوباره تلاش کنید."
 }
 
 # Cleanup Settings
@@ -79,7 +82,9 @@ CLEANUP_SETTINGS = {
     "expired_users_days": 30,  # Delete expired users after 30 days
     "old_logs_days": 90,  # Delete logs older than 90 days
     "old_backups_days": 30,  # Delete backups older than 30 days
-    "backup_retention_count": 10  # Keep last 10 backups minimum
+    "backup_retention_count": 10,  # Keep last 10 backups minimum
+    "expired_users_chunk_size": 200,  # services deleted per commit
+    "marzban_delete_concurrency": 10  # panel deletes in flight per chunk
 }
 
 # Performance Settings
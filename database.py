@@ -1,8 +1,17 @@
-from sqlalchemy import Column, Integer, Float, String, Boolean, ForeignKey, TIMESTAMP, Text, create_engine, func
+from sqlalchemy import Column, Integer, Float, String, Boolean, Date, ForeignKey, TIMESTAMP, Text, Index, and_, case, create_engine, delete, event, func, insert, or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from datetime import datetime
+from sqlalchemy.sql.sqltypes import DateTime
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
+import asyncio
 import json
+import time
+from advanced_config import CACHE_SETTINGS, DATABASE_SETTINGS, LOG_SETTINGS, PAGINATION_SETTINGS
+from cache_manager import CacheManager, cached
 
 # Declare base for using SQLAlchemy
 Base = declarative_base()
@@ -21,6 +30,10 @@ class User(Base):
     user_services = relationship("UserService", back_populates="user")
     transactions = relationship("Transaction", back_populates="user")
 
+    __table_args__ = (
+        Index('ix_users_created_at', 'created_at'),
+    )
+
 
 # Service model
 class Service(Base):
@@ -35,6 +48,14 @@ class Service(Base):
     inbound_id = Column(Integer)
 
 
+# Read-only copy of a services row, what the cached service reads and the catalog hand out
+ServiceEntry = namedtuple('ServiceEntry', ['id', 'name', 'price', 'duration', 'data_limit', 'is_active', 'inbound_id'])
+
+
+def service_entry(service):
+    return None if service is None else ServiceEntry(*(getattr(service, field) for field in ServiceEntry._fields))
+
+
 # UserService model
 class UserService(Base):
     __tablename__ = 'user_services'
@@ -47,11 +68,18 @@ class UserService(Base):
     data_limit = Column(Integer)
     data_used = Column(Integer, default=0)
     is_active = Column(Boolean, default=True)
+    expiry_notified_days = Column(Integer)  # smallest expire_warning_days threshold already sent
+    data_notified_percent = Column(Integer)  # highest data_warning_percent threshold already sent
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
 
     user = relationship("User", back_populates="user_services")
     service = relationship("Service")
 
+    __table_args__ = (
+        Index('ix_user_services_user_active', 'user_id', 'is_active'),
+        Index('ix_user_services_active_expire', 'is_active', 'expire_date'),
+    )
+
 
 # Transaction model
 class Transaction(Base):
@@ -62,9 +90,17 @@ class Transaction(Base):
     amount = Column(Float, nullable=False)
     type = Column(String)
     status = Column(String)
+    service_id = Column(Integer, ForeignKey('services.id'))  # Service paid for, purchases and refunds only
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
 
     user = relationship("User", back_populates="transactions")
+    service = relationship("Service")
+
+    __table_args__ = (
+        Index('ix_transactions_type_status_created', 'type', 'status', 'created_at'),
+        Index('ix_transactions_status_created', 'status', 'created_at'),
+        Index('ix_transactions_user_id', 'user_id'),
+    )
 
 
 # DiscountCode model
@@ -115,11 +151,87 @@ class Backup(Base):
     created_at = Column(TIMESTAMP, server_default=func.now())
 
 
+# SalesDailyRollup model, maintained in the same commit as each transaction write
+class SalesDailyRollup(Base):
+    __tablename__ = 'sales_daily_rollup'
+
+    date = Column(Date, primary_key=True)
+    type = Column(String, primary_key=True)
+    status = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    total = Column(Float, nullable=False, default=0)
+
+
+# BroadcastJob model, checkpointed so a restart resumes instead of starting over
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    message = Column(Text, nullable=False)
+    target = Column(String, nullable=False, default='all')
+    admin_id = Column(Integer, nullable=False)  # chat that gets the progress message
+    status = Column(String, nullable=False, default='running')  # running, completed, cancelled
+    last_user_id = Column(Integer, nullable=False, default=0)  # every user up to here is done
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    finished_at = Column(TIMESTAMP)
+
+    __table_args__ = (
+        Index('ix_broadcast_jobs_status', 'status'),
+    )
+
+
+# Users past a job's checkpoint who already got its message
+class BroadcastDelivery(Base):
+    __tablename__ = 'broadcast_deliveries'
+
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+
+
+# Marzban account still to be created for a purchased service, worked off by the Provisioner
+class ProvisioningJob(Base):
+    __tablename__ = 'provisioning_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String, unique=True)  # repeated purchase requests map to one job
+    user_service_id = Column(Integer, ForeignKey('user_services.id'), nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending, completed, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(TIMESTAMP, default=datetime.utcnow)
+    last_error = Column(String)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    finished_at = Column(TIMESTAMP)
+
+    __table_args__ = (
+        Index('ix_provisioning_jobs_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+
+SQLITE_PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout')
+
+
+def apply_sqlite_profile(engine):
+    """Apply the tuned PRAGMA profile to every new SQLite connection"""
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(f"PRAGMA {pragma}={DATABASE_SETTINGS[pragma]}")
+        cursor.close()
+
+
 class Database:
     def __init__(self, db_url):
         self.engine = create_engine(db_url)
+        apply_sqlite_profile(self.engine)
         Base.metadata.create_all(self.engine)
         self.Session = sessionmaker(bind=self.engine)
+        self.cache_manager = CacheManager()
 
     # User methods
     def create_user(self, telegram_id, username=None, is_admin=False):
@@ -162,7 +274,7 @@ class Database:
                 return True
             else:
                 return False
-        except Exception as e:
+        except Exception:
             session.rollback()
             return False
         finally:
@@ -182,6 +294,7 @@ class Database:
             )
             session.add(new_service)
             session.commit()
+            self.cache_manager.invalidate('services')
             return new_service.id
         except Exception as e:
             session.rollback()
@@ -190,20 +303,22 @@ class Database:
         finally:
             session.close()
 
+    @cached('services', ttl=CACHE_SETTINGS['service_expire_time'])
     def get_active_services(self):
         session = self.Session()
         try:
-            return session.query(Service).filter_by(is_active=True).all()
+            return tuple(map(service_entry, session.query(Service).filter_by(is_active=True)))
         except Exception as e:
             print(f"Error getting active services: {e}")
             return []
         finally:
             session.close()
 
+    @cached('services', ttl=CACHE_SETTINGS['service_expire_time'], key='{service_id}')
     def get_service(self, service_id):
         session = self.Session()
         try:
-            return session.query(Service).get(service_id)
+            return service_entry(session.query(Service).get(service_id))
         except Exception as e:
             print(f"Error getting service: {e}")
             return None
@@ -231,6 +346,46 @@ class Database:
         finally:
             session.close()
 
+    def purchase_service(self, telegram_id, service, marzban_username):
+        """Debit the wallet, record the purchase and create the user service in one commit.
+
+        Returns the new user service id, or None if the balance does not cover the price.
+        """
+        session = self.Session()
+        try:
+            user_id = session.scalar(wallet_debit(telegram_id, service.price))
+            if user_id is None:
+                session.rollback()
+                return None
+
+            new_transaction = Transaction(
+                user_id=user_id,
+                amount=service.price,
+                type='purchase',
+                status='completed',
+                service_id=service.id,
+                created_at=datetime.utcnow()
+            )
+            session.add(new_transaction)
+            session.execute(sales_rollup_upsert(new_transaction, 1))
+
+            new_user_service = UserService(
+                user_id=user_id,
+                service_id=service.id,
+                marzban_username=marzban_username,
+                expire_date=datetime.utcnow() + timedelta(days=service.duration),
+                data_limit=int(service.data_limit * 1024)  # GB -> MB, the unit of data_used
+            )
+            session.add(new_user_service)
+            session.commit()
+            return new_user_service.id
+        except Exception as e:
+            session.rollback()
+            print(f"Error purchasing service: {e}")
+            return None
+        finally:
+            session.close()
+
     def get_user_active_services(self, user_id: int):
         session = self.Session()
         try:
@@ -256,16 +411,19 @@ class Database:
             session.close()
 
     # Transaction methods
-    def create_transaction(self, user_id, amount, type_, status='pending'):
+    def create_transaction(self, user_id, amount, type_, status='pending', service_id=None):
         session = self.Session()
         try:
             new_transaction = Transaction(
                 user_id=user_id,
                 amount=amount,
                 type=type_,
-                status=status
+                status=status,
+                service_id=service_id,
+                created_at=datetime.utcnow()
             )
             session.add(new_transaction)
+            session.execute(sales_rollup_upsert(new_transaction, 1))
             session.commit()
             return new_transaction.id
         except Exception as e:
@@ -279,8 +437,12 @@ class Database:
         session = self.Session()
         try:
             transaction = session.query(Transaction).get(transaction_id)
-            if transaction:
+            if transaction and transaction.status != status:
+                if transaction.created_at is not None:
+                    session.execute(sales_rollup_upsert(transaction, -1))
                 transaction.status = status
+                if transaction.created_at is not None:
+                    session.execute(sales_rollup_upsert(transaction, 1))
                 session.commit()
         except Exception as e:
             session.rollback()
@@ -379,12 +541,1272 @@ class Database:
         finally:
             session.close()
 
+    @cached('services', ttl=CACHE_SETTINGS['service_expire_time'], key='{service_id}')
     def get_service_by_id(self, service_id: int):
         session = self.Session()
         try:
-            return session.query(Service).get(service_id)
+            return service_entry(session.query(Service).get(service_id))
         except Exception as e:
             print(f"Error getting service by ID: {e}")
             return None
         finally:
-            session.close()
\ No newline at end of file
+            session.close()
+
+
+def sales_rollup_upsert(transaction, sign):
+    """Add (sign=1) or remove (sign=-1) a transaction from its daily rollup row"""
+    stmt = sqlite_insert(SalesDailyRollup).values(
+        date=transaction.created_at.date(),
+        type=transaction.type or '',
+        status=transaction.status or '',
+        count=sign,
+        total=sign * transaction.amount
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=['date', 'type', 'status'],
+        set_={
+            'count': SalesDailyRollup.count + stmt.excluded.count,
+            'total': SalesDailyRollup.total + stmt.excluded.total
+        }
+    )
+
+
+def wallet_debit(telegram_id, amount):
+    """Conditional debit: updates no row unless the balance covers amount. Returns the user id."""
+    return (
+        update(User)
+        .where(User.telegram_id == telegram_id, User.wallet_balance >= amount)
+        .values(wallet_balance=User.wallet_balance - amount)
+        .returning(User.id)
+    )
+
+
+async def add_transaction(session, transaction):
+    """Add a transaction and count it in the rollup, in the caller's commit"""
+    if transaction.created_at is None:
+        transaction.created_at = datetime.utcnow()
+    session.add(transaction)
+    await session.flush()
+    await session.execute(sales_rollup_upsert(transaction, 1))
+
+
+async def set_transaction_status(session, transaction, status):
+    """Change a transaction's status and move it between rollup rows"""
+    if transaction.status == status:
+        return
+    if transaction.created_at is None:
+        # Legacy undated rows were never rolled up
+        transaction.status = status
+        return
+    await session.execute(sales_rollup_upsert(transaction, -1))
+    transaction.status = status
+    await session.execute(sales_rollup_upsert(transaction, 1))
+
+
+def _transaction_daily_totals():
+    day = func.date(Transaction.created_at)
+    type_ = func.coalesce(Transaction.type, '')
+    status = func.coalesce(Transaction.status, '')
+    return select(
+        day.label('date'),
+        type_.label('type'),
+        status.label('status'),
+        func.count().label('count'),
+        func.sum(Transaction.amount).label('total')
+    ).filter(
+        Transaction.created_at.isnot(None)
+    ).group_by(day, type_, status)
+
+
+def backfill_sales_rollup(conn):
+    """Rebuild sales_daily_rollup from the raw transactions table"""
+    conn.execute(delete(SalesDailyRollup))
+    conn.execute(insert(SalesDailyRollup).from_select(
+        ['date', 'type', 'status', 'count', 'total'], _transaction_daily_totals()
+    ))
+
+
+def check_sales_rollup(conn):
+    """Compare the rollup against raw transactions. Returns the mismatching keys."""
+    expected = {
+        (row.date, row.type, row.status): (row.count, round(row.total, 2))
+        for row in conn.execute(_transaction_daily_totals())
+    }
+    actual = {
+        (str(row.date), row.type, row.status): (row.count, round(row.total, 2))
+        for row in conn.execute(select(SalesDailyRollup)).all()
+        if row.count
+    }
+    return [
+        (key, expected.get(key), actual.get(key))
+        for key in sorted(expected.keys() | actual.keys())
+        if expected.get(key) != actual.get(key)
+    ]
+
+
+SALES_REPORT_WINDOWS = (0, 7, 30)  # days back from today
+
+
+def sales_totals_query(start_date, end_date):
+    """(count, total) of completed purchases between two dates, both inclusive"""
+    return select(
+        func.coalesce(func.sum(SalesDailyRollup.count), 0),
+        func.coalesce(func.sum(SalesDailyRollup.total), 0)
+    ).filter(
+        SalesDailyRollup.type == 'purchase',
+        SalesDailyRollup.status == 'completed',
+        SalesDailyRollup.date.between(start_date, end_date)
+    )
+
+
+def popular_services_query(period_start, period_end, limit):
+    """Best-selling services in [period_start, period_end), one GROUP BY join"""
+    sales = func.count(Transaction.id).label('sales')
+    return select(Service.name, sales).join(
+        Service, Service.id == Transaction.service_id
+    ).filter(
+        Transaction.type == 'purchase',
+        Transaction.status == 'completed',
+        Transaction.created_at >= period_start,
+        Transaction.created_at < period_end
+    ).group_by(Service.id).order_by(sales.desc()).limit(limit)
+
+
+def sales_summary_query(today):
+    """One pass over the widest window's rollup rows, with a conditional SUM per window"""
+    starts = [today - timedelta(days=days) for days in SALES_REPORT_WINDOWS]
+
+    columns = []
+    for start in starts:
+        in_window = SalesDailyRollup.date >= start
+        columns.append(func.coalesce(func.sum(case((in_window, SalesDailyRollup.count))), 0))
+        columns.append(func.coalesce(func.sum(case((in_window, SalesDailyRollup.total))), 0))
+
+    return select(*columns).filter(
+        SalesDailyRollup.type == 'purchase',
+        SalesDailyRollup.status == 'completed',
+        SalesDailyRollup.date >= min(starts)
+    )
+
+
+EPOCH = datetime(1970, 1, 1)
+
+Page = namedtuple('Page', ['items', 'prev_token', 'next_token'])
+
+
+class KeysetPaginator:
+    """Pages through a select() by its sort keys instead of OFFSET.
+
+    A page token is 'n' (rows after) or 'p' (rows before) followed by the
+    boundary row's keys, e.g. 'n42' or 'p1739999999000000.17'. Every page is
+    one `WHERE keys > boundary ORDER BY keys LIMIT page_size + 1` query, so
+    with an index on the keys its cost does not depend on the page number.
+    Rows with a NULL key have no place in that order and are not listed; a
+    token that does not decode restarts at the first page.
+    """
+
+    def __init__(self, stmt, *keys, page_size=PAGINATION_SETTINGS['page_size'], descending=False):
+        self.stmt = stmt.where(*(key.isnot(None) for key in keys))
+        self.keys = keys
+        self.page_size = page_size
+        self.descending = descending
+
+    def _encode(self, item):
+        values = []
+        for key in self.keys:
+            value = getattr(item, key.key)
+            if isinstance(value, datetime):
+                value = (value - EPOCH) // timedelta(microseconds=1)
+            values.append(str(value))
+        return '.'.join(values)
+
+    def _decode(self, cursor):
+        """Boundary key values of a token; ValueError if it was not made by _encode"""
+        parts = cursor.split('.')
+        if len(parts) != len(self.keys):
+            raise ValueError(f"bad page token: {cursor!r}")
+        values = []
+        for key, value in zip(self.keys, parts):
+            value = int(value)
+            if isinstance(key.type, DateTime):
+                try:
+                    value = EPOCH + timedelta(microseconds=value)
+                except OverflowError:
+                    raise ValueError(f"bad page token: {cursor!r}")
+            values.append(value)
+        return values
+
+    def _after(self, values, forward):
+        """Rows past the boundary in the given direction, compared key by key"""
+        greater = forward != self.descending
+        clauses = []
+        for i, (key, value) in enumerate(zip(self.keys, values)):
+            equal = [self.keys[j] == values[j] for j in range(i)]
+            clauses.append(and_(*equal, key > value if greater else key < value))
+        # The redundant bound on the first key lets SQLite seek the index to the boundary
+        first, value = self.keys[0], values[0]
+        return and_(first >= value if greater else first <= value, or_(*clauses))
+
+    def _order(self, forward):
+        ascending = forward != self.descending
+        return [key.asc() if ascending else key.desc() for key in self.keys]
+
+    async def page(self, session, token=None):
+        boundary = None
+        if token and len(token) > 1 and token[0] in 'np':
+            try:
+                boundary = self._decode(token[1:])
+            except ValueError:
+                pass
+        if boundary is None:
+            token = None
+
+        forward = not token or token[0] == 'n'
+        stmt = self.stmt.order_by(None).order_by(*self._order(forward)).limit(self.page_size + 1)
+        if boundary is not None:
+            stmt = stmt.where(self._after(boundary, forward))
+
+        items = list((await session.scalars(stmt)).all())
+        more = len(items) > self.page_size
+        items = items[:self.page_size]
+        if not forward:
+            items.reverse()
+        if not items:
+            return Page(items, None, None)
+
+        # A page reached from a token always has a neighbour on the side it came from
+        has_prev = more if not forward else bool(token and len(token) > 1)
+        has_next = more if forward else True
+        return Page(
+            items,
+            f"p{self._encode(items[0])}" if has_prev else None,
+            f"n{self._encode(items[-1])}" if has_next else None
+        )
+
+
+def to_async_url(db_url):
+    """Map a sync SQLite URL (sqlite:///...) onto the aiosqlite driver"""
+    url = make_url(db_url)
+    if url.drivername == 'sqlite':
+        url = url.set(drivername='sqlite+aiosqlite')
+    return url
+
+
+class BatchWriter:
+    """Single writer task that commits queued writes in grouped transactions.
+
+    A job is a coroutine function taking the shared session. Everything queued
+    while the previous batch was committing goes into the next commit, so the
+    write rate is no longer capped by one fsync per row.
+    """
+
+    def __init__(self, session_factory, max_batch=DATABASE_SETTINGS['write_batch_size']):
+        self.Session = session_factory
+        self.max_batch = max_batch
+        self.queue = None
+        self._task = None
+        self.commits = 0
+        self.writes = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self.queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Commit everything already queued, then stop the writer task"""
+        if self.running:
+            await self.queue.put(None)
+            await self._task
+        self._task = None
+
+    async def submit(self, job):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, future))
+        return await future
+
+    async def _run(self):
+        batch = []
+        try:
+            stopping = False
+            while not stopping:
+                item = await self.queue.get()
+                if item is None:
+                    break
+
+                batch = [item]
+                while len(batch) < self.max_batch and not self.queue.empty():
+                    item = self.queue.get_nowait()
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                await self._commit(batch)
+                batch = []
+        except BaseException as e:
+            # e.g. the rollback itself failed: the writer is gone, so
+            # nobody may be left waiting on it
+            print(f"Batch writer stopped: {e!r}")
+            self._task = None
+            self._fail_pending(batch, e if isinstance(e, Exception) else RuntimeError("batch writer stopped"))
+            if not isinstance(e, Exception):
+                raise
+
+    def _fail_pending(self, batch, error):
+        pending = list(batch)
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                pending.append(item)
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+    async def _commit(self, batch):
+        async with self.Session() as session:
+            try:
+                results = [await job(session) for job, _ in batch]
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                results = None
+
+        if results is None:
+            # Replay one by one so a bad write only fails its own caller
+            for job, future in batch:
+                async with self.Session() as session:
+                    try:
+                        result = await job(session)
+                        await session.commit()
+                        self._resolve(future, result)
+                    except Exception as e:
+                        await session.rollback()
+                        if not future.done():
+                            future.set_exception(e)
+                self.commits += 1
+        else:
+            for (job, future), result in zip(batch, results):
+                self._resolve(future, result)
+            self.commits += 1
+        self.writes += len(batch)
+
+    @staticmethod
+    def _resolve(future, result):
+        if not future.done():
+            future.set_result(result)
+
+
+class LogBuffer:
+    """Ring buffer of SystemLog/ErrorLog rows flushed in the background.
+
+    add() only appends to memory, so logging never waits on a commit. Rows
+    are written with one executemany per table every flush_interval ms, or
+    sooner once flush_size rows are waiting. Past max_backlog the oldest rows
+    are dropped and counted.
+    """
+
+    def __init__(self, write,
+                 flush_interval=LOG_SETTINGS['flush_interval'],
+                 flush_size=LOG_SETTINGS['flush_size'],
+                 max_backlog=LOG_SETTINGS['max_backlog']):
+        self.write = write
+        self.flush_interval = flush_interval / 1000
+        self.flush_size = flush_size
+        self.rows = deque(maxlen=max_backlog)
+        self._wakeup = None
+        self._task = None
+        self.flushed = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if not self.running:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flush task and write out whatever is still buffered"""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        await self.flush()
+
+    def add(self, model, **row):
+        if len(self.rows) == self.rows.maxlen:
+            self.dropped += 1
+        self.rows.append((model, row))
+        if self._wakeup is not None and len(self.rows) >= self.flush_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self.rows:
+            return
+
+        batch = list(self.rows)
+        self.rows.clear()
+        by_model = {}
+        for model, row in batch:
+            by_model.setdefault(model, []).append(row)
+
+        async def write(session):
+            for model, rows in by_model.items():
+                await session.execute(insert(model), rows)
+
+        try:
+            await self.write(write)
+            self.flushed += len(batch)
+            self.flushes += 1
+        except Exception as e:
+            self.dropped += len(batch)
+            print(f"Error flushing logs: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+# Read-only copy of a users row, safe to share between handlers
+UserSnapshot = namedtuple('UserSnapshot', [column.key for column in User.__table__.columns])
+
+
+def user_snapshot(user):
+    return UserSnapshot(*(getattr(user, field) for field in UserSnapshot._fields))
+
+
+class UserCache:
+    """Per-process read-through cache of UserSnapshots keyed by telegram id.
+
+    Entries expire after ttl seconds and the least recently used one is
+    evicted past max_size. Every invalidate() bumps version, so a lookup
+    that raced with a write does not put the stale row back.
+    """
+
+    def __init__(self, ttl=CACHE_SETTINGS['user_expire_time'], max_size=CACHE_SETTINGS['user_max_size']):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id):
+        entry = self.entries.get(telegram_id)
+        if entry is not None:
+            expires_at, snapshot = entry
+            if time.monotonic() < expires_at:
+                self.entries.move_to_end(telegram_id)
+                self.hits += 1
+                return snapshot
+            del self.entries[telegram_id]
+        self.misses += 1
+        return None
+
+    def put(self, telegram_id, snapshot, version):
+        if version != self.version:
+            return
+        self.entries[telegram_id] = (time.monotonic() + self.ttl, snapshot)
+        self.entries.move_to_end(telegram_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, telegram_id):
+        self.version += 1
+        self.entries.pop(telegram_id, None)
+
+
+class AsyncDatabase:
+    """Same API as Database, on SQLAlchemy's asyncio engine.
+
+    Every method is a coroutine, so handlers await the query instead of
+    blocking the event loop while SQLite works. Once start() is called,
+    writes are funnelled through a single BatchWriter task.
+    The schema is not touched here; run init_db.migrate_database() first.
+    """
+
+    def __init__(self, db_url):
+        self.engine = create_async_engine(to_async_url(db_url))
+        apply_sqlite_profile(self.engine.sync_engine)
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.writer = BatchWriter(self.Session)
+        self.logs = LogBuffer(self._write)
+        self.users = UserCache()
+        self.cache_manager = CacheManager()
+
+    async def start(self):
+        self.writer.start()
+        self.logs.start()
+
+    async def close(self):
+        await self.logs.stop()
+        await self.writer.stop()
+        await self.engine.dispose()
+
+    async def _write(self, job):
+        """Run a write job through the writer task, or in its own commit before start()"""
+        if self.writer.running:
+            return await self.writer.submit(job)
+
+        async with self.Session() as session:
+            try:
+                result = await job(session)
+                await session.commit()
+                return result
+            except Exception:
+                await session.rollback()
+                raise
+
+    # User methods
+    async def create_user(self, telegram_id, username=None, is_admin=False):
+        async def write(session):
+            new_user = User(telegram_id=telegram_id, username=username, is_admin=is_admin)
+            session.add(new_user)
+            await session.flush()
+            return new_user.id
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error creating user: {e}")
+            return None
+        finally:
+            self.users.invalidate(telegram_id)
+
+    async def get_user(self, telegram_id):
+        """UserSnapshot for telegram_id, served from the user cache when fresh"""
+        snapshot = self.users.get(telegram_id)
+        if snapshot is not None:
+            return snapshot
+
+        version = self.users.version
+        async with self.Session() as session:
+            try:
+                user = await session.scalar(select(User).filter_by(telegram_id=telegram_id))
+            except Exception as e:
+                print(f"Error getting user: {e}")
+                return None
+
+        if user is None:
+            return None
+        snapshot = user_snapshot(user)
+        self.users.put(telegram_id, snapshot, version)
+        return snapshot
+
+    async def update_user_balance(self, telegram_id, amount):
+        """Add amount (negative to debit) in one conditional UPDATE; False if it would go negative"""
+        async def write(session):
+            user_id = await session.scalar(
+                update(User)
+                .where(User.telegram_id == telegram_id, User.wallet_balance + amount >= 0)
+                .values(wallet_balance=User.wallet_balance + amount)
+                .returning(User.id)
+            )
+            return user_id is not None
+
+        try:
+            return await self._write(write)
+        except Exception:
+            return False
+        finally:
+            self.users.invalidate(telegram_id)
+
+    # Service methods
+    async def create_service(self, name, price, duration, data_limit, inbound_id=1):
+        async def write(session):
+            new_service = Service(
+                name=name,
+                price=price,
+                duration=duration,
+                data_limit=data_limit,
+                inbound_id=inbound_id
+            )
+            session.add(new_service)
+            await session.flush()
+            return new_service.id
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error creating service: {e}")
+            return None
+        finally:
+            self.cache_manager.invalidate('services')
+
+    async def update_service(self, service_id, **values):
+        """Set columns of a service. Returns False if it does not exist."""
+        async def write(session):
+            service = await session.get(Service, service_id)
+            if service is None:
+                return False
+            for name, value in values.items():
+                setattr(service, name, value)
+            return True
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error updating service: {e}")
+            return False
+        finally:
+            self.cache_manager.invalidate('services')
+
+    async def toggle_service(self, service_id):
+        """Flip is_active. Returns the new value, or None if the service does not exist."""
+        async def write(session):
+            service = await session.get(Service, service_id)
+            if service is None:
+                return None
+            service.is_active = not service.is_active
+            return service.is_active
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error toggling service: {e}")
+            return None
+        finally:
+            self.cache_manager.invalidate('services')
+
+    async def delete_service(self, service_id):
+        async def write(session):
+            result = await session.execute(delete(Service).where(Service.id == service_id))
+            return result.rowcount > 0
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error deleting service: {e}")
+            return False
+        finally:
+            self.cache_manager.invalidate('services')
+
+    @cached('services', ttl=CACHE_SETTINGS['service_expire_time'])
+    async def get_active_services(self):
+        async with self.Session() as session:
+            try:
+                result = await session.scalars(select(Service).filter_by(is_active=True))
+                return tuple(map(service_entry, result))
+            except Exception as e:
+                print(f"Error getting active services: {e}")
+                return []
+
+    @cached('services', ttl=CACHE_SETTINGS['service_expire_time'], key='{service_id}')
+    async def get_service(self, service_id):
+        async with self.Session() as session:
+            try:
+                return service_entry(await session.get(Service, int(service_id)))
+            except Exception as e:
+                print(f"Error getting service: {e}")
+                return None
+
+    # UserService methods
+    async def create_user_service(self, user_id, service_id, marzban_username, expire_date, data_limit):
+        async def write(session):
+            new_user_service = UserService(
+                user_id=user_id,
+                service_id=service_id,
+                marzban_username=marzban_username,
+                expire_date=expire_date,
+                data_limit=data_limit
+            )
+            session.add(new_user_service)
+            await session.flush()
+            return new_user_service.id
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error creating user service: {e}")
+            return None
+        finally:
+            self.cache_manager.invalidate_tag(f"user:{user_id}")
+
+    async def purchase_service(self, telegram_id, service, marzban_username=None, idempotency_key=None):
+        """Debit the wallet, record the purchase, create the user service and queue its
+        Marzban account in one commit.
+
+        Returns (user service id, charged): (None, False) if the balance does not
+        cover the price; a repeated idempotency_key returns the first purchase's id
+        with charged False, without charging again. Database errors are raised so
+        the caller can tell them apart from a short balance.
+        """
+        buyer_id = None
+
+        async def write(session):
+            nonlocal buyer_id
+            if idempotency_key is not None:
+                user_service_id = await session.scalar(
+                    select(ProvisioningJob.user_service_id).filter_by(idempotency_key=idempotency_key)
+                )
+                if user_service_id is not None:
+                    return user_service_id, False
+
+            user_id = buyer_id = await session.scalar(wallet_debit(telegram_id, service.price))
+            if user_id is None:
+                return None, False
+
+            await add_transaction(session, Transaction(
+                user_id=user_id,
+                amount=service.price,
+                type='purchase',
+                status='completed',
+                service_id=service.id
+            ))
+
+            new_user_service = UserService(
+                user_id=user_id,
+                service_id=service.id,
+                marzban_username=marzban_username,
+                expire_date=datetime.utcnow() + timedelta(days=service.duration),
+                data_limit=int(service.data_limit * 1024)  # GB -> MB, the unit of data_used
+            )
+            session.add(new_user_service)
+            await session.flush()
+            if new_user_service.marzban_username is None:
+                new_user_service.marzban_username = f"vpn{telegram_id}_{new_user_service.id}"
+            session.add(ProvisioningJob(idempotency_key=idempotency_key, user_service_id=new_user_service.id))
+            return new_user_service.id, True
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error purchasing service: {e}")
+            raise
+        finally:
+            self.users.invalidate(telegram_id)
+            if buyer_id is not None:
+                self.cache_manager.invalidate('reports')
+                self.cache_manager.invalidate_tag(f"user:{buyer_id}")
+
+    async def count_expired_user_services(self, before):
+        async with self.Session() as session:
+            try:
+                return await session.scalar(select(func.count(UserService.id)).where(
+                    UserService.is_active == False,
+                    UserService.expire_date < before
+                ))
+            except Exception as e:
+                print(f"Error counting expired user services: {e}")
+                return 0
+
+    async def get_expired_user_services(self, before, after_id=0, limit=200):
+        """(id, marzban_username) of inactive services expired before `before`, a page at a time by id"""
+        async with self.Session() as session:
+            try:
+                return (await session.execute(select(UserService.id, UserService.marzban_username).where(
+                    UserService.is_active == False,
+                    UserService.expire_date < before,
+                    UserService.id > after_id
+                ).order_by(UserService.id).limit(limit))).all()
+            except Exception as e:
+                print(f"Error getting expired user services: {e}")
+                return []
+
+    async def delete_user_services(self, ids):
+        """Delete user services (and their provisioning jobs) in one statement. Returns the number deleted."""
+        async def write(session):
+            await session.execute(delete(ProvisioningJob).where(ProvisioningJob.user_service_id.in_(ids)))
+            result = await session.execute(delete(UserService).where(UserService.id.in_(ids)))
+            return result.rowcount
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error deleting user services: {e}")
+            return 0
+
+    async def claim_expiry_reminder(self, user_service_id, days):
+        """Record that the `days` expiry warning is being sent. False if it, or a later one, already was."""
+        async def write(session):
+            result = await session.execute(
+                update(UserService).where(
+                    UserService.id == user_service_id,
+                    or_(UserService.expiry_notified_days == None, UserService.expiry_notified_days > days)
+                ).values(expiry_notified_days=days)
+            )
+            return result.rowcount > 0
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error claiming expiry reminder: {e}")
+            return False
+
+    async def get_usage_snapshot(self):
+        """{marzban_username: [(user_service_id, data_used, data_limit), ...]} of active services"""
+        async with self.Session() as session:
+            try:
+                rows = await session.execute(select(
+                    UserService.marzban_username, UserService.id, UserService.data_used, UserService.data_limit
+                ).where(UserService.is_active == True, UserService.marzban_username != None))
+                snapshot = {}
+                for username, user_service_id, data_used, data_limit in rows:
+                    snapshot.setdefault(username, []).append((user_service_id, data_used, data_limit))
+                return snapshot
+            except Exception as e:
+                print(f"Error getting usage snapshot: {e}")
+                return {}
+
+    async def update_usage(self, rows):
+        """Bulk update data_used/data_limit by user service id, one executemany"""
+        async def write(session):
+            await session.execute(update(UserService), rows)
+            return (await session.scalars(
+                select(UserService.user_id).where(UserService.id.in_([row['id'] for row in rows])).distinct()
+            )).all()
+
+        try:
+            user_ids = await self._write(write)
+        except Exception as e:
+            print(f"Error updating usage: {e}")
+            return
+        for user_id in user_ids:
+            self.cache_manager.invalidate_tag(f"user:{user_id}")
+
+    async def claim_data_warning(self, user_service_id, percent):
+        """Record that the `percent` data warning is being sent. False if it, or a higher one, already was."""
+        async def write(session):
+            result = await session.execute(
+                update(UserService).where(
+                    UserService.id == user_service_id,
+                    func.coalesce(UserService.data_notified_percent, 0) < percent
+                ).values(data_notified_percent=percent)
+            )
+            return result.rowcount > 0
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error claiming data warning: {e}")
+            return False
+
+    @cached('users', ttl=CACHE_SETTINGS['user_expire_time'], key='{user_id}', tags=('user:{user_id}',))
+    async def get_user_active_services(self, user_id: int):
+        async with self.Session() as session:
+            try:
+                result = await session.execute(
+                    select(
+                        UserService.id,
+                        UserService.user_id,
+                        UserService.service_id,
+                        UserService.marzban_username,
+                        UserService.expire_date,
+                        UserService.data_limit,
+                        func.coalesce(UserService.data_used, 0).label('data_used'),
+                        UserService.is_active,
+                        Service.name,
+                        Service.price
+                    ).join(Service).filter(
+                        UserService.user_id == user_id,
+                        UserService.is_active == True
+                    )
+                )
+                return result.all()
+            except Exception as e:
+                print(f"Error getting user active services: {e}")
+                return []
+
+    # Transaction methods
+    async def create_transaction(self, user_id, amount, type_, status='pending', service_id=None):
+        async def write(session):
+            new_transaction = Transaction(
+                user_id=user_id,
+                amount=amount,
+                type=type_,
+                status=status,
+                service_id=service_id
+            )
+            await add_transaction(session, new_transaction)
+            return new_transaction.id
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error creating transaction: {e}")
+            return None
+
+    async def update_transaction_status(self, transaction_id, status):
+        async def write(session):
+            transaction = await session.get(Transaction, transaction_id)
+            if transaction:
+                await set_transaction_status(session, transaction, status)
+
+        try:
+            await self._write(write)
+        except Exception as e:
+            print(f"Error updating transaction status: {e}")
+        finally:
+            self.cache_manager.invalidate('reports')
+
+    async def settle_deposit(self, transaction_id, approve):
+        """Approve (crediting the wallet) or reject a pending deposit in one write.
+
+        Returns (telegram_id, amount), or None if the transaction is not pending.
+        """
+        async def write(session):
+            transaction = await session.get(Transaction, transaction_id)
+            if transaction is None or transaction.status != 'pending':
+                return None
+            await set_transaction_status(session, transaction, 'completed' if approve else 'rejected')
+            telegram_id = await session.scalar(select(User.telegram_id).filter_by(id=transaction.user_id))
+            if approve:
+                await session.execute(
+                    update(User).where(User.id == transaction.user_id)
+                    .values(wallet_balance=User.wallet_balance + transaction.amount)
+                )
+            return telegram_id, transaction.amount
+
+        try:
+            result = await self._write(write)
+        except Exception as e:
+            print(f"Error settling deposit: {e}")
+            return None
+        if result is not None:
+            self.users.invalidate(result[0])
+            self.cache_manager.invalidate('reports')
+        return result
+
+    # DiscountCode methods
+    async def create_discount_code(self, code, type_, amount):
+        async def write(session):
+            new_code = DiscountCode(
+                code=code.upper(),
+                type=type_,
+                amount=amount
+            )
+            session.add(new_code)
+            await session.flush()
+            return new_code.id
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error creating discount code: {e}")
+            return None
+
+    # Backup and maintenance methods
+    async def add_backup(self, filename, type_, status, size=0, note=None):
+        """Record a backup file. Returns the row, with its created_at."""
+        async def write(session):
+            backup = Backup(filename=filename, size=size, type=type_, status=status, note=note)
+            session.add(backup)
+            await session.flush()
+            await session.refresh(backup)
+            return backup
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error adding backup: {e}")
+            return None
+
+    async def delete_backups(self, ids):
+        async def write(session):
+            result = await session.execute(delete(Backup).where(Backup.id.in_(ids)))
+            return result.rowcount
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error deleting backups: {e}")
+            return 0
+
+    async def delete_logs_before(self, before):
+        """Delete system and error logs older than `before`"""
+        async def write(session):
+            await session.execute(delete(SystemLog).where(SystemLog.created_at < before))
+            await session.execute(delete(ErrorLog).where(ErrorLog.created_at < before))
+
+        try:
+            await self._write(write)
+        except Exception as e:
+            print(f"Error deleting old logs: {e}")
+
+    async def get_discount_code(self, code):
+        async with self.Session() as session:
+            try:
+                return await session.scalar(select(DiscountCode).filter(
+                    DiscountCode.code == code.upper(),
+                    DiscountCode.is_active == True
+                ))
+            except Exception as e:
+                print(f"Error getting discount code: {e}")
+                return None
+
+    async def use_discount_code(self, code):
+        async def write(session):
+            discount_code = await session.scalar(select(DiscountCode).filter_by(code=code.upper()))
+            if discount_code:
+                discount_code.used_count += 1
+
+        try:
+            await self._write(write)
+        except Exception as e:
+            print(f"Error using discount code: {e}")
+
+    # Logging methods
+    async def log_system(self, level, module, message, details=None):
+        self.logs.add(
+            SystemLog,
+            level=level,
+            module=module,
+            message=message,
+            details=json.dumps(details) if details else None,
+            created_at=datetime.utcnow()
+        )
+
+    async def log_error(self, error_type, error_message, traceback, user_id=None):
+        self.logs.add(
+            ErrorLog,
+            error_type=error_type,
+            error_message=error_message,
+            traceback=traceback,
+            user_id=user_id,
+            created_at=datetime.utcnow()
+        )
+
+    # Broadcast methods
+    async def create_broadcast_job(self, message, target, admin_id):
+        async def write(session):
+            job = BroadcastJob(message=message, target=target, admin_id=admin_id)
+            session.add(job)
+            await session.flush()
+            return job
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error creating broadcast job: {e}")
+            return None
+
+    async def get_running_broadcast_jobs(self):
+        async with self.Session() as session:
+            try:
+                return (await session.scalars(
+                    select(BroadcastJob).filter_by(status='running').order_by(BroadcastJob.id)
+                )).all()
+            except Exception as e:
+                print(f"Error getting broadcast jobs: {e}")
+                return []
+
+    async def record_broadcast_delivery(self, job_id, user_id):
+        async def write(session):
+            session.add(BroadcastDelivery(job_id=job_id, user_id=user_id))
+
+        try:
+            await self._write(write)
+        except Exception as e:
+            print(f"Error recording broadcast delivery: {e}")
+
+    async def checkpoint_broadcast_job(self, job_id, last_user_id, sent, failed):
+        """Save progress; deliveries at or below the checkpoint are no longer needed"""
+        async def write(session):
+            await session.execute(
+                update(BroadcastJob).where(BroadcastJob.id == job_id)
+                .values(last_user_id=last_user_id, sent=sent, failed=failed)
+            )
+            await session.execute(delete(BroadcastDelivery).where(
+                BroadcastDelivery.job_id == job_id,
+                BroadcastDelivery.user_id <= last_user_id
+            ))
+
+        try:
+            await self._write(write)
+        except Exception as e:
+            print(f"Error checkpointing broadcast job: {e}")
+
+    async def finish_broadcast_job(self, job_id, status):
+        """Mark a running job completed or cancelled. Returns False if it was not running."""
+        async def write(session):
+            result = await session.execute(
+                update(BroadcastJob).where(BroadcastJob.id == job_id, BroadcastJob.status == 'running')
+                .values(status=status, finished_at=datetime.utcnow())
+            )
+            await session.execute(delete(BroadcastDelivery).where(BroadcastDelivery.job_id == job_id))
+            return result.rowcount > 0
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error finishing broadcast job: {e}")
+            return False
+
+    # Provisioning methods
+    async def get_due_provisioning_jobs(self, limit, exclude=()):
+        """Pending jobs whose next attempt is due, with what is needed to create the account"""
+        async with self.Session() as session:
+            try:
+                return (await session.execute(select(
+                    ProvisioningJob.id, ProvisioningJob.attempts, UserService.marzban_username,
+                    UserService.expire_date, UserService.data_limit, Service.name, Service.inbound_id,
+                    User.telegram_id
+                ).join(UserService, UserService.id == ProvisioningJob.user_service_id).join(
+                    Service, Service.id == UserService.service_id
+                ).join(User, User.id == UserService.user_id).where(
+                    ProvisioningJob.status == 'pending',
+                    ProvisioningJob.next_attempt_at <= datetime.utcnow(),
+                    ProvisioningJob.id.not_in(exclude)
+                ).order_by(ProvisioningJob.next_attempt_at).limit(limit))).all()
+            except Exception as e:
+                print(f"Error getting provisioning jobs: {e}")
+                return []
+
+    async def get_next_provisioning_time(self):
+        async with self.Session() as session:
+            try:
+                return await session.scalar(
+                    select(func.min(ProvisioningJob.next_attempt_at)).filter_by(status='pending')
+                )
+            except Exception as e:
+                print(f"Error getting next provisioning time: {e}")
+                return None
+
+    async def finish_provisioning_job(self, job_id, status, error=None):
+        async def write(session):
+            await session.execute(
+                update(ProvisioningJob).where(ProvisioningJob.id == job_id)
+                .values(status=status, last_error=error, finished_at=datetime.utcnow())
+            )
+
+        try:
+            await self._write(write)
+        except Exception as e:
+            print(f"Error finishing provisioning job: {e}")
+
+    async def refund_provisioning_job(self, job_id, error):
+        """Give up on a pending job: mark it failed, deactivate its user service and
+        refund the purchase that created it to the wallet, in one commit.
+
+        Returns the refunded amount, 0 if there was nothing to refund, or None on error.
+        """
+        refunded = {}
+
+        async def write(session):
+            job = await session.get(ProvisioningJob, job_id)
+            if job is None or job.status != 'pending':
+                return 0
+            job.status = 'failed'
+            job.last_error = error
+            job.finished_at = datetime.utcnow()
+
+            user_service = await session.get(UserService, job.user_service_id)
+            user_service.is_active = False
+            # The purchase is committed with the job, so it is the newest one not after it
+            purchase = await session.scalar(
+                select(Transaction).where(
+                    Transaction.user_id == user_service.user_id,
+                    Transaction.service_id == user_service.service_id,
+                    Transaction.type == 'purchase',
+                    Transaction.status == 'completed',
+                    Transaction.created_at <= job.created_at
+                ).order_by(Transaction.created_at.desc(), Transaction.id.desc()).limit(1)
+            )
+            if purchase is None:
+                return 0
+
+            await set_transaction_status(session, purchase, 'refunded')
+            await add_transaction(session, Transaction(
+                user_id=purchase.user_id,
+                amount=purchase.amount,
+                type='refund',
+                status='completed',
+                service_id=purchase.service_id
+            ))
+            refunded['telegram_id'] = await session.scalar(
+                update(User).where(User.id == purchase.user_id)
+                .values(wallet_balance=User.wallet_balance + purchase.amount)
+                .returning(User.telegram_id)
+            )
+            refunded['user_id'] = purchase.user_id
+            return purchase.amount
+
+        try:
+            return await self._write(write)
+        except Exception as e:
+            print(f"Error refunding provisioning job: {e}")
+            return None
+        finally:
+            if refunded:
+                self.users.invalidate(refunded['telegram_id'])
+                self.cache_manager.invalidate('reports')
+                self.cache_manager.invalidate_tag(f"user:{refunded['user_id']}")
+
+    async def retry_provisioning_job(self, job_id, attempts, next_attempt_at, error):
+        async def write(session):
+            await session.execute(
+                update(ProvisioningJob).where(ProvisioningJob.id == job_id)
+                .values(attempts=attempts, next_attempt_at=next_attempt_at, last_error=error)
+            )
+
+        try:
+            await self._write(write)
+        except Exception as e:
+            print(f"Error rescheduling provisioning job: {e}")
+
+    # Report methods
+    @cached('reports', ttl=CACHE_SETTINGS['report_expire_time'])
+    async def get_sales_totals(self, start_date, end_date):
+        """(count, total) of completed purchases between two dates, both inclusive"""
+        async with self.Session() as session:
+            try:
+                return tuple((await session.execute(sales_totals_query(start_date, end_date))).one())
+            except Exception as e:
+                print(f"Error getting sales totals: {e}")
+                return (0, 0)
+
+    @cached('reports', ttl=CACHE_SETTINGS['report_expire_time'])
+    async def get_popular_services(self, period_start, period_end, limit=5):
+        """[(service name, sales count), ...] best sellers first"""
+        async with self.Session() as session:
+            try:
+                result = await session.execute(popular_services_query(period_start, period_end, limit))
+                return [tuple(row) for row in result]
+            except Exception as e:
+                print(f"Error getting popular services: {e}")
+                return []
+
+    @cached('reports', ttl=CACHE_SETTINGS['report_expire_time'])
+    async def get_sales_summary(self, today):
+        """(count, total) of completed purchases for each SALES_REPORT_WINDOWS window"""
+        async with self.Session() as session:
+            try:
+                row = (await session.execute(sales_summary_query(today))).one()
+                return tuple(zip(row[0::2], row[1::2]))
+            except Exception as e:
+                print(f"Error getting sales summary: {e}")
+                return tuple((0, 0) for _ in SALES_REPORT_WINDOWS)
+
+    # Additional methods
+    async def get_user_by_id(self, user_id: int):
+        async with self.Session() as session:
+            try:
+                return await session.get(User, user_id)
+            except Exception as e:
+                print(f"Error getting user by ID: {e}")
+                return None
+
+    @cached('services', ttl=CACHE_SETTINGS['service_expire_time'], key='{service_id}')
+    async def get_service_by_id(self, service_id: int):
+        async with self.Session() as session:
+            try:
+                return service_entry(await session.get(Service, service_id))
+            except Exception as e:
+                print(f"Error getting service by ID: {e}")
+                return None
@@ -1,15 +1,211 @@
-from database import Base, User, Service, UserService, Transaction, DiscountCode, SystemLog, ErrorLog, Report, Backup
-from sqlalchemy import create_engine
+from database import Base, User, Service, UserService, Transaction, DiscountCode, SystemLog, ErrorLog, Backup, SalesDailyRollup, BroadcastJob, BroadcastDelivery, ProvisioningJob, apply_sqlite_profile, backfill_sales_rollup
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import Session
+from datetime import date, datetime
 from config import DATABASE_URL, ADMIN_ID, SERVICE_TEMPLATES
 
+
+def _create_indexes(conn, *names):
+    """Create model-declared indexes that an older database is missing"""
+    indexes = {index.name: index for table in Base.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+
+def _add_column(conn, table, column, ddl):
+    """ALTER TABLE ADD COLUMN unless create_all already made the column"""
+    existing = {row.name for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _migration_001_hot_path_indexes(conn):
+    _create_indexes(
+        conn,
+        'ix_users_created_at',
+        'ix_user_services_user_active',
+        'ix_user_services_active_expire',
+        'ix_transactions_type_status_created',
+        'ix_transactions_status_created',
+        'ix_transactions_user_id',
+    )
+
+
+def _migration_002_sales_daily_rollup(conn):
+    SalesDailyRollup.__table__.create(conn, checkfirst=True)
+    backfill_sales_rollup(conn)
+
+
+def _migration_003_transaction_service_id(conn):
+    _add_column(conn, 'transactions', 'service_id', 'INTEGER REFERENCES services (id)')
+
+    # Purchases were written right before their user_service row, so match each
+    # one to the same user's first service created within the following minute
+    conn.execute(text(
+        "UPDATE transactions SET service_id = ("
+        "  SELECT user_services.service_id FROM user_services"
+        "  WHERE user_services.user_id = transactions.user_id"
+        "    AND user_services.created_at >= transactions.created_at"
+        "    AND (julianday(user_services.created_at) - julianday(transactions.created_at)) * 86400 <= 60"
+        "  ORDER BY user_services.created_at"
+        "  LIMIT 1"
+        ") WHERE type = 'purchase' AND service_id IS NULL"
+    ))
+
+
+def _migration_004_broadcast_jobs(conn):
+    BroadcastJob.__table__.create(conn, checkfirst=True)
+    BroadcastDelivery.__table__.create(conn, checkfirst=True)
+
+
+def _migration_005_expiry_notified_days(conn):
+    _add_column(conn, 'user_services', 'expiry_notified_days', 'INTEGER')
+
+
+def _migration_006_data_notified_percent(conn):
+    _add_column(conn, 'user_services', 'data_notified_percent', 'INTEGER')
+
+
+def _migration_007_provisioning_jobs(conn):
+    ProvisioningJob.__table__.create(conn, checkfirst=True)
+
+
+def _migration_008_data_limit_mb(conn):
+    # Purchases stored the service's GB figure while usage sync writes MB. Any
+    # limit under 1024 is a GB value (no plan is under 1 GB or over 1 TB);
+    # larger ones were already rewritten in MB from the panel.
+    conn.execute(text(
+        "UPDATE user_services SET data_limit = data_limit * 1024 "
+        "WHERE data_limit > 0 AND data_limit < 1024"
+    ))
+
+
+# (version, name, migrate) - append only, never renumber
+MIGRATIONS = [
+    (1, "hot path indexes", _migration_001_hot_path_indexes),
+    (2, "sales daily rollup", _migration_002_sales_daily_rollup),
+    (3, "transaction service id", _migration_003_transaction_service_id),
+    (4, "broadcast jobs", _migration_004_broadcast_jobs),
+    (5, "expiry notified days", _migration_005_expiry_notified_days),
+    (6, "data notified percent", _migration_006_data_notified_percent),
+    (7, "provisioning jobs", _migration_007_provisioning_jobs),
+    (8, "user service data limit in MB", _migration_008_data_limit_mb),
+]
+
+# Queries on the request path, checked against their index with EXPLAIN QUERY PLAN
+HOT_QUERIES = {
+    "get_user": (
+        "SELECT * FROM users WHERE telegram_id = :telegram_id",
+        {"telegram_id": 0}
+    ),
+    "get_user_active_services": (
+        "SELECT * FROM user_services JOIN services ON services.id = user_services.service_id "
+        "WHERE user_services.user_id = :user_id AND user_services.is_active = 1",
+        {"user_id": 0}
+    ),
+    "sales_report": (
+        "SELECT sum(count), sum(total) FROM sales_daily_rollup "
+        "WHERE type = 'purchase' AND status = 'completed' AND date >= :since",
+        {"since": date(2000, 1, 1)}
+    ),
+    "popular_services": (
+        "SELECT services.name, count(transactions.id) AS sales FROM transactions "
+        "JOIN services ON services.id = transactions.service_id "
+        "WHERE transactions.type = 'purchase' AND transactions.status = 'completed' "
+        "AND transactions.created_at >= :start AND transactions.created_at < :end "
+        "GROUP BY services.id ORDER BY sales DESC LIMIT 5",
+        {"start": datetime(2000, 1, 1), "end": datetime(2000, 1, 2)}
+    ),
+    "new_users": (
+        "SELECT count(*) FROM users WHERE created_at BETWEEN :start AND :end",
+        {"start": datetime(2000, 1, 1), "end": datetime(2000, 1, 2)}
+    ),
+    "expiry_scheduler_load": (
+        "SELECT id, expire_date, expiry_notified_days FROM user_services "
+        "WHERE is_active = 1 AND expire_date > :now "
+        "AND (expiry_notified_days IS NULL OR expiry_notified_days > 1)",
+        {"now": datetime(2000, 1, 1)}
+    ),
+    "low_data_services": (
+        "SELECT id FROM user_services "
+        "WHERE is_active = 1 AND id > :after_id AND data_limit > 0 "
+        "AND coalesce(data_used, 0) * 100 >= data_limit * 80 ORDER BY id LIMIT 500",
+        {"after_id": 0}
+    ),
+    "provisioning_due": (
+        "SELECT id FROM provisioning_jobs WHERE status = 'pending' AND next_attempt_at <= :now "
+        "ORDER BY next_attempt_at LIMIT 5",
+        {"now": datetime(2000, 1, 1)}
+    ),
+    "cleanup_expired_users": (
+        "SELECT id, marzban_username FROM user_services "
+        "WHERE is_active = 0 AND expire_date < :before AND id > :after_id ORDER BY id LIMIT 200",
+        {"before": datetime(2000, 1, 1), "after_id": 0}
+    ),
+    "pending_transactions": (
+        "SELECT * FROM transactions WHERE status = 'pending' "
+        "AND created_at <= :created_at AND (created_at < :created_at OR (created_at = :created_at AND id < :id)) "
+        "ORDER BY created_at DESC, id DESC LIMIT 11",
+        {"created_at": datetime(2000, 1, 1), "id": 0}
+    ),
+}
+
+
+def run_migrations(engine):
+    """Apply pending migrations, each in its own transaction. Returns the applied versions."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)"
+        ))
+        applied = set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+    newly_applied = []
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+                {"version": version, "name": name, "applied_at": datetime.utcnow()}
+            )
+        newly_applied.append(version)
+    return newly_applied
+
+
+def migrate_database(db_url):
+    """Create missing tables and apply pending migrations. Returns the applied versions."""
+    engine = create_engine(db_url)
+    try:
+        apply_sqlite_profile(engine)
+        Base.metadata.create_all(engine)
+        return run_migrations(engine)
+    finally:
+        engine.dispose()
+
+
+def explain_hot_queries(engine):
+    """Print the SQLite query plan of every hot query"""
+    with engine.connect() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            print(f"🔎 {name}")
+            for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"), params):
+                print(f"   {row.detail}")
+
+
 def init_database():
     """Initialize database and create default data"""
     engine = create_engine(DATABASE_URL)
+    apply_sqlite_profile(engine)
     Base.metadata.create_all(engine)
-    
+
     print("✅ Database tables created successfully!")
-    
+
+    for version in run_migrations(engine):
+        print(f"✅ Migration {version:03d} applied successfully!")
+    explain_hot_queries(engine)
+
     # Create admin user
     try:
         with Session(engine) as session:
@@ -23,7 +219,7 @@ def init_database():
             print("✅ Admin user created successfully!")
     except Exception as e:
         print(f"❌ Error creating admin user: {e}")
-    
+
     # Create default services
     try:
         with Session(engine) as session:
@@ -38,4 +234,4 @@ def init_database():
 if __name__ == "__main__":
     print("Initializing database...")
     init_database()
-    print("Done!") 
\ No newline at end of file
+    print("Done!")
@@ -1,9 +1,13 @@
+import argparse
 import os
 import shutil
+import sys
 from datetime import datetime, timedelta
 import logging
+from sqlalchemy import create_engine
 from config import *
 from advanced_config import CLEANUP_SETTINGS
+from database import apply_sqlite_profile, backfill_sales_rollup, check_sales_rollup
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -41,15 +45,56 @@ def check_disk_space():
         logger.warning(f"High disk usage: {percent_used:.1f}%")
         # Could send notification to admin here
 
-def main():
+def _engine():
+    engine = create_engine(DATABASE_URL)
+    apply_sqlite_profile(engine)
+    return engine
+
+def rollup_backfill():
+    """Rebuild the daily sales rollup from raw transactions"""
+    with _engine().begin() as conn:
+        backfill_sales_rollup(conn)
+    logger.info("Sales rollup rebuilt from transactions")
+    return True
+
+def rollup_check():
+    """Verify the daily sales rollup against raw transactions"""
+    with _engine().connect() as conn:
+        mismatches = check_sales_rollup(conn)
+
+    for key, expected, actual in mismatches:
+        logger.warning(f"Rollup mismatch for {key}: transactions={expected}, rollup={actual}")
+    if mismatches:
+        logger.warning(f"{len(mismatches)} rollup rows out of sync, run 'rollup-backfill' to rebuild")
+    else:
+        logger.info("Sales rollup is consistent with transactions")
+    return not mismatches
+
+def run_maintenance():
     """Run maintenance tasks"""
     try:
         logger.info("Starting maintenance tasks...")
         cleanup_old_files()
         check_disk_space()
         logger.info("Maintenance tasks completed successfully!")
+        return True
     except Exception as e:
         logger.error(f"Error during maintenance: {e}")
+        return False
+
+TASKS = {
+    'cleanup': run_maintenance,
+    'rollup-backfill': rollup_backfill,
+    'rollup-check': rollup_check,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run maintenance tasks")
+    parser.add_argument('task', nargs='?', default='cleanup', choices=list(TASKS))
+    args = parser.parse_args()
+
+    if not TASKS[args.task]():
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
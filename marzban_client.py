@@ -0,0 +1,321 @@
+import asyncio
+import base64
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout, TCPConnector
+
+from advanced_config import MARZBAN_CLIENT_SETTINGS, PERFORMANCE_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+
+def token_expiry(token: str) -> Optional[float]:
+    """The `exp` claim of a JWT (unverified, only used to schedule the refresh)"""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+UNAUTHORIZED = object()
+
+
+class PanelUnavailable(Exception):
+    """The circuit to the Marzban panel is open; calls fail fast until it recovers"""
+
+
+class CircuitBreaker:
+    """closed -> open after failure_threshold consecutive failures; open -> half-open
+    after reset_timeout, letting one trial call through; its outcome closes or reopens."""
+
+    def __init__(self, failure_threshold: int = MARZBAN_CLIENT_SETTINGS['failure_threshold'],
+                 reset_timeout: float = MARZBAN_CLIENT_SETTINGS['reset_timeout']):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+
+    def before_call(self):
+        if self.state == 'open':
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise PanelUnavailable("Marzban panel unavailable")
+            self.state = 'half-open'
+        if self.state == 'half-open':
+            if self.trial_running:
+                raise PanelUnavailable("Marzban panel unavailable")
+            self.trial_running = True
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_running = False
+        if self.state == 'half-open' or self.failures >= self.failure_threshold:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+
+class LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class MarzbanClient:
+    """Async client for the parts of the Marzban REST API the bot uses.
+
+    One keep-alive ClientSession (pooled connector, cached DNS) is shared by
+    every call. The JWT is reused until shortly before its `exp`; when it
+    has to be renewed, concurrent callers wait on a single login. A 401 is
+    retried once with a fresh token. Latency is recorded per endpoint.
+
+    Every call passes a CircuitBreaker, so a dead panel costs one timeout per
+    reset_timeout instead of one per click (PanelUnavailable meanwhile).
+    Identical concurrent GETs share one in-flight request; callers must
+    treat the returned JSON as read-only.
+    """
+
+    def __init__(self, url: str, username: str, password: str,
+                 timeout: float = PERFORMANCE_SETTINGS['request_timeout']):
+        self.url = url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = ClientTimeout(total=timeout)
+        self.session: Optional[ClientSession] = None
+        self.token: Optional[str] = None
+        self.token_expires_at = 0.0
+        self.token_lock = asyncio.Lock()
+        self.calls = 0
+        self.logins = 0
+        self.latency: Dict[str, LatencyStats] = {}
+        self.breaker = CircuitBreaker()
+        self.inflight: Dict[tuple, asyncio.Future] = {}
+
+    def _session(self) -> ClientSession:
+        if self.session is None or self.session.closed:
+            connector = TCPConnector(
+                limit=PERFORMANCE_SETTINGS['connection_pool_size'],
+                ttl_dns_cache=MARZBAN_CLIENT_SETTINGS['dns_cache_ttl'],
+                keepalive_timeout=MARZBAN_CLIENT_SETTINGS['keepalive_timeout']
+            )
+            self.session = ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _record(self, endpoint: str, started: float):
+        self.latency.setdefault(endpoint, LatencyStats()).record(time.perf_counter() - started)
+
+    async def _guarded(self, call):
+        """Run one HTTP call through the circuit breaker"""
+        self.breaker.before_call()
+        try:
+            result = await call()
+        except ClientResponseError as e:
+            # 4xx means the panel is up and answering
+            if e.status >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            raise
+        except (ClientError, asyncio.TimeoutError):
+            self.breaker.record_failure()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.trial_running = False
+            raise
+        except Exception:
+            # e.g. a malformed body; never leave a half-open trial marked as running
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def get_token(self) -> str:
+        """Log in and cache the token until shortly before it expires"""
+        async def login():
+            async with self._session().post(
+                f"{self.url}/api/admin/token",
+                data={'username': self.username, 'password': self.password}
+            ) as response:
+                response.raise_for_status()
+                return (await response.json())['access_token']
+
+        self.calls += 1
+        self.logins += 1
+        started = time.perf_counter()
+        try:
+            token = await self._guarded(login)
+        finally:
+            self._record('POST /api/admin/token', started)
+
+        expires_at = token_expiry(token) or time.time() + MARZBAN_CLIENT_SETTINGS['default_token_ttl']
+        self.token = token
+        self.token_expires_at = expires_at - MARZBAN_CLIENT_SETTINGS['token_refresh_margin']
+        return token
+
+    async def _refresh_token(self, stale: Optional[str]) -> str:
+        async with self.token_lock:
+            # Someone else logged in while we waited for the lock
+            if self.token is not None and self.token != stale and time.time() < self.token_expires_at:
+                return self.token
+            return await self.get_token()
+
+    async def _valid_token(self) -> str:
+        if self.token is not None and time.time() < self.token_expires_at:
+            return self.token
+        return await self._refresh_token(self.token)
+
+    async def request(self, method: str, path: str, endpoint: Optional[str] = None, **kwargs) -> Any:
+        if method != 'GET':
+            return await self._request(method, path, endpoint, **kwargs)
+
+        key = (path, tuple(sorted((kwargs.get('params') or {}).items())))
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._request(method, path, endpoint, **kwargs))
+            self.inflight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # One caller giving up must not cancel the request for the others
+        return await asyncio.shield(future)
+
+    def _forget(self, key: tuple, future: asyncio.Future):
+        self.inflight.pop(key, None)
+        if not future.cancelled():
+            future.exception()  # retrieved, even if every waiter was cancelled
+
+    async def _request(self, method: str, path: str, endpoint: Optional[str] = None, **kwargs) -> Any:
+        endpoint = endpoint or f"{method} {path}"
+        token = await self._valid_token()
+        for attempt in range(2):
+            async def call():
+                async with self._session().request(
+                    method,
+                    f"{self.url}{path}",
+                    headers={'Authorization': f"Bearer {token}"},
+                    **kwargs
+                ) as response:
+                    if response.status == 401 and attempt == 0:
+                        return UNAUTHORIZED
+                    response.raise_for_status()
+                    return await response.json()
+
+            self.calls += 1
+            started = time.perf_counter()
+            try:
+                result = await self._guarded(call)
+            finally:
+                self._record(endpoint, started)
+            if result is UNAUTHORIZED:
+                token = await self._refresh_token(token)
+                continue
+            return result
+
+    async def get_system(self) -> Dict[str, Any]:
+        return await self.request('GET', '/api/system')
+
+    async def get_users(self, offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+        """One page of panel users: {'users': [...], 'total': n}"""
+        return await self.request('GET', '/api/users', params={'offset': offset, 'limit': limit})
+
+    async def create_user(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.request('POST', '/api/user', json=data)
+
+    async def delete_user(self, username: str) -> Dict[str, Any]:
+        return await self.request('DELETE', f'/api/user/{username}', endpoint='DELETE /api/user/{username}')
+
+    async def get_inbounds(self) -> List[Dict[str, Any]]:
+        inbounds = await self.request('GET', '/api/inbounds')
+        if isinstance(inbounds, dict):
+            # Grouped by protocol
+            return [inbound for group in inbounds.values() for inbound in group]
+        return inbounds
+
+    async def get_inbound(self, inbound_id: int) -> Dict[str, Any]:
+        return await self.request('GET', f'/api/inbound/{inbound_id}', endpoint='GET /api/inbound/{id}')
+
+    async def update_inbound(self, inbound_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.request('PUT', f'/api/inbound/{inbound_id}', endpoint='PUT /api/inbound/{id}', json=data)
+
+
+class InboundRegistry:
+    """Inbound definitions from the panel, cached by id.
+
+    Inbounds almost never change, so the whole list is loaded once and
+    reused for `ttl` seconds; run_forever() reloads it in the background
+    well before that, keeping admin navigation off the network. Updates go
+    to the panel and then straight into the cached entry. If a reload
+    fails the previous copy keeps being served.
+    """
+
+    def __init__(self, client: MarzbanClient,
+                 ttl: float = MARZBAN_CLIENT_SETTINGS['inbound_cache_ttl'],
+                 refresh_interval: float = MARZBAN_CLIENT_SETTINGS['inbound_refresh_interval']):
+        self.client = client
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.inbounds: Dict[int, Dict[str, Any]] = {}
+        self.loaded_at: Optional[float] = None
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Inbound refresh failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def refresh(self) -> Dict[int, Dict[str, Any]]:
+        inbounds = await self.client.get_inbounds()
+        self.inbounds = {inbound['id']: inbound for inbound in inbounds}
+        self.loaded_at = time.monotonic()
+        return self.inbounds
+
+    async def _current(self) -> Dict[int, Dict[str, Any]]:
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl:
+            return self.inbounds
+        try:
+            return await self.refresh()
+        except Exception:
+            if self.loaded_at is None:
+                raise
+            logger.warning("Serving stale inbounds, the panel could not be reached")
+            return self.inbounds
+
+    async def all(self) -> List[Dict[str, Any]]:
+        return list((await self._current()).values())
+
+    async def get(self, inbound_id: int) -> Optional[Dict[str, Any]]:
+        return (await self._current()).get(inbound_id)
+
+    async def exists(self, inbound_id: int) -> bool:
+        return inbound_id in await self._current()
+
+    async def update(self, inbound_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Write to the panel, then into the cache"""
+        await self.client.update_inbound(inbound_id, data)
+        inbound = {**self.inbounds.get(inbound_id, {'id': inbound_id}), **data}
+        self.inbounds[inbound_id] = inbound
+        return inbound
@@ -0,0 +1,88 @@
+from types import MappingProxyType
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+DEFAULT_LOCALE = 'fa'
+ROLES = ('user', 'admin')
+
+WALLET_CHARGE_AMOUNTS = (50000, 100000, 200000, 500000)
+
+# menu -> (roles it is shown to, rows of (text, callback_data[, only for this role]))
+MENU_LAYOUTS = {
+    'fa': {
+        'main': (ROLES, [
+            [("🛒 خرید سرویس", 'buy_service')],
+            [("👤 حساب کاربری", 'user_account')],
+            [("📊 اطلاعات سرویس", 'service_info')],
+            [("⚙️ پنل مدیریت", 'admin_panel', 'admin')],
+        ]),
+        'account': (ROLES, [
+            [("💰 شارژ کیف پول", 'charge_wallet')],
+            [("🔄 تمدید سرویس", 'extend_service')],
+            [("🔙 بازگشت", 'back_to_main')],
+        ]),
+        'wallet_charge': (ROLES, [
+            *([(f"💰 {amount:,} تومان", f'charge_{amount}')] for amount in WALLET_CHARGE_AMOUNTS),
+            [("🔙 بازگشت", 'back_to_main')],
+        ]),
+        'admin_panel': (('admin',), [
+            [("📊 گزارش فروش", 'admin_sales_report')],
+            [("👥 مدیریت کاربران", 'admin_users')],
+            [("🎁 کد تخفیف", 'admin_discount_codes')],
+            [("📨 ارسال پیام همگانی", 'admin_broadcast')],
+            [("⚙️ تنظیمات سرویس‌ها", 'admin_services')],
+            [("🔙 بازگشت", 'back_to_main')],
+        ]),
+        'manage_services': (('admin',), [
+            [("➕ افزودن سرویس", 'add_service')],
+            [("📝 ویرایش سرویس‌ها", 'edit_services')],
+            [("🔄 تنظیمات تمدید", 'renewal_settings')],
+            [("⚙️ تنظیمات اینباند", 'inbound_settings')],
+            [("🔙 بازگشت", 'admin_panel')],
+        ]),
+        'detailed_report': (('admin',), [
+            [("📊 گزارش روزانه", 'report_daily')],
+            [("📈 گزارش هفتگی", 'report_weekly')],
+            [("📉 گزارش ماهانه", 'report_monthly')],
+            [("🗓 گزارش سفارشی", 'report_custom')],
+            [("💾 ذخیره گزارش", 'save_report')],
+            [("🔙 بازگشت", 'admin_panel')],
+        ]),
+    },
+}
+
+
+def build_markup(rows, role: str) -> InlineKeyboardMarkup:
+    keyboard = []
+    for row in rows:
+        buttons = [
+            InlineKeyboardButton(text, callback_data=data)
+            for text, data, *only in row
+            if not only or only[0] == role
+        ]
+        if buttons:
+            keyboard.append(buttons)
+    return InlineKeyboardMarkup(keyboard)
+
+
+class MenuRegistry:
+    """Static menus built once, keyed by (menu, role, locale).
+
+    InlineKeyboardMarkup is frozen after construction, so one instance is
+    safely shared by every update. Unknown locales fall back to
+    DEFAULT_LOCALE.
+    """
+
+    def __init__(self, layouts=MENU_LAYOUTS):
+        markups = {}
+        for locale, menus in layouts.items():
+            for name, (roles, rows) in menus.items():
+                for role in roles:
+                    markups[(name, role, locale)] = build_markup(rows, role)
+        self.markups = MappingProxyType(markups)
+
+    def get(self, name: str, role: str = 'user', locale: str = DEFAULT_LOCALE) -> InlineKeyboardMarkup:
+        markup = self.markups.get((name, role, locale))
+        if markup is None:
+            markup = self.markups[(name, role, DEFAULT_LOCALE)]
+        return markup
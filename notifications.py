@@ -0,0 +1,198 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import case, func, or_, select
+
+from advanced_config import NOTIFICATION_SETTINGS
+from database import Service, User, UserService
+from optimizations import SendRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def next_expiry_reminder(expire_date: datetime, notified_days: Optional[int], thresholds: List[int], now: datetime):
+    """(fire_at, days) of the next reminder a service is owed, or None.
+
+    A reminder for `days` fires once at expire_date - days. When several
+    thresholds are already past (e.g. a 2 day service and 7/3 day warnings)
+    only the most urgent one is sent.
+    """
+    if expire_date is None or expire_date <= now:
+        return None
+    pending = [days for days in thresholds if notified_days is None or days < notified_days]
+    if not pending:
+        return None
+
+    due = [days for days in pending if expire_date - timedelta(days=days) <= now]
+    if due:
+        return now, min(due)
+    days = max(pending)
+    return expire_date - timedelta(days=days), days
+
+
+class ExpiryScheduler:
+    """Sends each expiry warning once, when it is due, instead of rescanning hourly.
+
+    Upcoming reminders sit in a min-heap of (fire_at, user_service_id); the
+    task sleeps until the earliest one. On wakeup the row is re-read, so a
+    stale heap entry (service renewed, deactivated, already warned) is
+    simply rescheduled or dropped. The notified threshold is stored in
+    user_services.expiry_notified_days and claimed before sending, so a
+    restart never repeats a warning; a send that fails is not retried, but
+    the next threshold is still scheduled.
+    """
+
+    def __init__(self, db, limiter: SendRateLimiter,
+                 thresholds: List[int] = NOTIFICATION_SETTINGS['expire_warning_days'],
+                 max_sleep: float = 86400):
+        self.db = db
+        self.limiter = limiter
+        self.thresholds = sorted(thresholds, reverse=True)
+        self.max_sleep = max_sleep
+        self.heap = []
+        self.wakeup = asyncio.Event()
+        self.sent = 0
+
+    def push(self, user_service_id: int, expire_date: datetime, notified_days: Optional[int] = None):
+        reminder = next_expiry_reminder(expire_date, notified_days, self.thresholds, datetime.utcnow())
+        if reminder is None:
+            return
+        fire_at, _ = reminder
+        first = not self.heap or fire_at < self.heap[0][0]
+        heapq.heappush(self.heap, (fire_at, user_service_id))
+        if first:
+            self.wakeup.set()
+
+    async def load(self):
+        """Schedule every active service that still has a warning to get"""
+        now = datetime.utcnow()
+        async with self.db.Session() as session:
+            rows = await session.execute(select(
+                UserService.id, UserService.expire_date, UserService.expiry_notified_days
+            ).where(
+                UserService.is_active == True,
+                UserService.expire_date > now,
+                or_(UserService.expiry_notified_days == None,
+                    UserService.expiry_notified_days > min(self.thresholds))
+            ))
+            for user_service_id, expire_date, notified_days in rows:
+                self.push(user_service_id, expire_date, notified_days)
+
+    async def run(self, bot):
+        await self.load()
+        while True:
+            self.wakeup.clear()
+            now = datetime.utcnow()
+            if self.heap and self.heap[0][0] <= now:
+                _, user_service_id = heapq.heappop(self.heap)
+                try:
+                    await self._fire(bot, user_service_id)
+                except Exception as e:
+                    logger.error(f"Failed to send expiry notification: {e}")
+                continue
+
+            timeout = self.max_sleep
+            if self.heap:
+                timeout = min(timeout, (self.heap[0][0] - now).total_seconds())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, bot, user_service_id: int):
+        async with self.db.Session() as session:
+            row = (await session.execute(select(
+                UserService.expire_date, UserService.is_active, UserService.expiry_notified_days,
+                User.telegram_id, Service.name
+            ).join(User, User.id == UserService.user_id).join(Service, Service.id == UserService.service_id).where(
+                UserService.id == user_service_id
+            ))).one_or_none()
+        if row is None or not row.is_active:
+            return
+
+        reminder = next_expiry_reminder(row.expire_date, row.expiry_notified_days, self.thresholds, datetime.utcnow())
+        if reminder is None:
+            return
+        fire_at, days = reminder
+        if fire_at > datetime.utcnow():
+            # Renewed or rescheduled since this entry was pushed
+            self.push(user_service_id, row.expire_date, row.expiry_notified_days)
+            return
+
+        try:
+            if await self.db.claim_expiry_reminder(user_service_id, days):
+                days_left = (row.expire_date - datetime.utcnow()).days
+                await self.limiter.acquire(row.telegram_id)
+                await bot.send_message(
+                    row.telegram_id,
+                    f"""
+⚠️ اخطار انقضای سرویس:
+سرویس {row.name} شما تا {days_left} روز دیگر منقضی می‌شود.
+برای تمدید سرویس از منوی اصلی اقدام کنید.
+                    """
+                )
+                self.sent += 1
+        except Exception as e:
+            logger.error(f"Failed to send expiry notification to {row.telegram_id}: {e}")
+        finally:
+            # A failed send costs this warning only, the later thresholds stay scheduled
+            self.push(user_service_id, row.expire_date, days)
+
+
+def low_data_services_query(thresholds: List[int], after_id: int = 0, limit: int = 500):
+    """Active services that crossed a data_warning_percent threshold they were not warned about.
+
+    The highest crossed threshold is computed in SQL, so only services owed
+    a warning leave the database, a page of `limit` at a time by id.
+    """
+    thresholds = sorted(thresholds, reverse=True)
+    used = func.coalesce(UserService.data_used, 0) * 100
+    crossed = case(
+        *((used >= UserService.data_limit * percent, percent) for percent in thresholds),
+        else_=0
+    ).label('percent')
+
+    return select(
+        UserService.id, UserService.data_limit, UserService.data_used, User.telegram_id, Service.name, crossed
+    ).join(User, User.id == UserService.user_id).join(Service, Service.id == UserService.service_id).where(
+        UserService.is_active == True,
+        UserService.id > after_id,
+        UserService.data_limit > 0,
+        used >= UserService.data_limit * min(thresholds),
+        crossed > func.coalesce(UserService.data_notified_percent, 0)
+    ).order_by(UserService.id).limit(limit)
+
+
+async def send_low_data_warnings(db, bot, limiter: SendRateLimiter,
+                                 thresholds: List[int] = NOTIFICATION_SETTINGS['data_warning_percent']) -> int:
+    """Warn every service owner whose usage crossed a new threshold. Returns the number sent."""
+    sent = 0
+    after_id = 0
+    while True:
+        async with db.Session() as session:
+            rows = (await session.execute(low_data_services_query(thresholds, after_id))).all()
+        if not rows:
+            return sent
+
+        for row in rows:
+            after_id = row.id
+            if not await db.claim_data_warning(row.id, row.percent):
+                continue
+            remaining_gb = (row.data_limit - (row.data_used or 0)) / 1024
+            try:
+                await limiter.acquire(row.telegram_id)
+                await bot.send_message(
+                    row.telegram_id,
+                    f"""
+⚠️ اخطار اتمام حجم:
+{row.percent}٪ از حجم سرویس {row.name} شما مصرف شده است.
+حجم باقیمانده: {remaining_gb:.1f} GB
+برای خرید حجم اضافه از منوی اصلی اقدام کنید.
+                    """
+                )
+                sent += 1
+            except Exception as e:
+                logger.error(f"Failed to send data limit notification: {e}")
@@ -1,7 +1,8 @@
 import asyncio
-from typing import Dict, Set
+import time
+from typing import Dict, Optional, Set
 from datetime import datetime, timedelta
-from advanced_config import PERFORMANCE_SETTINGS
+from advanced_config import BROADCAST_SETTINGS, PERFORMANCE_SETTINGS
 
 class RequestLimiter:
     def __init__(self):
@@ -45,6 +46,59 @@ class ConnectionPool:
         async with self.lock:
             self.pool.discard(identifier)
 
+class SendRateLimiter:
+    """Token bucket for Telegram's bot-wide send rate plus a per-chat minimum interval.
+
+    Waiters take tokens in arrival order. pause() stops every sender, which
+    is how a RetryAfter from Telegram is honoured.
+    """
+
+    def __init__(self, rate: float = BROADCAST_SETTINGS['global_rate'],
+                 per_chat_interval: float = BROADCAST_SETTINGS['per_chat_interval']):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.per_chat_interval = per_chat_interval
+        self.last_sent: Dict[int, float] = {}
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id: Optional[int] = None):
+        """Wait until a message may be sent (to chat_id, if given)"""
+        if chat_id is not None and chat_id in self.last_sent:
+            wait = self.last_sent[chat_id] + self.per_chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    wait = (1 - self.tokens) / self.rate
+                await asyncio.sleep(wait)
+
+        if chat_id is not None:
+            self._mark(chat_id, now)
+
+    def _mark(self, chat_id: int, now: float):
+        self.last_sent[chat_id] = now
+        if len(self.last_sent) > 10000:
+            # Only chats sent to within the interval still matter
+            self.last_sent = {
+                chat: sent for chat, sent in self.last_sent.items()
+                if now - sent < self.per_chat_interval
+            }
+
 class PerformanceOptimizer:
     def __init__(self):
         self.request_limiter = RequestLimiter()
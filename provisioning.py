@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import ClientResponseError
+
+from advanced_config import PROVISIONING_SETTINGS
+from marzban_client import InboundRegistry, MarzbanClient
+from optimizations import SendRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def provisioning_backoff(attempts: int, base: float = PROVISIONING_SETTINGS['backoff_base'],
+                         cap: float = PROVISIONING_SETTINGS['backoff_max']) -> float:
+    """Seconds to wait after the `attempts`-th failure"""
+    return min(cap, base * 2 ** (attempts - 1))
+
+
+class Provisioner:
+    """Creates the Marzban accounts of purchased services in the background.
+
+    Purchases only commit a provisioning_jobs row, so the buyer is answered
+    without waiting on the panel. Up to `concurrency` jobs are worked at
+    once; a failed attempt is retried with exponential backoff and the job
+    is given up after max_attempts. A panel that already has the username
+    (the account was created but the job not marked) counts as success.
+    The buyer is messaged when the account is ready.
+    """
+
+    def __init__(self, db, client: MarzbanClient, inbounds: InboundRegistry, limiter: SendRateLimiter,
+                 admin_id: int = None,
+                 concurrency: int = PROVISIONING_SETTINGS['concurrency'],
+                 max_attempts: int = PROVISIONING_SETTINGS['max_attempts'],
+                 backoff_base: float = PROVISIONING_SETTINGS['backoff_base'],
+                 backoff_max: float = PROVISIONING_SETTINGS['backoff_max'],
+                 poll_interval: float = PROVISIONING_SETTINGS['poll_interval']):
+        self.db = db
+        self.client = client
+        self.inbounds = inbounds
+        self.limiter = limiter
+        self.admin_id = admin_id
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.running = {}  # job id -> task
+        self.wakeup = asyncio.Event()
+        self.completed = 0
+        self.failed = 0
+
+    def notify(self):
+        """A job was queued, look for work now instead of at the next poll"""
+        self.wakeup.set()
+
+    async def run_forever(self, bot):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self._dispatch(bot)
+            except Exception as e:
+                logger.error(f"Provisioning dispatch failed: {e}")
+
+            timeout = self.poll_interval
+            next_attempt = await self.db.get_next_provisioning_time()
+            if next_attempt is not None:
+                timeout = min(timeout, max((next_attempt - datetime.utcnow()).total_seconds(), 0.1))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self, bot) -> int:
+        """Work every job that is due now and wait for them. Returns how many were tried."""
+        tasks = await self._dispatch(bot)
+        await asyncio.gather(*tasks)
+        return len(tasks)
+
+    async def _dispatch(self, bot):
+        free = self.concurrency - len(self.running)
+        if free <= 0:
+            return []
+        tasks = []
+        for job in await self.db.get_due_provisioning_jobs(free, exclude=list(self.running)):
+            task = asyncio.create_task(self._work(bot, job))
+            self.running[job.id] = task
+            task.add_done_callback(lambda _, job_id=job.id: self._done(job_id))
+            tasks.append(task)
+        return tasks
+
+    def _done(self, job_id: int):
+        self.running.pop(job_id, None)
+        # A worker slot is free again
+        self.wakeup.set()
+
+    async def _work(self, bot, job):
+        try:
+            account = await self._create_account(job)
+        except Exception as e:
+            await self._failed(bot, job, e)
+            return
+
+        await self.db.finish_provisioning_job(job.id, 'completed')
+        self.completed += 1
+        text = f"✅ حساب سرویس {job.name} آماده است.\n👤 نام کاربری: {job.marzban_username}"
+        if account.get('subscription_url'):
+            text += f"\n🔗 لینک اشتراک:\n{account['subscription_url']}"
+        await self._send(bot, job.telegram_id, text)
+
+    async def _create_account(self, job) -> dict:
+        inbound = await self.inbounds.get(job.inbound_id)
+        if inbound is None:
+            raise ValueError(f"inbound {job.inbound_id} not found on the panel")
+
+        try:
+            return await self.client.create_user({
+                'username': job.marzban_username,
+                'proxies': {inbound['protocol']: {}},
+                'inbounds': {inbound['protocol']: [inbound['tag']]},
+                'expire': int(job.expire_date.replace(tzinfo=timezone.utc).timestamp()),
+                'data_limit': (job.data_limit or 0) * 1024 * 1024,  # MB -> bytes
+            })
+        except ClientResponseError as e:
+            if e.status == 409:
+                # Created by an attempt that did not get to mark the job
+                return {}
+            raise
+
+    async def _failed(self, bot, job, error: Exception):
+        attempts = job.attempts + 1
+        if attempts < self.max_attempts:
+            delay = provisioning_backoff(attempts, self.backoff_base, self.backoff_max)
+            logger.warning(f"Provisioning {job.marzban_username} failed (attempt {attempts}), retrying in {delay}s: {error}")
+            await self.db.retry_provisioning_job(
+                job.id, attempts, datetime.utcnow() + timedelta(seconds=delay), str(error)
+            )
+            return
+
+        logger.error(f"Provisioning {job.marzban_username} failed after {attempts} attempts: {error}")
+        refunded = await self.db.refund_provisioning_job(job.id, str(error))
+        self.failed += 1
+        if refunded:
+            await self._send(bot, job.telegram_id,
+                             f"❌ ساخت حساب سرویس {job.name} با خطا مواجه شد. "
+                             f"مبلغ {refunded:,.0f} تومان به کیف پول شما بازگردانده شد.")
+        else:
+            await self._send(bot, job.telegram_id,
+                             f"❌ ساخت حساب سرویس {job.name} با خطا مواجه شد. لطفاً با پشتیبانی تماس بگیرید.")
+        if self.admin_id is not None:
+            refund_note = f"مبلغ بازگشتی: {refunded:,.0f} تومان" if refunded else "⚠️ مبلغی بازگردانده نشد"
+            await self._send(bot, self.admin_id,
+                             f"❌ ساخت حساب {job.marzban_username} پس از {attempts} تلاش ناموفق بود:\n{error}\n{refund_note}")
+
+    async def _send(self, bot, chat_id: int, text: str):
+        try:
+            await self.limiter.acquire(chat_id)
+            await bot.send_message(chat_id, text)
+        except Exception as e:
+            logger.error(f"Failed to send provisioning notice to {chat_id}: {e}")
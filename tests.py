@@ -1,15 +1,40 @@
 import unittest
 import asyncio
+import base64
+import json
+import os
+import tempfile
+import time
 from unittest.mock import Mock, patch
 from datetime import datetime, timedelta
-from bot import VPNBot
-from database import User, Service, UserService, Transaction
+from bot import CleanupManager, VPNBot
+from sqlalchemy import create_engine, inspect, select, text
+from database import (
+    Base, User, Service, UserService, Transaction, SystemLog, ProvisioningJob, BroadcastJob, BroadcastDelivery,
+    AsyncDatabase, KeysetPaginator, LogBuffer,
+    add_transaction, check_sales_rollup
+)
+from init_db import MIGRATIONS, migrate_database, run_migrations
+from broadcast import Broadcaster
+from notifications import ExpiryScheduler, next_expiry_reminder, send_low_data_warnings
+from optimizations import SendRateLimiter
+from provisioning import Provisioner
+from cache_manager import CacheManager, MemoryTier, cached
+from catalog import ServiceCatalog
+from menus import MenuRegistry
+from telegram.error import Forbidden, NetworkError, RetryAfter
+from aiohttp import ClientResponseError, web
+from aiohttp.test_utils import TestServer
+from marzban_client import CircuitBreaker, InboundRegistry, MarzbanClient, PanelUnavailable
+from usage_sync import MB, UsageSync
 from config import *
 
 class TestVPNBot(unittest.TestCase):
     def setUp(self):
         """Set up test environment"""
-        self.bot = VPNBot()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        with patch('bot.DATABASE_URL', f"sqlite:///{os.path.join(self.tmpdir.name, 'test.db')}"):
+            self.bot = VPNBot()
         self.loop = asyncio.get_event_loop()
         
     async def async_setup(self):
@@ -21,7 +46,7 @@ class TestVPNBot(unittest.TestCase):
         self.assertIsNotNone(self.bot.engine)
         self.assertIsNotNone(self.bot.marzban)
         
-    @patch('bot.VPNBot.create_marzban_user')
+    @patch('provisioning.Provisioner._create_account')
     async def test_service_purchase(self, mock_create_user):
         """Test service purchase flow"""
         # Mock data
@@ -58,6 +83,877 @@ class TestVPNBot(unittest.TestCase):
     def tearDown(self):
         """Clean up after tests"""
         self.loop.close()
+        self.tmpdir.cleanup()
+
+class TestAsyncDatabase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_url = f"sqlite:///{os.path.join(self.tmpdir.name, 'test.db')}"
+        migrate_database(db_url)
+        self.db = AsyncDatabase(db_url)
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        self.tmpdir.cleanup()
+
+    async def test_user_balance_flow(self):
+        """Test user creation and balance updates through the async layer"""
+        user_id = await self.db.create_user(telegram_id=123456, username="test")
+        self.assertTrue(await self.db.update_user_balance(123456, 50000))
+        self.assertFalse(await self.db.update_user_balance(123456, -100000))
+
+        user = await self.db.get_user(123456)
+        self.assertEqual(user.id, user_id)
+        self.assertEqual(user.wallet_balance, 50000)
+
+    async def test_user_cache(self):
+        """Test that get_user is served from the cache until a write invalidates it"""
+        await self.db.create_user(telegram_id=123456)
+        first = await self.db.get_user(123456)
+        self.assertIs(await self.db.get_user(123456), first)
+        self.assertEqual((self.db.users.hits, self.db.users.misses), (1, 1))
+
+        await self.db.update_user_balance(123456, 50000)
+        user = await self.db.get_user(123456)
+        self.assertEqual(user.wallet_balance, 50000)
+        self.assertEqual(self.db.users.misses, 2)
+        with self.assertRaises(AttributeError):
+            user.wallet_balance = 0
+
+    async def test_user_active_services(self):
+        """Test the joined active-services query"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        service_id = await self.db.create_service("Test Service", 100000, 30, 50)
+        await self.db.create_user_service(
+            user_id, service_id, "test_user", datetime.utcnow() + timedelta(days=30), 50
+        )
+
+        services = await self.db.get_user_active_services(user_id)
+        self.assertEqual(len(services), 1)
+        self.assertEqual(services[0].name, "Test Service")
+        self.assertEqual(services[0].data_used, 0)
+
+    async def test_purchase_service(self):
+        """Test that concurrent purchases never overdraw the wallet"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        await self.db.update_user_balance(123456, 150000)
+        service = await self.db.get_service(await self.db.create_service("Test Service", 100000, 30, 50))
+        await self.db.start()
+
+        results = await asyncio.gather(*(self.db.purchase_service(123456, service, "test_user") for _ in range(3)))
+        self.assertEqual(sorted(charged for _, charged in results), [False, False, True])
+        self.assertEqual((await self.db.get_user(123456)).wallet_balance, 50000)
+        self.assertEqual(len(await self.db.get_user_active_services(user_id)), 1)
+        self.assertEqual(await self.db.get_sales_totals(datetime.utcnow().date(), datetime.utcnow().date()), (1, 100000))
+
+    async def test_settle_deposit(self):
+        """Test that approving a deposit credits atomically alongside concurrent debits, once"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        await self.db.update_user_balance(123456, 100000)
+        service = await self.db.get_service(await self.db.create_service("Test Service", 100000, 30, 50))
+        deposit = await self.db.create_transaction(user_id, 50000, 'deposit')
+        await self.db.start()
+
+        settled, (_, charged), debited = await asyncio.gather(
+            self.db.settle_deposit(deposit, True),
+            self.db.purchase_service(123456, service),
+            self.db.update_user_balance(123456, -20000)
+        )
+        self.assertEqual((settled, charged, debited), ((123456, 50000), True, True))
+        self.assertEqual((await self.db.get_user(123456)).wallet_balance, 30000)
+        self.assertIsNone(await self.db.settle_deposit(deposit, False))
+
+    async def test_batched_writes(self):
+        """Test that concurrent writes share commits through the writer task"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        await self.db.start()
+
+        ids = await asyncio.gather(*(
+            self.db.create_transaction(user_id, 1000, 'deposit') for _ in range(50)
+        ))
+        self.assertEqual(len(set(ids)), 50)
+        self.assertLess(self.db.writer.commits, 50)
+
+        # A failing write must not take the rest of its batch down with it
+        results = await asyncio.gather(
+            self.db.create_user(telegram_id=123456),
+            self.db.create_transaction(user_id, 500, 'deposit')
+        )
+        self.assertIsNone(results[0])
+        self.assertIsNotNone(results[1])
+
+    async def test_writer_failure(self):
+        """Test that a dead writer fails its queued writes instead of leaving them waiting"""
+        await self.db.start()
+
+        async def broken(batch):
+            raise RuntimeError("rollback failed")
+
+        async def job(session):
+            return 1
+
+        with patch.object(self.db.writer, '_commit', broken):
+            results = await asyncio.wait_for(asyncio.gather(
+                *(self.db.writer.submit(job) for _ in range(3)), return_exceptions=True
+            ), 1)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertFalse(self.db.writer.running)
+        self.assertIsNotNone(await self.db.create_user(telegram_id=123456))  # falls back to direct commits
+
+    async def test_service_writes(self):
+        """Test the admin service edits going through the writer"""
+        await self.db.start()
+        service_id = await self.db.create_service("Basic", 100000, 30, 50)
+        self.assertTrue(await self.db.update_service(service_id, price=120000, name="Plus"))
+        self.assertEqual(await self.db.toggle_service(service_id), False)
+        service = await self.db.get_service_by_id(service_id)
+        self.assertEqual((service.name, service.price, service.is_active), ("Plus", 120000, False))
+        with self.assertRaises(AttributeError):
+            service.price = 1  # cached reads are shared, so they are read-only copies
+        self.assertTrue(await self.db.delete_service(service_id))
+        self.assertFalse(await self.db.update_service(service_id, price=1))
+        self.assertIsNone(await self.db.toggle_service(service_id))
+
+    async def test_sales_summary(self):
+        """Test the single-scan day/week/month sales aggregation"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        now = datetime.utcnow()
+        async with self.db.Session() as session:
+            for transaction in [
+                Transaction(user_id=user_id, amount=100, type='purchase', status='completed', created_at=now),
+                Transaction(user_id=user_id, amount=200, type='purchase', status='completed',
+                            created_at=now - timedelta(days=3)),
+                Transaction(user_id=user_id, amount=400, type='purchase', status='completed',
+                            created_at=now - timedelta(days=20)),
+                Transaction(user_id=user_id, amount=800, type='purchase', status='pending', created_at=now),
+                Transaction(user_id=user_id, amount=1600, type='deposit', status='completed', created_at=now),
+            ]:
+                await add_transaction(session, transaction)
+            await session.commit()
+
+        daily, weekly, monthly = await self.db.get_sales_summary(now.date())
+        self.assertEqual(daily, (1, 100))
+        self.assertEqual(weekly, (2, 300))
+        self.assertEqual(monthly, (3, 700))
+
+    async def test_popular_services(self):
+        """Test best sellers are ranked by completed purchases in the period"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        basic = await self.db.create_service("Basic", 100, 30, 10)
+        premium = await self.db.create_service("Premium", 200, 30, 50)
+        for service_id, status in [(basic, 'completed'), (premium, 'completed'),
+                                   (premium, 'completed'), (basic, 'pending')]:
+            await self.db.create_transaction(user_id, 100, 'purchase', status, service_id=service_id)
+
+        now = datetime.utcnow()
+        popular = await self.db.get_popular_services(now - timedelta(days=1), now + timedelta(days=1))
+        self.assertEqual(popular, [("Premium", 2), ("Basic", 1)])
+
+    async def test_sales_rollup_follows_transactions(self):
+        """Test that the daily rollup tracks transaction inserts and status changes"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        pending_id = await self.db.create_transaction(user_id, 500, 'purchase')
+        await self.db.create_transaction(user_id, 300, 'purchase', status='completed')
+        await self.db.update_transaction_status(pending_id, 'completed')
+
+        today = datetime.utcnow().date()
+        self.assertEqual(await self.db.get_sales_totals(today, today), (2, 800))
+
+        async with self.db.engine.connect() as conn:
+            self.assertEqual(await conn.run_sync(check_sales_rollup), [])
+
+    async def test_keyset_pagination(self):
+        """Test paging forward and back over a composite descending key with ties"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        created_at = datetime(2025, 1, 1)
+        async with self.db.Session() as session:
+            for i in range(25):
+                await add_transaction(session, Transaction(
+                    user_id=user_id, amount=i, type='deposit', status='pending',
+                    created_at=created_at + timedelta(days=i // 2)
+                ))
+            await session.commit()
+
+        paginator = KeysetPaginator(
+            select(Transaction).filter_by(status='pending'),
+            Transaction.created_at, Transaction.id,
+            page_size=10, descending=True
+        )
+        async with self.db.Session() as session:
+            pages = [await paginator.page(session)]
+            while pages[-1].next_token:
+                pages.append(await paginator.page(session, pages[-1].next_token))
+            back = await paginator.page(session, pages[-1].prev_token)
+
+        self.assertEqual([[t.amount for t in page.items] for page in pages],
+                         [list(range(24, 14, -1)), list(range(14, 4, -1)), list(range(4, -1, -1))])
+        self.assertIsNone(pages[0].prev_token)
+        self.assertEqual(back.items, pages[1].items)
+        self.assertEqual(back.prev_token, pages[1].prev_token)
+
+    async def test_keyset_pagination_bad_input(self):
+        """Test that rows with a NULL key are skipped and tampered tokens restart at the first page"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        async with self.db.Session() as session:
+            for i in range(4):
+                await add_transaction(session, Transaction(user_id=user_id, amount=i + 1, type='deposit', status='pending'))
+            await session.execute(text("UPDATE transactions SET created_at = NULL WHERE amount = 1"))  # legacy row
+            await session.commit()
+
+        paginator = KeysetPaginator(
+            select(Transaction).filter_by(status='pending'),
+            Transaction.created_at, Transaction.id,
+            page_size=2, descending=True
+        )
+        async with self.db.Session() as session:
+            first = await paginator.page(session)
+            rest = await paginator.page(session, first.next_token)
+            self.assertEqual([t.amount for t in first.items + rest.items], [4, 3, 2])
+            for token in ('nabc', 'n1.2.3', 'p99999999999999999999.1', 'x12'):
+                page = await paginator.page(session, token)
+                self.assertEqual((page.items, page.prev_token), (first.items, None))
+
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+            self.flood_limits = {3: 1}  # chat id -> RetryAfter errors left to raise
+            self.network_errors = {}
+
+        async def send_message(self, chat_id, text, reply_markup=None):
+            if self.flood_limits.get(chat_id):
+                self.flood_limits[chat_id] -= 1
+                raise RetryAfter(0)
+            if self.network_errors.get(chat_id):
+                self.network_errors[chat_id] -= 1
+                raise NetworkError("connection reset")
+            if chat_id == 4:
+                raise Forbidden("bot was blocked by the user")
+            self.sent.append(chat_id)
+            return Mock(chat_id=chat_id, message_id=1)
+
+        async def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+            self.progress = text
+
+    def _broadcaster(self, bot):
+        return Broadcaster(bot, self.db, SendRateLimiter(rate=1000, per_chat_interval=0),
+                           concurrency=4, stream_batch_size=3)
+
+    async def test_broadcast(self):
+        """Test that a broadcast retries after RetryAfter and counts blocked chats as failed"""
+        for telegram_id in range(1, 11):
+            await self.db.create_user(telegram_id=telegram_id)
+
+        bot = self.FakeBot()
+        job = await self.db.create_broadcast_job("hello", 'all', 999)
+        self.assertEqual(await self._broadcaster(bot).run(job), (9, 1))
+        self.assertEqual(sorted(bot.sent), [1, 2, 3, 5, 6, 7, 8, 9, 10, 999])
+        self.assertIn("✅ موفق: 9", bot.progress)
+
+    async def test_broadcast_retries(self):
+        """Test that RetryAfter pauses use no attempt and only network errors run out the retries"""
+        for telegram_id in range(1, 11):
+            await self.db.create_user(telegram_id=telegram_id)
+
+        bot = self.FakeBot()
+        bot.flood_limits = {3: 5, 6: 11}
+        bot.network_errors = {5: 3, 7: 2}
+        job = await self.db.create_broadcast_job("hello", 'all', 999)
+        self.assertEqual(await self._broadcaster(bot).run(job), (7, 3))
+        self.assertEqual(sorted(bot.sent), [1, 2, 3, 7, 8, 9, 10, 999])
+
+    async def test_broadcast_resume(self):
+        """Test that a resumed broadcast skips users before the checkpoint and already delivered ones"""
+        user_ids = [await self.db.create_user(telegram_id=telegram_id) for telegram_id in range(1, 11)]
+        job = await self.db.create_broadcast_job("hello", 'all', 999)
+        await self.db.checkpoint_broadcast_job(job.id, user_ids[4], 5, 0)
+        await self.db.record_broadcast_delivery(job.id, user_ids[6])
+
+        job, = await self.db.get_running_broadcast_jobs()
+        bot = self.FakeBot()
+        self.assertEqual(await self._broadcaster(bot).run(job), (9, 0))
+        self.assertEqual(sorted(bot.sent), [6, 8, 9, 10, 999])
+
+        self.assertTrue(await self.db.finish_broadcast_job(job.id, 'completed'))
+        self.assertEqual(await self.db.get_running_broadcast_jobs(), [])
+
+    async def test_broadcast_cancel(self):
+        """Test that a cancelled broadcast leaves no delivery rows behind once the job is finished"""
+        for telegram_id in range(10, 40):
+            await self.db.create_user(telegram_id=telegram_id)
+        await self.db.start()
+
+        class SlowBot(self.FakeBot):
+            async def send_message(self, chat_id, text, reply_markup=None):
+                await asyncio.sleep(0.01)
+                return await super().send_message(chat_id, text, reply_markup)
+
+        bot = SlowBot()
+        job = await self.db.create_broadcast_job("hello", 'all', 999)
+        task = asyncio.create_task(self._broadcaster(bot).run(job))
+        while len(bot.sent) < 6:  # the progress message and a few recipients
+            await asyncio.sleep(0.005)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertTrue(await self.db.finish_broadcast_job(job.id, 'cancelled'))
+
+        await asyncio.sleep(0.05)
+        async with self.db.Session() as session:
+            self.assertEqual((await session.scalars(select(BroadcastDelivery))).all(), [])
+            self.assertGreater((await session.get(BroadcastJob, job.id)).sent, 0)
+
+    async def test_expiry_reminders_fire_once(self):
+        """Test that each due expiry warning is sent once, across scheduler restarts"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        service_id = await self.db.create_service("Test Service", 100000, 30, 50)
+        now = datetime.utcnow()
+        for days in (2, 5, 20):
+            await self.db.create_user_service(user_id, service_id, "test_user", now + timedelta(days=days), 50)
+
+        bot = self.FakeBot()
+        for _ in range(2):
+            scheduler = ExpiryScheduler(self.db, SendRateLimiter(rate=1000, per_chat_interval=0))
+            task = asyncio.create_task(scheduler.run(bot))
+            await asyncio.sleep(0.2)
+            task.cancel()
+
+        # Only the most urgent due warning is sent; later thresholds stay scheduled
+        self.assertEqual(bot.sent, [123456, 123456])
+        async with self.db.Session() as session:
+            notified = (await session.scalars(
+                select(UserService.expiry_notified_days).order_by(UserService.expire_date)
+            )).all()
+        self.assertEqual(notified, [3, 7, None])
+        self.assertEqual(len(scheduler.heap), 3)
+        self.assertEqual(next_expiry_reminder(now + timedelta(days=20), None, [7, 3, 1], now),
+                         (now + timedelta(days=13), 7))
+
+    async def test_expiry_reminder_failed_send(self):
+        """Test that a failed expiry warning still schedules the next threshold"""
+        user_id = await self.db.create_user(telegram_id=4)  # FakeBot: blocked the bot
+        service_id = await self.db.create_service("Test Service", 100000, 30, 50)
+        user_service_id = await self.db.create_user_service(
+            user_id, service_id, "test_user", datetime.utcnow() + timedelta(days=2), 50
+        )
+
+        scheduler = ExpiryScheduler(self.db, SendRateLimiter(rate=1000, per_chat_interval=0))
+        await scheduler._fire(self.FakeBot(), user_service_id)
+        self.assertEqual(scheduler.sent, 0)
+        self.assertEqual([entry[1] for entry in scheduler.heap], [user_service_id])
+
+    async def test_low_data_warnings(self):
+        """Test that each data threshold is warned about once, highest crossed first"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        service_id = await self.db.create_service("Test Service", 100000, 30, 100)
+        async with self.db.Session() as session:
+            for used, active in ((50, True), (85, True), (92, True), (99, True), (99, False)):
+                session.add(UserService(user_id=user_id, service_id=service_id, data_limit=100,
+                                        data_used=used, is_active=active))
+            await session.commit()
+
+        limiter = SendRateLimiter(rate=1000, per_chat_interval=0)
+        bot = self.FakeBot()
+        self.assertEqual(await send_low_data_warnings(self.db, bot, limiter), 3)
+        self.assertEqual(await send_low_data_warnings(self.db, bot, limiter), 0)
+
+        async with self.db.Session() as session:
+            services = (await session.scalars(select(UserService).order_by(UserService.id))).all()
+            self.assertEqual([s.data_notified_percent for s in services], [None, 80, 90, 95, None])
+            services[1].data_used = 96
+            await session.commit()
+        self.assertEqual(await send_low_data_warnings(self.db, bot, limiter), 1)
+
+    async def _fake_marzban(self, users, inbounds=()):
+        """Local stand-in for the Marzban token, users and inbounds endpoints. Returns (server, state)."""
+        state = {'logins': 0, 'token': None, 'requests': 0, 'status': 200, 'delay': 0,
+                 'inbounds': {inbound['id']: dict(inbound) for inbound in inbounds}, 'inbound_reads': 0,
+                 'accounts': {}, 'create_failures': 0, 'delete_failures': set()}
+
+        async def token(request):
+            form = await request.post()
+            if form['username'] != 'admin':
+                return web.json_response({}, status=401)
+            state['logins'] += 1
+            payload = base64.urlsafe_b64encode(json.dumps({'exp': time.time() + 3600}).encode()).decode()
+            state['token'] = f"header.{payload.rstrip('=')}.{state['logins']}"
+            return web.json_response({'access_token': state['token']})
+
+        async def list_users(request):
+            if request.headers.get('Authorization') != f"Bearer {state['token']}":
+                return web.json_response({}, status=401)
+            state['requests'] += 1
+            await asyncio.sleep(state['delay'])
+            if state['status'] != 200:
+                return web.json_response({}, status=state['status'])
+            offset, limit = int(request.query['offset']), int(request.query['limit'])
+            return web.json_response({'users': users[offset:offset + limit], 'total': len(users)})
+
+        async def list_inbounds(request):
+            state['inbound_reads'] += 1
+            return web.json_response(list(state['inbounds'].values()))
+
+        async def update_inbound(request):
+            inbound = state['inbounds'][int(request.match_info['id'])]
+            inbound.update(await request.json())
+            return web.json_response(inbound)
+
+        async def create_user(request):
+            if state['create_failures']:
+                state['create_failures'] -= 1
+                return web.json_response({}, status=503)
+            data = await request.json()
+            if data['username'] in state['accounts']:
+                return web.json_response({'detail': 'User already exists'}, status=409)
+            state['accounts'][data['username']] = data
+            return web.json_response({**data, 'subscription_url': f"/sub/{data['username']}"})
+
+        async def delete_user(request):
+            username = request.match_info['username']
+            if username in state['delete_failures']:
+                return web.json_response({}, status=500)
+            if state['accounts'].pop(username, None) is None:
+                return web.json_response({'detail': 'User not found'}, status=404)
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_post('/api/admin/token', token)
+        app.router.add_post('/api/user', create_user)
+        app.router.add_delete('/api/user/{username}', delete_user)
+        app.router.add_get('/api/users', list_users)
+        app.router.add_get('/api/inbounds', list_inbounds)
+        app.router.add_put('/api/inbound/{id}', update_inbound)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        return server, state
+
+    async def test_marzban_client_token_reuse(self):
+        """Test that concurrent calls share one login and a revoked token is refreshed once"""
+        server, state = await self._fake_marzban([{'username': 'user0'}])
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+
+        await asyncio.gather(*(client.get_users(offset) for offset in range(20)))
+        self.assertEqual(state['logins'], 1)
+
+        state['token'] = 'revoked'
+        await asyncio.gather(*(client.get_users(offset) for offset in range(5)))
+        self.assertEqual(state['logins'], 2)
+        self.assertEqual(client.latency['GET /api/users'].count, 30)
+
+    async def test_marzban_client_coalescing(self):
+        """Test that identical concurrent reads share one request and different pages do not"""
+        server, state = await self._fake_marzban([{'username': f"user{i}"} for i in range(10)])
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+        state['delay'] = 0.05
+
+        results = await asyncio.gather(*(client.get_users(0, 5) for _ in range(10)), client.get_users(5, 5))
+        self.assertEqual(state['requests'], 2)
+        self.assertEqual(results[0]['users'][0]['username'], 'user0')
+        self.assertEqual(results[10]['users'][0]['username'], 'user5')
+        self.assertEqual(client.inflight, {})
+
+    async def test_marzban_circuit_breaker(self):
+        """Test that a failing panel opens the circuit, fails fast and recovers through one trial call"""
+        server, state = await self._fake_marzban([{'username': 'user0'}])
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+        client.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.1)
+        await client.get_users()
+
+        state['status'] = 503
+        for _ in range(3):
+            with self.assertRaises(ClientResponseError):
+                await client.get_users()
+        self.assertEqual(client.breaker.state, 'open')
+
+        requests = state['requests']
+        with self.assertRaises(PanelUnavailable):
+            await client.get_users()
+        self.assertEqual(state['requests'], requests)
+
+        # Half-open: the trial fails and reopens the circuit
+        await asyncio.sleep(0.1)
+        with self.assertRaises(ClientResponseError):
+            await client.get_users()
+        self.assertEqual(client.breaker.state, 'open')
+
+        # Any other error in the trial also reopens it instead of wedging it half-open
+        await asyncio.sleep(0.1)
+        async def malformed():
+            raise KeyError('access_token')
+        with self.assertRaises(KeyError):
+            await client._guarded(malformed)
+        self.assertEqual((client.breaker.state, client.breaker.trial_running), ('open', False))
+
+        state['status'] = 200
+        await asyncio.sleep(0.1)
+        await client.get_users()
+        self.assertEqual((client.breaker.state, client.breaker.failures), ('closed', 0))
+
+    async def test_inbound_registry(self):
+        """Test that inbounds are read once per TTL and updates are written through to the cache"""
+        server, state = await self._fake_marzban([], [
+            {'id': 1, 'tag': 'vless', 'port': 443, 'enable': True},
+            {'id': 2, 'tag': 'vmess', 'port': 8080, 'enable': True}
+        ])
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+        registry = InboundRegistry(client, ttl=60)
+
+        self.assertEqual(len(await registry.all()), 2)
+        self.assertTrue(await registry.exists(2))
+        self.assertFalse(await registry.exists(3))
+        await registry.update(2, {'enable': False})
+        self.assertFalse((await registry.get(2))['enable'])
+        self.assertFalse(state['inbounds'][2]['enable'])
+        self.assertEqual(state['inbound_reads'], 1)
+
+        # Expired and the panel is down: the last copy is still served
+        registry.loaded_at -= 60
+        client.breaker.state, client.breaker.opened_at = 'open', time.monotonic()
+        self.assertEqual((await registry.get(1))['tag'], 'vless')
+        self.assertEqual(state['inbound_reads'], 1)
+
+    async def test_provisioning_queue(self):
+        """Test that a repeated purchase is charged once and its account is created after retries"""
+        await self.db.create_user(telegram_id=123456)
+        await self.db.update_user_balance(123456, 250000)
+        service = await self.db.get_service(await self.db.create_service("Test Service", 100000, 30, 50))
+        server, state = await self._fake_marzban([], [{'id': 1, 'tag': 'vless', 'protocol': 'vless', 'enable': True}])
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+        provisioner = Provisioner(self.db, client, InboundRegistry(client), SendRateLimiter(rate=1000, per_chat_interval=0),
+                                  admin_id=1, backoff_base=0, poll_interval=0.01)
+
+        first, replay = [await self.db.purchase_service(123456, service, idempotency_key='purchase_123456_7_1')
+                         for _ in range(2)]
+        self.assertEqual((first[1], replay), (True, (first[0], False)))
+        ids = [first[0]]
+        self.assertEqual((await self.db.get_user(123456)).wallet_balance, 150000)
+
+        state['create_failures'] = 2
+        bot = self.FakeBot()
+        for _ in range(3):
+            self.assertEqual(await provisioner.run_once(bot), 1)
+        self.assertEqual(await provisioner.run_once(bot), 0)
+
+        username = f"vpn123456_{ids[0]}"
+        self.assertEqual(state['accounts'][username]['data_limit'], 50 * 1024 * MB)
+        self.assertEqual(bot.sent, [123456])
+        async with self.db.Session() as session:
+            job = (await session.scalars(select(ProvisioningJob))).one()
+        self.assertEqual((job.status, job.attempts), ('completed', 2))
+
+    async def test_provisioning_refund(self):
+        """Test that a job given up on refunds the buyer once and alerts the admin"""
+        await self.db.create_user(telegram_id=123456)
+        await self.db.update_user_balance(123456, 250000)
+        service = await self.db.get_service(await self.db.create_service("Test Service", 100000, 30, 50))
+        server, state = await self._fake_marzban([], [{'id': 1, 'tag': 'vless', 'protocol': 'vless', 'enable': True}])
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+        provisioner = Provisioner(self.db, client, InboundRegistry(client), SendRateLimiter(rate=1000, per_chat_interval=0),
+                                  admin_id=1, max_attempts=2, backoff_base=0, poll_interval=0.01)
+
+        user_service_id, _ = await self.db.purchase_service(123456, service)
+        state['create_failures'] = 2
+        bot = self.FakeBot()
+        for _ in range(2):
+            self.assertEqual(await provisioner.run_once(bot), 1)
+
+        self.assertEqual(sorted(bot.sent), [1, 123456])
+        self.assertEqual((await self.db.get_user(123456)).wallet_balance, 250000)
+        self.assertEqual(await self.db.refund_provisioning_job(1, 'again'), 0)
+        self.assertEqual((await self.db.get_user(123456)).wallet_balance, 250000)
+        async with self.db.Session() as session:
+            self.assertFalse((await session.get(UserService, user_service_id)).is_active)
+            statuses = (await session.execute(select(Transaction.type, Transaction.status)
+                                              .where(Transaction.type != 'deposit'))).all()
+        self.assertEqual(sorted(statuses), [('purchase', 'refunded'), ('refund', 'completed')])
+
+    async def test_purchase_error(self):
+        """Test that a database error in a purchase is raised instead of reported as a short balance"""
+        await self.db.create_user(telegram_id=123456)
+        await self.db.update_user_balance(123456, 250000)
+        service = await self.db.get_service(await self.db.create_service("Test Service", 100000, 30, 50))
+        with patch('database.add_transaction', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                await self.db.purchase_service(123456, service)
+        self.assertEqual((await self.db.get_user(123456)).wallet_balance, 250000)
+
+    async def test_cleanup_expired_users(self):
+        """Test that expired services are deleted a chunk at a time and failed panel deletes are kept"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        service_id = await self.db.create_service("Test Service", 100000, 30, 50)
+        expired = datetime.utcnow() - timedelta(days=60)
+        async with self.db.Session() as session:
+            session.add_all(UserService(user_id=user_id, service_id=service_id, marzban_username=f"user{i}",
+                                        expire_date=expired, is_active=i == 0) for i in range(250))
+            await session.commit()
+
+        server, state = await self._fake_marzban([])
+        state['accounts'] = {f"user{i}": {} for i in range(200)}  # user200+ are already gone from the panel
+        state['delete_failures'] = {'user7'}
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+        cleanup = CleanupManager(Mock(db=self.db, marzban=client))
+        await self.db.start()
+
+        with patch.dict(CLEANUP_SETTINGS, expired_users_chunk_size=100):
+            self.assertEqual(await cleanup.cleanup_expired_users(), (248, 1))
+        self.assertEqual(set(state['accounts']), {'user0', 'user7'})
+        async with self.db.Session() as session:
+            self.assertEqual((await session.scalars(select(UserService.marzban_username))).all(), ['user0', 'user7'])
+
+        state['delete_failures'] = set()
+        with patch.dict(CLEANUP_SETTINGS, expired_users_chunk_size=100):
+            self.assertEqual(await cleanup.cleanup_expired_users(), (1, 0))
+
+    async def test_service_catalog(self):
+        """Test that the catalog snapshot is versioned, immutable and carries the buy menu"""
+        catalog = ServiceCatalog(self.db)
+        first = await catalog.reload()
+        self.assertEqual((first.version, first.services), (1, ()))
+
+        basic = await self.db.create_service("Basic", 100000, 30, 50)
+        await self.db.create_service("Hidden", 50000, 30, 10)
+        async with self.db.Session() as session:
+            (await session.get(Service, 2)).is_active = False
+            await session.commit()
+        snapshot = await catalog.reload()
+
+        self.assertEqual(snapshot.version, 2)
+        self.assertEqual([entry.name for entry in snapshot.active], ["Basic"])
+        self.assertEqual(catalog.get(str(basic)).price, 100000)
+        self.assertEqual(catalog.get(2).is_active, False)
+        buttons = [row[0] for row in snapshot.buy_markup.inline_keyboard]
+        self.assertEqual([(b.text, b.callback_data) for b in buttons],
+                         [("Basic - 100,000.0 تومان", f"service_{basic}"), ("🔙 بازگشت", 'back_to_main')])
+        with self.assertRaises(TypeError):
+            snapshot.by_id[3] = None
+        self.assertEqual(first.version, 1)  # earlier snapshots are left untouched
+
+    async def test_usage_sync(self):
+        """Test that usage is paged in from Marzban and only changed rows are written"""
+        user_id = await self.db.create_user(telegram_id=123456)
+        service_id = await self.db.create_service("Test Service", 100000, 30, 50)
+        for i in range(3):
+            await self.db.create_user_service(user_id, service_id, f"user{i}", datetime.utcnow() + timedelta(days=30), 51200)
+        async with self.db.Session() as session:
+            (await session.get(UserService, 2)).data_used = 100  # user1 is already up to date
+            await session.commit()
+
+        users = [{'username': f"user{i}", 'used_traffic': i * 100 * MB, 'data_limit': 50 * 1024 * MB}
+                 for i in range(1200)]
+        server, _ = await self._fake_marzban(users)
+        client = MarzbanClient(str(server.make_url('')), 'admin', 'secret')
+        self.addAsyncCleanup(client.close)
+        sync = UsageSync(self.db, client, page_size=500, concurrency=2)
+        self.assertEqual([s[6] for s in await self.db.get_user_active_services(user_id)], [0, 100, 0])  # cached
+
+        stats = await sync.run_once()
+        self.assertEqual((stats.users_seen, stats.rows_changed, stats.api_calls), (1200, 1, 4))
+        self.assertEqual([s[6] for s in await self.db.get_user_active_services(user_id)], [0, 100, 200])
+        self.assertEqual((await sync.run_once()).rows_changed, 0)
+
+    async def test_buffered_logs(self):
+        """Test that log rows are buffered and written in a few batches, flushed on close"""
+        await self.db.start()
+        for i in range(250):
+            await self.db.log_system('INFO', 'test', f'message {i}')
+        commits = self.db.writer.commits
+        await self.db.close()
+
+        self.assertEqual(self.db.logs.flushed, 250)
+        self.assertLessEqual(self.db.logs.flushes, 3)
+        self.assertLessEqual(self.db.writer.commits - commits, 3)
+        engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'test.db')}")
+        with engine.connect() as conn:
+            self.assertEqual(conn.execute(text("SELECT count(*) FROM system_logs")).scalar(), 250)
+        engine.dispose()
+
+    async def test_log_backlog_is_bounded(self):
+        """Test that a full log buffer drops the oldest rows and counts them"""
+        written = []
+
+        async def write(job):
+            written.append(job)
+
+        logs = LogBuffer(write, max_backlog=3)
+        for i in range(5):
+            logs.add(SystemLog, message=f'message {i}')
+        self.assertEqual(logs.dropped, 2)
+        self.assertEqual([row['message'] for _, row in logs.rows], ['message 2', 'message 3', 'message 4'])
+
+        await logs.stop()
+        self.assertEqual((logs.flushed, len(written)), (3, 1))
+
+class TestMigrations(unittest.TestCase):
+    def test_indexes_added_to_existing_database(self):
+        """Test that migrations add indexes create_all skips on existing tables"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_transactions_type_status_created"))
+
+        self.assertEqual(run_migrations(engine), [version for version, _, _ in MIGRATIONS])
+        self.assertEqual(run_migrations(engine), [])
+
+        index_names = {index['name'] for index in inspect(engine).get_indexes('transactions')}
+        self.assertIn('ix_transactions_type_status_created', index_names)
+
+    def test_data_limit_gb_to_mb(self):
+        """Test that legacy GB data limits are converted once and MB limits are left alone"""
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO user_services (user_id, service_id, marzban_username, data_limit) "
+                              "VALUES (1, 1, 'legacy', 50), (1, 1, 'synced', 51200), (1, 1, 'unlimited', 0)"))
+            conn.execute(text("CREATE TABLE schema_migrations ("
+                              "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)"))
+            conn.execute(text("INSERT INTO schema_migrations VALUES (7, 'provisioning jobs', '2024-01-01')"))
+
+        self.assertIn(8, run_migrations(engine))
+        self.assertNotIn(8, run_migrations(engine))
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT marzban_username, data_limit FROM user_services ORDER BY id")).all()
+        self.assertEqual(rows, [('legacy', 51200), ('synced', 51200), ('unlimited', 0)])
+
+class TestMemoryTier(unittest.TestCase):
+    @patch('cache_manager.time.monotonic')
+    def test_lru_ttl_namespaces(self, monotonic):
+        """Test LRU eviction, TTL expiry and per-namespace limits and counters"""
+        monotonic.return_value = 0
+        tier = MemoryTier(max_size=3, namespace_sizes={'services': 1}, expire_time=10)
+        for key in ('a', 'b', 'c'):
+            tier.set(key, key.upper())
+        self.assertEqual(tier.get('a'), 'A')  # a is now the most recently used
+        tier.set('d', 'D')
+        self.assertIsNone(tier.get('b'))
+        tier.set('e', 'E', expire_seconds=5)
+        tier.set('x', 1, namespace='services')
+        tier.set('y', 2, namespace='services')
+        self.assertEqual((tier.get('x', 'services'), tier.get('y', 'services')), (None, 2))
+
+        monotonic.return_value = 6
+        self.assertIsNone(tier.get('e'))
+        self.assertEqual(tier.get('d'), 'D')
+        monotonic.return_value = 11
+        self.assertEqual(tier.purge_expired(), 3)
+
+        stats = tier.stats()
+        self.assertEqual({k: stats['default'][k] for k in ('hits', 'misses', 'evictions', 'expirations', 'size')},
+                         {'hits': 2, 'misses': 2, 'evictions': 2, 'expirations': 3, 'size': 0})
+        self.assertEqual((stats['services']['evictions'], stats['services']['max_size']), (1, 1))
+
+class TestMenuRegistry(unittest.TestCase):
+    def test_prebuilt_menus(self):
+        """Test that static menus are built once, shared and differ by role"""
+        menus = MenuRegistry()
+        user_main = menus.get('main', 'user')
+        self.assertIs(menus.get('main', 'user', 'en'), user_main)  # unknown locale falls back
+        self.assertEqual([row[0].callback_data for row in user_main.inline_keyboard],
+                         ['buy_service', 'user_account', 'service_info'])
+        self.assertEqual(menus.get('main', 'admin').inline_keyboard[-1][0].callback_data, 'admin_panel')
+        self.assertEqual([row[0].callback_data for row in menus.get('wallet_charge').inline_keyboard][:2],
+                         ['charge_50000', 'charge_100000'])
+        with self.assertRaises(KeyError):
+            menus.get('admin_panel', 'user')
+        with self.assertRaises(AttributeError):
+            user_main.inline_keyboard = ()
+
+class TestCacheManager(unittest.IsolatedAsyncioTestCase):
+    async def test_disk_tier(self):
+        """Test that the disk tier takes any key, keeps bytes binary and sweeps expired rows"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'old.cache'), 'w') as f:
+                f.write('{}')
+            cache = CacheManager(tmpdir)
+            await cache.set_in_disk('report/../daily?2024', {'sales': [1, 2]}, 60)
+            self.assertEqual(os.listdir(tmpdir).count('old.cache'), 0)
+            await cache.set_in_disk('blob', b'\x00\xff' * 1000, 1)
+            self.assertEqual(await cache.get_from_disk('report/../daily?2024'), {'sales': [1, 2]})
+            self.assertEqual(await cache.get_from_disk('blob'), b'\x00\xff' * 1000)
+
+            with patch('cache_manager.time.time', return_value=time.time() + 2):
+                self.assertIsNone(await cache.get_from_disk('blob'))
+                self.assertEqual(await asyncio.to_thread(cache.disk.purge_expired), 1)
+            self.assertIsNotNone(await cache.get_from_disk('report/../daily?2024'))
+            cache.close()
+
+    async def test_cached_decorator(self):
+        """Test single-flight loads and invalidation by namespace and tag, for async and sync functions"""
+        calls = []
+
+        class Repository:
+            cache_manager = CacheManager()
+
+            @cached('services', key='{service_id}')
+            async def get_service(self, service_id):
+                calls.append(service_id)
+                await asyncio.sleep(0.01)
+                return {'id': service_id}
+
+            @cached('users', tags=('user:{user_id}',))
+            def get_services_of(self, user_id, active=True):
+                calls.append((user_id, active))
+                return [user_id]
+
+        repo = Repository()
+        results = await asyncio.gather(*(repo.get_service(1) for _ in range(10)), repo.get_service('1'))
+        self.assertEqual(results, [{'id': 1}] * 11)
+        self.assertEqual(calls, [1])
+
+        repo.get_services_of(7)
+        repo.get_services_of(7)
+        repo.get_services_of(8)
+        self.assertEqual(len(calls), 3)
+
+        repo.cache_manager.invalidate_tag('user:7')
+        repo.get_services_of(7)
+        repo.get_services_of(8)
+        repo.cache_manager.invalidate('services')
+        await repo.get_service(1)
+        self.assertEqual(calls[3:], [(7, True), 1])
+        self.assertEqual(repo.cache_manager.stats()['users']['hits'], 2)
+
+    async def test_cached_disk_survives_restart(self):
+        """Test that disk entries are reused by a new manager and invalidated by any of them"""
+        calls = []
+
+        class Reports:
+            def __init__(self, cache_dir):
+                self.cache_manager = CacheManager(cache_dir)
+
+            @cached('reports', key='{day}', disk=True)
+            async def report(self, day):
+                calls.append(day)
+                return {'day': day, 'run': len(calls)}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            first = Reports(tmpdir)
+            self.assertEqual(await first.report('d1'), {'day': 'd1', 'run': 1})
+            first.cache_manager.close()
+
+            # A restart reuses the entry; invalidating before any disk use still reaches it
+            second = Reports(tmpdir)
+            self.assertEqual(await second.report('d1'), {'day': 'd1', 'run': 1})
+            second.cache_manager.close()
+            third = Reports(tmpdir)
+            third.cache_manager.invalidate('reports')
+            self.assertEqual(await third.report('d1'), {'day': 'd1', 'run': 2})
+            third.cache_manager.close()
+
+            fourth = Reports(tmpdir)
+            self.assertEqual(await fourth.report('d1'), {'day': 'd1', 'run': 2})
+            fourth.cache_manager.invalidate('reports')  # written through in the background
+            fourth.cache_manager.close()
+
+            fifth = Reports(tmpdir)
+            self.assertEqual(await fifth.report('d1'), {'day': 'd1', 'run': 3})
+            fifth.cache_manager.close()
+        self.assertEqual(calls, ['d1', 'd1', 'd1'])
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from collections import namedtuple
+from typing import Dict, List, Tuple
+
+from advanced_config import MARZBAN_SYNC_SETTINGS
+from marzban_client import MarzbanClient
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+UsageSyncStats = namedtuple('UsageSyncStats', ['duration', 'api_calls', 'users_seen', 'rows_changed'])
+
+
+class UsageSync:
+    """Copies traffic usage from the Marzban panel into user_services.
+
+    Panel users are fetched page_size at a time, at most `concurrency` pages
+    in flight. Each page is diffed against the local rows and only services
+    whose usage or limit changed are written, with one executemany per page.
+    data_used and data_limit are stored in MB.
+    """
+
+    def __init__(self, db, client: MarzbanClient,
+                 page_size: int = MARZBAN_SYNC_SETTINGS['page_size'],
+                 concurrency: int = MARZBAN_SYNC_SETTINGS['concurrency'],
+                 interval: float = MARZBAN_SYNC_SETTINGS['interval']):
+        self.db = db
+        self.client = client
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.interval = interval
+        self.last_stats = None
+
+    async def run_forever(self):
+        while True:
+            try:
+                stats = await self.run_once()
+                logger.info(
+                    f"Usage sync: {stats.users_seen} panel users, {stats.rows_changed} rows changed, "
+                    f"{stats.api_calls} API calls in {stats.duration:.2f}s"
+                )
+            except Exception as e:
+                logger.error(f"Usage sync failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> UsageSyncStats:
+        started = time.monotonic()
+        calls = self.client.calls
+        local = await self.db.get_usage_snapshot()
+
+        first = await self.client.get_users(0, self.page_size)
+        counts = [await self._sync_page(local, first['users'])]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def sync_page(offset):
+            async with semaphore:
+                page = await self.client.get_users(offset, self.page_size)
+            return await self._sync_page(local, page['users'])
+
+        counts += await asyncio.gather(*(
+            sync_page(offset) for offset in range(self.page_size, first['total'], self.page_size)
+        ))
+
+        self.last_stats = UsageSyncStats(
+            time.monotonic() - started, self.client.calls - calls,
+            sum(users_seen for users_seen, _ in counts), sum(rows_changed for _, rows_changed in counts)
+        )
+        return self.last_stats
+
+    async def _sync_page(self, local: Dict[str, List[Tuple[int, int, int]]], users: List[dict]) -> Tuple[int, int]:
+        """Write the changed rows of one page. Returns (users seen, rows changed)."""
+        rows = []
+        for user in users:
+            used = (user.get('used_traffic') or 0) // MB
+            limit = (user.get('data_limit') or 0) // MB
+            for user_service_id, data_used, data_limit in local.get(user['username'], ()):
+                # A panel limit of 0 means unlimited; keep the purchased one
+                new_limit = limit or data_limit
+                if (used, new_limit) != (data_used, data_limit):
+                    rows.append({'id': user_service_id, 'data_used': used, 'data_limit': new_limit})
+
+        if rows:
+            await self.db.update_usage(rows)
+        return len(users), len(rows)